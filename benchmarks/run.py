@@ -0,0 +1,346 @@
+"""Benchmarks of the query parsing, serialization, service and HTTP hot paths.
+
+Runs against a MongoDB server (--mongodb-uri, eg. a local mongod) or against an
+in-process stand-in (--in-process, needs the `mongomock` package) when no server
+is available. Results are written as JSON so that runs on different commits can
+be compared with --compare.
+
+    python benchmarks/run.py --in-process --output bench.json
+    python benchmarks/run.py --mongodb-uri mongodb://localhost:27017 --compare bench.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+DATABASE = "mangorest_bench"
+COLLECTION = "bench_rocket_engines"
+RESOURCE = "rockets"
+USERS_COLLECTION = "bench_users"
+USERNAME = "bench"
+PASSWORD = "bench-password"
+
+RESULT_SIZES = [10, 100, 1000]
+
+# set by setup()
+app: Any = None
+services: Any = None
+encoder: Any = None
+database: Any = None
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    backend = parser.add_mutually_exclusive_group(required=True)
+    backend.add_argument("--mongodb-uri", help="MongoDB server to benchmark against")
+    backend.add_argument(
+        "--in-process",
+        action="store_true",
+        help="use mongomock instead of a MongoDB server",
+    )
+    parser.add_argument(
+        "--documents",
+        type=int,
+        default=max(RESULT_SIZES),
+        help="number of documents in the benchmark collection",
+    )
+    parser.add_argument(
+        "--min-time",
+        type=float,
+        default=1.0,
+        help="seconds each benchmark runs for, at least",
+    )
+    parser.add_argument(
+        "--filter", default="", help="only run benchmarks with this in their name"
+    )
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--compare", help="results of a previous run to compare with")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.1,
+        help="exit with 1 if a median latency is this much worse than in --compare",
+    )
+    return parser.parse_args()
+
+
+# ===============================================
+# setup
+# ===============================================
+
+
+def setup(args: argparse.Namespace) -> None:
+    """Configure and import mangorest against the benchmark database."""
+
+    global app, services, encoder, database
+
+    os.environ["MONGODB_URI"] = args.mongodb_uri or "mongodb://localhost:27017"
+    os.environ["DATABASE"] = DATABASE
+    os.environ["COLLECTIONS"] = f"{RESOURCE}:{COLLECTION}"
+    os.environ["MANGO_USER_COLLECTION"] = USERS_COLLECTION
+    os.environ.setdefault("JWT_SECRET_KEY", "mangorest-benchmark")
+    os.environ.setdefault("SLOW_QUERY_THRESHOLD_MS", "0")
+
+    import pymongo
+
+    if args.in_process:
+        import mongomock
+
+        client = mongomock.MongoClient()
+        # mangorest creates its client on first use, which must be the stand-in
+        pymongo.MongoClient = lambda *_args, **_kwargs: client
+    else:
+        client = pymongo.MongoClient(args.mongodb_uri)
+
+    db = client[DATABASE]
+    db.drop_collection(COLLECTION)
+    db.drop_collection(USERS_COLLECTION)
+    db[COLLECTION].insert_many(
+        [
+            {
+                "name": f"RD-{index}",
+                "country": ["USSR", "USA", "China", "Japan"][index % 4],
+                "thrust_to_weight_ratio": index % 150,
+                "launched": datetime.datetime(2000, 1, 1)
+                + datetime.timedelta(days=index),
+                "stages": [{"engines": index % 9, "fuel": "RP-1"}],
+            }
+            for index in range(args.documents)
+        ]
+    )
+
+    # benchmark the working tree, even if another mangorest is installed
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import mangorest
+    import mangorest.auth as auth
+    import mangorest.encoder as mangorest_encoder
+    import mangorest.services as mangorest_services
+
+    auth.create_user(db[USERS_COLLECTION], USERNAME, PASSWORD)
+
+    app = mangorest.app
+    services = mangorest_services
+    encoder = mangorest_encoder
+    database = db
+
+
+def teardown() -> None:
+    database.drop_collection(COLLECTION)
+    database.drop_collection(USERS_COLLECTION)
+
+
+# ===============================================
+# measuring
+# ===============================================
+
+
+def measure(function: Callable[[], Any], min_time: float) -> Dict[str, Any]:
+    """Call function repeatedly for at least min_time seconds, after a warmup."""
+
+    for _ in range(3):
+        function()
+
+    latencies: List[float] = []
+    started = time.perf_counter()
+    while True:
+        start = time.perf_counter()
+        function()
+        end = time.perf_counter()
+        latencies.append(end - start)
+        if end - started >= min_time and len(latencies) >= 5:
+            break
+
+    latencies.sort()
+    total = sum(latencies)
+
+    def percentile(fraction: float) -> float:
+        return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)]
+
+    return {
+        "iterations": len(latencies),
+        "ops_per_sec": len(latencies) / total,
+        "latency_ms": {
+            "mean": statistics.mean(latencies) * 1000,
+            "min": latencies[0] * 1000,
+            "p50": percentile(0.5) * 1000,
+            "p90": percentile(0.9) * 1000,
+            "p99": percentile(0.99) * 1000,
+            "max": latencies[-1] * 1000,
+        },
+    }
+
+
+# ===============================================
+# benchmarks
+# ===============================================
+
+
+def benchmarks(args: argparse.Namespace) -> Dict[str, Callable[[], Any]]:
+    client = app.test_client()
+    token = client.post(
+        "/login", json={"username": USERNAME, "password": PASSWORD}
+    ).json["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    api_url = f"/api/{RESOURCE}"
+
+    query_params = {
+        "country": "USSR",
+        "thrust_to_weight_ratio": "gte[int].100",
+        "or": "(country.eq[str].USA,country.eq[str].Japan)",
+    }
+    uncached_queries = iter(range(sys.maxsize))
+
+    documents = {
+        size: list(database[COLLECTION].find(limit=size)) for size in RESULT_SIZES
+    }
+    oid = str(documents[RESULT_SIZES[0]][0]["_id"])
+
+    def crud_cycle() -> None:
+        resp = client.post(api_url, json={"name": "RD-bench"}, headers=headers)
+        new_oid = resp.json["_id"]["$oid"]
+        client.patch(f"{api_url}/{new_oid}", json={"country": "Moon"}, headers=headers)
+        client.delete(f"{api_url}/{new_oid}", headers=headers)
+
+    cases: Dict[str, Callable[[], Any]] = {
+        "query/map_to_query_operator/cached": lambda: services.map_to_query_operator(
+            query_params
+        ),
+        "query/map_to_query_operator/uncached": lambda: services.map_to_query_operator(
+            {**query_params, "name": f"RD-{next(uncached_queries)}"}
+        ),
+        "query/parse_sort": lambda: services.parse_sort.__wrapped__(
+            "(country:ascending),(name:descending)"
+        ),
+    }
+
+    for size in RESULT_SIZES:
+        cases[f"serialize/encoder.dumps/{size}"] = lambda size=size: encoder.dumps(
+            documents[size]
+        )
+        cases[
+            f"serialize/parse_object_id/{size}"
+        ] = lambda size=size: services.parse_object_id(documents[size])
+        cases[
+            f"service/fetch_collection/{size}"
+        ] = lambda size=size: services.fetch_collection(
+            database, COLLECTION, {}, None, None, str(size), None
+        )
+        cases[f"http/get_collection/{size}"] = lambda size=size: client.get(
+            f"{api_url}?_limit={size}"
+        ).close()
+        cases[f"http/get_collection_streamed/{size}"] = lambda size=size: client.get(
+            f"{api_url}?_limit={size}&_stream=true"
+        ).close()
+
+    cases.update(
+        {
+            "service/fetch_document": lambda: services.fetch_document(
+                database, COLLECTION, oid
+            ),
+            "http/get_document": lambda: client.get(f"{api_url}/{oid}").close(),
+            "http/update_document": lambda: client.patch(
+                f"{api_url}/{oid}", json={"country": "USSR"}, headers=headers
+            ).close(),
+            "http/create_update_delete_document": crud_cycle,
+            "http/login": lambda: client.post(
+                "/login", json={"username": USERNAME, "password": PASSWORD}
+            ).close(),
+        }
+    )
+    return {name: case for name, case in cases.items() if args.filter in name}
+
+
+# ===============================================
+# reporting
+# ===============================================
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(
+    results: Dict[str, Dict], baseline: Dict[str, Dict], max_regression: float
+) -> List[str]:
+    """Print the change of the median latencies. Returns the regressed benchmarks."""
+
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["latency_ms"]["p50"]
+        after = result["latency_ms"]["p50"]
+        change = (after - before) / before if before else 0.0
+        print(
+            f"{name:50} {before:10.4f} ms -> {after:10.4f} ms {change:+8.1%}",
+            file=sys.stderr,
+        )
+        if change > max_regression:
+            regressions.append(name)
+    return regressions
+
+
+def main() -> int:
+    args = parse_args()
+    setup(args)
+
+    results = {}
+    try:
+        for name, case in benchmarks(args).items():
+            results[name] = measure(case, args.min_time)
+            print(
+                f"{name:50} {results[name]['ops_per_sec']:12.1f} ops/s "
+                f"p50 {results[name]['latency_ms']['p50']:.4f} ms",
+                file=sys.stderr,
+            )
+    finally:
+        teardown()
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.datetime.utcnow().isoformat() + "Z",
+            "backend": "mongomock" if args.in_process else "mongodb",
+            "documents": args.documents,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        regressions = compare(results, baseline, args.max_regression)
+        if regressions:
+            print(f"Regressed: {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,26 @@
+"""gunicorn settings, picked up from the working directory by `gunicorn mangorest:app`."""
+
+import glob
+import os
+
+# requests run on threads of the workers, so the ones waiting on a password hash
+# (see mangorest.hashing) or on a change stream (see mangorest.watch) hold a
+# thread instead of a whole worker. --threads overrides it.
+worker_class = "gthread"
+threads = 8
+
+
+def on_starting(server):
+    # metrics files of a previous run would be added to the new ones
+    multiproc_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        os.makedirs(multiproc_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(multiproc_dir, "*.db")):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -5,12 +5,17 @@ import logging.config
 
 from flask import Flask
 
-from . import config, logger
+from . import compression, config, encoder, logger, metrics
 
 logging.config.dictConfig(logger.LOGGING_CONFIG)
 
 app = Flask(__name__)
+app.json_encoder = encoder.MangoJSONEncoder
 
 app.config["JWT_SECRET_KEY"] = config.JWT_SECRET_KEY
 
+# metrics first, so its after_request hook runs after compression
+metrics.init_app(app)
+compression.init_app(app)
+
 import mangorest.views
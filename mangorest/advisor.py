@@ -0,0 +1,169 @@
+"""Index advisor.
+
+Records the shapes of the filters and sorts the server runs, ie. the queries with
+their values taken out, and how often each one is seen. The most frequent shapes
+are explained on request to find the ones that scan the whole collection or sort
+in memory, with a suggested compound index for each of them.
+
+Shapes are recorded per worker process.
+"""
+
+import json
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import pymongo
+
+# operators matching a single value, which go first in a compound index
+EQUALITY_OPERATORS = ["$eq", "$in"]
+
+
+class QueryShape(NamedTuple):
+    collection_name: str
+    filter_shape: str
+    sort: Tuple[Tuple[str, int], ...]
+
+
+class ShapeStats:
+    def __init__(self, query: Dict) -> None:
+        self.count = 0
+        # the last filter seen with this shape, run by explain
+        self.sample_query = query
+
+
+def normalize_filter(query: Any) -> Any:
+    """Replace the values of a filter with 1, keeping the field names and operators.
+
+    Two filters that differ only in their values have the same shape.
+    """
+
+    if isinstance(query, dict):
+        return {key: normalize_filter(value) for key, value in query.items()}
+    if isinstance(query, (list, tuple)) and any(isinstance(v, dict) for v in query):
+        # clauses of $and/$or/$nor
+        return [normalize_filter(value) for value in query]
+    return 1
+
+
+def query_shape(
+    collection_name: str, query: Optional[Dict], sort_options: Optional[List]
+) -> QueryShape:
+    filter_shape = json.dumps(normalize_filter(query or {}), sort_keys=True)
+    sort = tuple((key, direction) for key, direction in sort_options or [])
+    return QueryShape(collection_name, filter_shape, sort)
+
+
+class ShapeRecorder:
+    """Counts the query shapes seen, up to max_shapes distinct shapes."""
+
+    def __init__(self, max_shapes: int) -> None:
+        self.max_shapes = max_shapes
+        self.dropped = 0
+        self._shapes: Dict[QueryShape, ShapeStats] = {}
+        self._lock = threading.Lock()
+
+    def record(
+        self, collection_name: str, query: Optional[Dict], sort_options: Optional[List]
+    ) -> None:
+        shape = query_shape(collection_name, query, sort_options)
+        with self._lock:
+            stats = self._shapes.get(shape)
+            if stats is None:
+                if len(self._shapes) >= self.max_shapes:
+                    self.dropped += 1
+                    return
+                stats = self._shapes[shape] = ShapeStats(query or {})
+            stats.count += 1
+            stats.sample_query = query or {}
+
+    def most_frequent(
+        self, collection_name: Optional[str] = None, top: Optional[int] = None
+    ) -> List[Tuple[QueryShape, int, Dict]]:
+        """The recorded shapes with their count and a sample filter, most frequent first."""
+
+        with self._lock:
+            shapes = [
+                (shape, stats.count, stats.sample_query)
+                for shape, stats in self._shapes.items()
+                if collection_name is None or shape.collection_name == collection_name
+            ]
+        shapes.sort(key=lambda item: item[1], reverse=True)
+        return shapes[:top] if top else shapes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._shapes.clear()
+            self.dropped = 0
+
+
+def plan_stages(plan: Any) -> List[str]:
+    """All the stage names of a (possibly nested) explain plan."""
+
+    stages: List[str] = []
+    if isinstance(plan, dict):
+        if isinstance(plan.get("stage"), str):
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+    return stages
+
+
+def winning_plan_stages(explain: Dict) -> List[str]:
+    return plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+
+
+def filter_fields(query: Optional[Dict]) -> Tuple[List[str], List[str]]:
+    """Split the fields of a filter into equality and range fields.
+
+    $or/$nor clauses are left out since they are indexed per clause.
+    """
+
+    equality: List[str] = []
+    ranges: List[str] = []
+    for key, value in (query or {}).items():
+        if key == "$and":
+            for clause in value:
+                clause_equality, clause_ranges = filter_fields(clause)
+                equality.extend(clause_equality)
+                ranges.extend(clause_ranges)
+        elif key.startswith("$"):
+            continue
+        elif isinstance(value, dict) and any(op.startswith("$") for op in value):
+            if all(op in EQUALITY_OPERATORS for op in value):
+                equality.append(key)
+            else:
+                ranges.append(key)
+        else:
+            equality.append(key)
+    return equality, ranges
+
+
+def suggest_index(
+    query: Optional[Dict], sort_options: Optional[List]
+) -> List[Tuple[str, int]]:
+    """Suggest a compound index following the equality, sort, range rule.
+
+    Equality fields go first, then the sort keys in their sort direction, then
+    the fields filtered by range.
+    """
+
+    equality, ranges = filter_fields(query)
+    keys: List[Tuple[str, int]] = []
+    seen = set()
+
+    for key in equality:
+        if key not in seen:
+            keys.append((key, pymongo.ASCENDING))
+            seen.add(key)
+    for key, direction in sort_options or []:
+        if key not in seen:
+            keys.append((key, direction))
+            seen.add(key)
+    for key in ranges:
+        if key not in seen:
+            keys.append((key, pymongo.ASCENDING))
+            seen.add(key)
+    return keys
@@ -0,0 +1,48 @@
+"""ASGI entry point serving the Flask app, eg. with uvicorn:
+
+    uvicorn mangorest.asgi:app
+
+The requests are handled by the Flask views (so the routes, CORS, JWTs and
+errors are the ones of mangorest.views) on a pool of ASGI_THREADS threads per
+process. It defaults to the size of the MongoDB connection pool, so a process
+serves as many requests at a time as its pool allows. Needs the `a2wsgi`
+package, see the asgi extra.
+"""
+
+import io
+from typing import Any, Callable, Dict, Iterable
+
+from a2wsgi import WSGIMiddleware
+
+from mangorest import app as flask_app
+from mangorest import config
+
+
+class BodyReader(io.RawIOBase):
+    """The request body of a2wsgi as a raw stream.
+
+    The readline(limit) of a2wsgi returns whatever it has buffered, even nothing,
+    instead of waiting for a line, so the body is read thru an io.BufferedReader.
+    """
+
+    def __init__(self, body: Any) -> None:
+        self.body = body
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        data = self.body.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+def wsgi_app(environ: Dict[str, Any], start_response: Callable) -> Iterable[bytes]:
+    # the body stream ends with the request body (like gunicorn's), so bodies
+    # sent without a Content-Length, eg. chunked NDJSON uploads, can be read
+    environ["wsgi.input_terminated"] = True
+    environ["wsgi.input"] = io.BufferedReader(BodyReader(environ["wsgi.input"]))
+    return flask_app(environ, start_response)
+
+
+app = WSGIMiddleware(wsgi_app, workers=config.ASGI_THREADS)
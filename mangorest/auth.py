@@ -1,12 +1,11 @@
 from typing import NamedTuple
 
+import bson
 import nacl.exceptions
-import nacl.pwhash
-import pymongo
 from bson.objectid import ObjectId
 from pymongo.collection import Collection
 
-from mangorest import config, mongo
+from mangorest import cache, config, hashing, mongo
 
 
 class MangoUser(NamedTuple):
@@ -14,13 +13,28 @@ class MangoUser(NamedTuple):
     password: bytes
 
 
+def dump_user(user: MangoUser) -> bytes:
+    return bson.encode(user._asdict())
+
+
+def load_user(data: bytes) -> MangoUser:
+    return MangoUser(**bson.decode(data))
+
+
+# users keyed by username (the JWT identity), saves a query on every authenticated request
+user_cache = cache.create_cache(
+    "users", config.USER_CACHE_SIZE, config.USER_CACHE_TTL, dump_user, load_user
+)
+
+
 def create_user(users_collection: Collection, username: str, password: str) -> ObjectId:
     password_byte = password.encode("UTF-8")
-    hashed_password = nacl.pwhash.str(password_byte)
+    hashed_password = hashing.password_hasher.hash(password_byte)
 
     oid = mongo.insert_single_document(
         users_collection, {"username": username, "password": hashed_password}
     )
+    user_cache.invalidate(username)
     return oid
 
 
@@ -36,12 +50,23 @@ def get_user(users_collection: Collection, username: str):
         raise
 
 
+def get_cached_user(users_collection: Collection, username: str):
+    """Same as get_user, but served from user_cache when possible."""
+
+    user = user_cache.get(username)
+    if user is None:
+        user = get_user(users_collection, username)
+        if user:
+            user_cache.set(username, user)
+    return user
+
+
 def check_password(user, entered_password) -> None:
     correct_user_password = user.password
     entered_user_password = entered_password.encode("UTF-8")
 
     try:
-        nacl.pwhash.verify(correct_user_password, entered_user_password)
+        hashing.password_hasher.verify(correct_user_password, entered_user_password)
     except nacl.exceptions.InvalidkeyError:
         raise
 
@@ -49,13 +74,10 @@ def check_password(user, entered_password) -> None:
 def create_user_service(username: str, password: str) -> ObjectId:
     """This will mainly be used by the CLI."""
 
-    client = pymongo.MongoClient(config.MONGODB_URI)
-    database = client[config.DATABASE]
+    database = mongo.get_database()
     users = database[config.MANGO_USER_COLLECTION]
 
     user_oid = create_user(users, username, password)
-
-    client.close()
     return user_oid
 
 
@@ -0,0 +1,415 @@
+"""Caches of the users and of the GET responses.
+
+The memory backend keeps the entries in each worker process. The shared
+backend keeps them in a memory-mapped file (see mangorest.shm) used by all
+the worker processes of a host. Select it with CACHE_BACKEND=shared.
+"""
+
+import abc
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, NamedTuple, Optional, Set, Tuple
+
+from mangorest import config, shm
+
+HEADERS_LENGTH = struct.Struct("<I")
+
+
+class CacheBackend(abc.ABC):
+    """A cache of values by key, expiring after ttl seconds (eg. auth.user_cache)."""
+
+    @abc.abstractmethod
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        ...
+
+    @abc.abstractmethod
+    def set(self, key: Hashable, value: Any) -> None:
+        ...
+
+    @abc.abstractmethod
+    def invalidate(self, key: Hashable) -> None:
+        ...
+
+    @abc.abstractmethod
+    def clear(self) -> None:
+        ...
+
+    @abc.abstractmethod
+    def stats(self) -> Dict[str, Any]:
+        ...
+
+
+class TTLCache(CacheBackend):
+    """A bounded LRU cache whose entries also expire after ttl seconds.
+
+    Safe to share between the threads of a worker. A maxsize of 0 disables caching.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        timer: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > self.timer():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (self.timer() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": "memory",
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+            }
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    headers: List[Tuple[str, str]]
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(
+            len(name) + len(value) for name, value in self.headers
+        )
+
+    def to_bytes(self) -> bytes:
+        headers = json.dumps(self.headers).encode("UTF-8")
+        return HEADERS_LENGTH.pack(len(headers)) + headers + self.body
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "CachedResponse":
+        header_start = HEADERS_LENGTH.size
+        (headers_length,) = HEADERS_LENGTH.unpack_from(data)
+        body_start = header_start + headers_length
+        headers = json.loads(data[header_start:body_start])
+        return cls(data[body_start:], [(name, value) for name, value in headers])
+
+
+class ResponseCacheBackend(abc.ABC):
+    """A cache of serialized responses grouped by namespace (eg. services.response_cache).
+
+    invalidate(namespace) drops the entries of a namespace and bumps its
+    generation: set only stores a response if the generation read before
+    computing it is still current, so that data read before a write is not
+    stored after it. A max_bytes of 0 disables caching.
+    """
+
+    max_bytes: int
+
+    @abc.abstractmethod
+    def get(self, key: Hashable) -> Optional[CachedResponse]:
+        ...
+
+    @abc.abstractmethod
+    def generation(self, namespace: Hashable) -> int:
+        ...
+
+    @abc.abstractmethod
+    def set(
+        self,
+        namespace: Hashable,
+        key: Hashable,
+        value: CachedResponse,
+        generation: int,
+        ttl: Optional[float] = None,
+    ) -> bool:
+        """Store a response computed at generation. Returns whether it was stored."""
+
+    @abc.abstractmethod
+    def invalidate(self, namespace: Hashable) -> None:
+        ...
+
+    @abc.abstractmethod
+    def clear(self) -> None:
+        ...
+
+    @abc.abstractmethod
+    def stats(self) -> Dict[str, Any]:
+        ...
+
+
+class ResponseCache(ResponseCacheBackend):
+    """A LRU cache of serialized responses, bounded by their total size in bytes.
+
+    Responses over a quarter of max_bytes are not stored.
+    """
+
+    def __init__(self, max_bytes: int, timer: Callable[[], float] = time.monotonic):
+        self.max_bytes = max_bytes
+        self.timer = timer
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[Hashable, Tuple[Hashable, Optional[float], CachedResponse]]" = (
+            OrderedDict()
+        )
+        self._namespaces: Dict[Hashable, Set[Hashable]] = {}
+        self._generations: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                _, expires_at, value = entry
+                if expires_at is None or expires_at > self.timer():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def generation(self, namespace: Hashable) -> int:
+        with self._lock:
+            return self._generations.get(namespace, 0)
+
+    def set(
+        self,
+        namespace: Hashable,
+        key: Hashable,
+        value: CachedResponse,
+        generation: int,
+        ttl: Optional[float] = None,
+    ) -> bool:
+        """Store a response computed at generation. Returns whether it was stored."""
+
+        size = value.size
+        if size > self.max_bytes // 4:
+            return False
+
+        with self._lock:
+            if self._generations.get(namespace, 0) != generation:
+                return False
+            if key in self._entries:
+                self._remove(key)
+            expires_at = self.timer() + ttl if ttl else None
+            self._entries[key] = (namespace, expires_at, value)
+            self._namespaces.setdefault(namespace, set()).add(key)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            return True
+
+    def invalidate(self, namespace: Hashable) -> None:
+        with self._lock:
+            self._generations[namespace] = self._generations.get(namespace, 0) + 1
+            for key in self._namespaces.pop(namespace, ()):
+                self.size -= self._entries.pop(key)[2].size
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            for namespace in self._namespaces:
+                self._generations[namespace] = self._generations.get(namespace, 0) + 1
+            self._entries.clear()
+            self._namespaces.clear()
+            self.size = 0
+
+    def _remove(self, key: Hashable) -> None:
+        namespace, _, value = self._entries.pop(key)
+        keys = self._namespaces[namespace]
+        keys.discard(key)
+        if not keys:
+            del self._namespaces[namespace]
+        self.size -= value.size
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": "memory",
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "size_bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+# ===============================================
+# shared backend
+# ===============================================
+
+
+class SharedTTLCache(CacheBackend):
+    """Same as TTLCache, in a segment shared by the worker processes of a host.
+
+    Values are stored as the bytes returned by dumps.
+    """
+
+    def __init__(
+        self,
+        segment: shm.Segment,
+        ttl: float,
+        dumps: Callable[[Any], bytes],
+        loads: Callable[[bytes], Any],
+    ) -> None:
+        self.segment = segment
+        self.ttl = ttl
+        self.dumps = dumps
+        self.loads = loads
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        data = self.segment.get(shm.digest(key))
+        return default if data is None else self.loads(data)
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self.segment.set(shm.digest(key), self.dumps(value), self.ttl)
+
+    def invalidate(self, key: Hashable) -> None:
+        self.segment.delete(shm.digest(key))
+
+    def clear(self) -> None:
+        self.segment.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "shared", **self.segment.stats(), "ttl": self.ttl}
+
+
+class SharedResponseCache(ResponseCacheBackend):
+    """Same as ResponseCache, in a segment shared by the worker processes of a host.
+
+    Invalidating a namespace (eg. after a write) is seen by all the workers.
+    """
+
+    def __init__(self, segment: shm.Segment) -> None:
+        self.segment = segment
+        self.max_bytes = segment.data_size
+
+    def get(self, key: Hashable) -> Optional[CachedResponse]:
+        data = self.segment.get(shm.digest(key))
+        return None if data is None else CachedResponse.from_bytes(data)
+
+    def generation(self, namespace: Hashable) -> int:
+        return self.segment.generation(shm.digest(namespace))
+
+    def set(
+        self,
+        namespace: Hashable,
+        key: Hashable,
+        value: CachedResponse,
+        generation: int,
+        ttl: Optional[float] = None,
+    ) -> bool:
+        return self.segment.set(
+            shm.digest(key),
+            value.to_bytes(),
+            ttl,
+            shm.digest(namespace),
+            generation,
+        )
+
+    def invalidate(self, namespace: Hashable) -> None:
+        self.segment.invalidate(shm.digest(namespace))
+
+    def clear(self) -> None:
+        self.segment.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "shared", **self.segment.stats()}
+
+
+# bytes of data region per entry of a shared user cache
+SHARED_USER_ENTRY_SIZE = 512
+
+
+def shared_segment_path(name: str) -> str:
+    """Path of a shared segment, distinct for each database served on the host."""
+
+    deployment = hashlib.blake2b(
+        f"{config.MONGODB_URI} {config.DATABASE}".encode("UTF-8"), digest_size=4
+    ).hexdigest()
+    return os.path.join(config.SHARED_CACHE_DIR, f"mangorest-{deployment}-{name}")
+
+
+def check_backend() -> bool:
+    """Whether the shared backend is configured."""
+
+    if config.CACHE_BACKEND not in ("memory", "shared"):
+        raise ValueError(
+            f"Unknown CACHE_BACKEND {config.CACHE_BACKEND}. "
+            "Must be one of ['memory', 'shared']."
+        )
+    return config.CACHE_BACKEND == "shared"
+
+
+def create_cache(
+    name: str,
+    maxsize: int,
+    ttl: float,
+    dumps: Callable[[Any], bytes],
+    loads: Callable[[bytes], Any],
+) -> CacheBackend:
+    """A cache of the configured backend. dumps and loads serialize the shared values."""
+
+    if check_backend() and maxsize > 0:
+        segment = shm.Segment(
+            shared_segment_path(name), maxsize, maxsize * SHARED_USER_ENTRY_SIZE
+        )
+        return SharedTTLCache(segment, ttl, dumps, loads)
+    return TTLCache(maxsize, ttl)
+
+
+def create_response_cache(
+    name: str, max_bytes: int, max_entries: int
+) -> ResponseCacheBackend:
+    """A response cache of the configured backend. max_entries only bounds the shared one."""
+
+    if check_backend() and max_bytes > 0:
+        segment = shm.Segment(shared_segment_path(name), max_entries, max_bytes)
+        return SharedResponseCache(segment)
+    return ResponseCache(max_bytes)
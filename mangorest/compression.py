@@ -0,0 +1,140 @@
+"""Response compression (Content-Encoding negotiation) for the /api endpoints.
+
+gzip is always available. brotli (br) and zstd are used when the `brotli` and
+`zstandard` packages are installed.
+"""
+
+import zlib
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from flask import Flask, request
+from flask.wrappers import Response
+
+from mangorest import config
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+class GzipCompressor:
+    def __init__(self, level: int) -> None:
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        # sync flush so each streamed chunk reaches the client right away
+        return self._compressor.compress(data) + self._compressor.flush(
+            zlib.Z_SYNC_FLUSH
+        )
+
+    def finish(self) -> bytes:
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor:
+    def __init__(self, level: int) -> None:
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class ZstdCompressor:
+    def __init__(self, level: int) -> None:
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        )
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+def available_compressors() -> Dict[str, Callable[[], object]]:
+    """Content codings the server can produce, in order of preference."""
+
+    compressors: Dict[str, Callable[[], object]] = {}
+    for encoding in config.COMPRESSION_ALGORITHMS.split(","):
+        if encoding == "br" and brotli is not None:
+            compressors["br"] = lambda: BrotliCompressor(
+                config.COMPRESSION_BROTLI_LEVEL
+            )
+        elif encoding == "zstd" and zstandard is not None:
+            compressors["zstd"] = lambda: ZstdCompressor(config.COMPRESSION_ZSTD_LEVEL)
+        elif encoding == "gzip":
+            compressors["gzip"] = lambda: GzipCompressor(config.COMPRESSION_GZIP_LEVEL)
+    return compressors
+
+
+def negotiate_encoding(encodings: List[str]) -> Optional[str]:
+    """Pick the content coding the client prefers, ties broken by server preference."""
+
+    encoding = request.accept_encodings.best_match(encodings)
+    if encoding and request.accept_encodings[encoding]:
+        return encoding
+    return None
+
+
+def compress_stream(
+    chunks: Iterable, compressor, charset: str = "utf-8"
+) -> Iterator[bytes]:
+    """Compress a streamed response body chunk by chunk."""
+
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode(charset)
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.finish()
+
+
+def compress_response(response: Response) -> Response:
+    if not request.path.startswith("/api/"):
+        return response
+    if (
+        response.status_code < 200
+        or response.status_code in (204, 206, 304)
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+
+    response.vary.add("Accept-Encoding")
+
+    compressors = available_compressors()
+    encoding = negotiate_encoding(list(compressors))
+    if encoding is None:
+        return response
+
+    compressor = compressors[encoding]()
+
+    if response.is_streamed:
+        response.response = compress_stream(
+            response.response, compressor, response.charset
+        )
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < config.COMPRESSION_MIN_SIZE:
+            return response
+        response.set_data(compressor.compress(data) + compressor.finish())
+
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_app(app: Flask) -> None:
+    if config.COMPRESSION_ENABLED:
+        app.after_request(compress_response)
@@ -1,8 +1,13 @@
+import json
 import os
-from typing import Dict, List
+import tempfile
+from typing import Any, Dict, List, NamedTuple, Optional
 
-import pymongo
 from dotenv import load_dotenv
+from pymongo.database import Database
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import ReadPreference
+from pymongo.write_concern import WriteConcern
 
 load_dotenv()
 
@@ -13,11 +18,215 @@ COLLECTION = os.environ["COLLECTIONS"]
 JWT_SECRET_KEY = os.environ["JWT_SECRET_KEY"]
 MANGO_USER_COLLECTION = os.environ.get("MANGO_USER_COLLECTION", "mangorest_users")
 
+# connection pool settings, only passed to MongoClient when set so that
+# options given in MONGODB_URI are not overridden
+MONGODB_MAX_POOL_SIZE = os.environ.get("MONGODB_MAX_POOL_SIZE")
+MONGODB_MIN_POOL_SIZE = os.environ.get("MONGODB_MIN_POOL_SIZE")
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = os.environ.get("MONGODB_WAIT_QUEUE_TIMEOUT_MS")
+MONGODB_READ_PREFERENCE = os.environ.get("MONGODB_READ_PREFERENCE")
+MONGODB_COMPRESSORS = os.environ.get("MONGODB_COMPRESSORS")
+
+# threads per process of the ASGI app (see mangorest.asgi), by default one per
+# connection of the pool (100 unless set, like the driver)
+ASGI_THREADS = int(os.environ.get("ASGI_THREADS", MONGODB_MAX_POOL_SIZE or 100))
+
+# cache of MangoREST users looked up for JWT protected requests
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 1024))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 60))
+
+# password hashing pool, see mangorest.hashing
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+PASSWORD_HASH_QUEUE_DEPTH = int(os.environ.get("PASSWORD_HASH_QUEUE_DEPTH", 4))
+PASSWORD_HASH_TIMEOUT = float(os.environ.get("PASSWORD_HASH_TIMEOUT", 10))
+PASSWORD_HASH_OPSLIMIT = int(os.environ.get("PASSWORD_HASH_OPSLIMIT", 0)) or None
+PASSWORD_HASH_MEMLIMIT = int(os.environ.get("PASSWORD_HASH_MEMLIMIT", 0)) or None
+
+# number of compiled query string filters and sorts cached per worker process
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", 1024))
+
+# field that changes whenever a document changes (eg. a version number or an
+# updated_at timestamp), used as the document's ETag instead of hashing its content
+ETAG_VERSION_FIELD = os.environ.get("ETAG_VERSION_FIELD")
+
+# response compression of the /api endpoints, see mangorest.compression
+COMPRESSION_ENABLED = os.environ.get("COMPRESSION_ENABLED", "true").lower() == "true"
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+COMPRESSION_ALGORITHMS = os.environ.get("COMPRESSION_ALGORITHMS", "br,zstd,gzip")
+COMPRESSION_GZIP_LEVEL = int(os.environ.get("COMPRESSION_GZIP_LEVEL", 6))
+COMPRESSION_BROTLI_LEVEL = int(os.environ.get("COMPRESSION_BROTLI_LEVEL", 4))
+COMPRESSION_ZSTD_LEVEL = int(os.environ.get("COMPRESSION_ZSTD_LEVEL", 3))
+
+# aggregation pipelines sent to POST /api/<resource>/_aggregate
+AGGREGATE_ALLOWED_STAGES = os.environ.get(
+    "AGGREGATE_ALLOWED_STAGES",
+    "$match,$project,$addFields,$set,$unset,$group,$sort,$limit,$skip,$count,"
+    "$unwind,$lookup,$graphLookup,$unionWith,$facet,$bucket,$bucketAuto,"
+    "$sortByCount,$replaceRoot,$replaceWith,$sample",
+).split(",")
+AGGREGATE_FORBIDDEN_OPERATORS = ["$where", "$function", "$accumulator"]
+AGGREGATE_ALLOW_DISK_USE = (
+    os.environ.get("AGGREGATE_ALLOW_DISK_USE", "false").lower() == "true"
+)
+AGGREGATE_MAX_TIME_MS = int(os.environ.get("AGGREGATE_MAX_TIME_MS", 30000))
+
+# number of operations sent per bulk_write call by POST /api/<resource>/_bulk
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", 1000))
+
+# number of documents inserted at a time by NDJSON POST /api/<resource>
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 1000))
+
+# longest line of the NDJSON bodies, the lines being read are held in memory
+NDJSON_MAX_LINE_BYTES = int(os.environ.get("NDJSON_MAX_LINE_BYTES", 16 * 1024 * 1024))
+
+# guardrails of GET /api/<resource>, overridable per resource in RESOURCE_OPTIONS_FILE
+QUERY_DEFAULT_LIMIT = int(os.environ.get("QUERY_DEFAULT_LIMIT", 0))
+QUERY_MAX_LIMIT = int(os.environ.get("QUERY_MAX_LIMIT", 0))
+QUERY_MAX_TIME_MS = int(os.environ.get("QUERY_MAX_TIME_MS", 30000))
+RESPONSE_MAX_BYTES = int(os.environ.get("RESPONSE_MAX_BYTES", 64 * 1024 * 1024))
+
+# Prometheus metrics at /metrics, see mangorest.metrics
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+
+# slow query log, see mangorest.slowlog
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get("SLOW_QUERY_THRESHOLD_MS", 100))
+SLOW_QUERY_EXPLAIN_SAMPLE_RATE = float(
+    os.environ.get("SLOW_QUERY_EXPLAIN_SAMPLE_RATE", 0.1)
+)
+SLOW_QUERY_EXPLAIN_QUEUE_DEPTH = int(
+    os.environ.get("SLOW_QUERY_EXPLAIN_QUEUE_DEPTH", 10)
+)
+
+# index advisor, see mangorest.advisor
+INDEX_ADVISOR_ENABLED = (
+    os.environ.get("INDEX_ADVISOR_ENABLED", "false").lower() == "true"
+)
+INDEX_ADVISOR_MAX_SHAPES = int(os.environ.get("INDEX_ADVISOR_MAX_SHAPES", 1000))
+INDEX_ADVISOR_EXPLAIN_TOP = int(os.environ.get("INDEX_ADVISOR_EXPLAIN_TOP", 10))
+
+# change streams served as Server-Sent Events at /_watch, see mangorest.watch
+WATCH_KEEPALIVE_SECONDS = float(os.environ.get("WATCH_KEEPALIVE_SECONDS", 15))
+WATCH_MAX_PENDING_EVENTS = int(os.environ.get("WATCH_MAX_PENDING_EVENTS", 1000))
+
+# memory budget of the cached GET /api/<resource> responses, see RESOURCE_OPTIONS_FILE
+RESPONSE_CACHE_MAX_BYTES = int(
+    os.environ.get("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+)
+# number of responses the shared backend can index
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 16384))
+
+# backend of the user and response caches: "memory" (each worker process) or
+# "shared" (a memory-mapped file in SHARED_CACHE_DIR), see mangorest.cache
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "memory").lower()
+SHARED_CACHE_DIR = os.environ.get(
+    "SHARED_CACHE_DIR",
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+)
+
+# JSON file of per-resource read preference, read/write concern, maxTimeMS, limits and caching
+RESOURCE_OPTIONS_FILE = os.environ.get("RESOURCE_OPTIONS_FILE")
+
+
+def mongo_client_options() -> Dict[str, Any]:
+    """Keyword arguments for MongoClient built from the pool settings."""
+
+    options: Dict[str, Any] = {}
+    if MONGODB_MAX_POOL_SIZE:
+        options["maxPoolSize"] = int(MONGODB_MAX_POOL_SIZE)
+    if MONGODB_MIN_POOL_SIZE:
+        options["minPoolSize"] = int(MONGODB_MIN_POOL_SIZE)
+    if MONGODB_WAIT_QUEUE_TIMEOUT_MS:
+        options["waitQueueTimeoutMS"] = int(MONGODB_WAIT_QUEUE_TIMEOUT_MS)
+    if MONGODB_READ_PREFERENCE:
+        options["readPreference"] = MONGODB_READ_PREFERENCE
+    if MONGODB_COMPRESSORS:
+        options["compressors"] = MONGODB_COMPRESSORS
+    return options
+
+
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+
+class CollectionOptions(NamedTuple):
+    """Options applied to every operation on a collection. None means the driver default."""
+
+    read_preference: Optional[Any] = None
+    read_concern: Optional[ReadConcern] = None
+    write_concern: Optional[WriteConcern] = None
+    max_time_ms: Optional[int] = None
+    default_limit: Optional[int] = None
+    max_limit: Optional[int] = None
+    max_response_bytes: Optional[int] = None
+    cache_ttl: Optional[float] = None
+    cache_watch: bool = False
+
+    @property
+    def cached(self) -> bool:
+        """Whether GET responses are cached, until they expire or the collection changes."""
+
+        return bool(self.cache_ttl or self.cache_watch)
+
+    @classmethod
+    def from_dict(cls, options: Dict[str, Any]) -> "CollectionOptions":
+        """Build from a dict in the form of
+        {
+            "read_preference": "secondaryPreferred",
+            "read_concern": "majority",
+            "write_concern": {"w": 1, "j": false, "wtimeout": 1000},
+            "max_time_ms": 2000,
+            "default_limit": 100,
+            "max_limit": 1000,
+            "max_response_bytes": 16777216,
+            "cache_ttl": 60,
+            "cache_watch": true
+        }
+        """
+
+        unknown_options = set(options) - set(cls._fields)
+        if unknown_options:
+            raise ValueError(f"Unknown resource options: {sorted(unknown_options)}")
+
+        read_preference = options.get("read_preference")
+        read_concern = options.get("read_concern")
+        write_concern = options.get("write_concern")
+        max_time_ms = options.get("max_time_ms")
+        default_limit = options.get("default_limit")
+        max_limit = options.get("max_limit")
+        max_response_bytes = options.get("max_response_bytes")
+        cache_ttl = options.get("cache_ttl")
+        cache_watch = options.get("cache_watch", False)
+
+        if read_preference is not None and read_preference not in READ_PREFERENCES:
+            raise ValueError(
+                f"Unknown read_preference {read_preference}. "
+                f"Must be one of {list(READ_PREFERENCES)}."
+            )
+
+        return cls(
+            read_preference=READ_PREFERENCES[read_preference]
+            if read_preference
+            else None,
+            read_concern=ReadConcern(read_concern) if read_concern else None,
+            write_concern=WriteConcern(**write_concern) if write_concern else None,
+            max_time_ms=int(max_time_ms) if max_time_ms else None,
+            default_limit=int(default_limit) if default_limit else None,
+            max_limit=int(max_limit) if max_limit else None,
+            max_response_bytes=int(max_response_bytes) if max_response_bytes else None,
+            cache_ttl=float(cache_ttl) if cache_ttl else None,
+            cache_watch=bool(cache_watch),
+        )
+
 
 class MangoConfigurator:
     def __init__(self, resource_collection_map_list: List[str]) -> None:
         self.resource_collection_map_list = resource_collection_map_list
         self.resource_name_map: Dict[str, str] = {}
+        self.collection_options: Dict[str, CollectionOptions] = {}
 
     def resource_collection_map_parser(self) -> None:
         """Build the resource name to collection dict.
@@ -35,11 +244,38 @@ class MangoConfigurator:
             resource_name, collection_name = item.split(":")
             self.resource_name_map[resource_name] = collection_name
 
-    def verify_collection_exists(self) -> None:
-        client = pymongo.MongoClient(MONGODB_URI)
-        database = client[DATABASE]
+    def resource_options_parser(self, resource_options: Dict[str, Dict]) -> None:
+        """Build the collection name to CollectionOptions dict.
+
+        resource_options is keyed by resource name, in the form of
+        {
+            "resource_name_1": {"read_preference": "secondaryPreferred", "max_time_ms": 2000},
+            "resource_name_2": {"write_concern": {"w": "majority"}},
+            ...
+        }
+        """
+
+        unknown_resources = set(resource_options) - set(self.resource_name_map)
+        if unknown_resources:
+            raise ValueError(
+                "The following resources in RESOURCE_OPTIONS_FILE are not in "
+                f"the COLLECTIONS config parameter: {sorted(unknown_resources)}"
+            )
+
+        for resource_name, options in resource_options.items():
+            collection_name = self.resource_name_map[resource_name]
+            self.collection_options[collection_name] = CollectionOptions.from_dict(
+                options
+            )
+
+    def load_resource_options(self, path: Optional[str]) -> None:
+        if not path:
+            return
+        with open(path) as options_file:
+            self.resource_options_parser(json.load(options_file))
+
+    def verify_collection_exists(self, database: Database) -> None:
         collections_list = database.list_collection_names()
-        client.close()
 
         nonexistent_collections: List = []
 
@@ -59,10 +295,7 @@ class MangoConfigurator:
         return set(self.resource_name_map.values())
 
     @classmethod
-    def from_unmapped_all_collections(cls):
-        client = pymongo.MongoClient(MONGODB_URI)
-        database = client[DATABASE]
+    def from_unmapped_all_collections(cls, database: Database):
         collections_list = database.list_collection_names()
-        client.close()
         resource_collection_list = [f"{item}:{item}" for item in collections_list]
         return cls(resource_collection_list)
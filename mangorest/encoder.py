@@ -0,0 +1,130 @@
+"""JSON encoding of raw pymongo documents."""
+
+import json
+import logging
+from typing import Any, Iterable, Iterator, List
+
+from bson import json_util
+from flask.json import JSONEncoder
+
+from mangorest import metrics
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 16 * 1024  # characters buffered before a streamed chunk is yielded
+
+
+class MangoJSONEncoder(JSONEncoder):
+    """Encodes BSON types (ObjectId, datetime, Decimal128, Binary, etc.) in a single pass.
+
+    The standard library encoder walks dicts and lists natively and only calls
+    `default` for the values it cannot handle, which are then converted to their
+    MongoDB Extended JSON form by `bson.json_util.default`. The output is the
+    same as `json_util.dumps`, without building and re-parsing an intermediate string.
+    """
+
+    def encode(self, o: Any) -> str:
+        with metrics.phase_timer("serialize"):
+            return super().encode(o)
+
+    def default(self, o: Any) -> Any:
+        try:
+            return json_util.default(o)
+        except TypeError:
+            pass
+
+        # Mapping types that are not dict subclasses, eg. RawBSONDocument
+        if hasattr(o, "items"):
+            return dict(o.items())
+        if hasattr(o, "__iter__") and not isinstance(o, (str, bytes)):
+            return list(o)
+        return super().default(o)
+
+
+def dumps(obj: Any, **kwargs: Any) -> str:
+    """Serialize obj to a JSON string using MangoJSONEncoder."""
+
+    kwargs.setdefault("cls", MangoJSONEncoder)
+    return json.dumps(obj, **kwargs)
+
+
+def cut_off(documents: Any, max_bytes: int) -> None:
+    """Stop pulling documents once max_bytes of them are encoded."""
+
+    logger.warning("Response cut off at %s bytes.", max_bytes)
+    close = getattr(documents, "close", None)
+    if close is not None:
+        close()
+
+
+def iter_json_array(
+    documents: Iterable[Any],
+    sort_keys: bool = True,
+    chunk_size: int = CHUNK_SIZE,
+    max_bytes: int = 0,
+) -> Iterator[str]:
+    """Encode documents as one JSON array, yielded in chunks of about chunk_size characters.
+
+    Only the current chunk is held in memory, so documents can be pulled lazily
+    from a pymongo Cursor. The array ends cleanly after the last document that
+    fits in max_bytes (0 means no cap).
+    """
+
+    json_encoder = MangoJSONEncoder(separators=(",", ":"), sort_keys=sort_keys)
+    buffer = ["["]
+    buffered = 1
+    total = 1
+
+    for index, document in enumerate(documents):
+        encoded = json_encoder.encode(document)
+        total += len(encoded) + 1
+        if max_bytes and total > max_bytes:
+            cut_off(documents, max_bytes)
+            break
+        if index:
+            buffer.append(",")
+        buffer.append(encoded)
+        buffered += len(encoded) + 1
+
+        if buffered >= chunk_size:
+            yield "".join(buffer)
+            buffer = []
+            buffered = 0
+
+    buffer.append("]\n")
+    yield "".join(buffer)
+
+
+def iter_ndjson(
+    documents: Iterable[Any],
+    sort_keys: bool = True,
+    chunk_size: int = CHUNK_SIZE,
+    max_bytes: int = 0,
+) -> Iterator[str]:
+    """Encode documents as newline-delimited JSON, yielded in chunks of about chunk_size characters.
+
+    Ends after the last document that fits in max_bytes (0 means no cap).
+    """
+
+    json_encoder = MangoJSONEncoder(separators=(",", ":"), sort_keys=sort_keys)
+    buffer: List[str] = []
+    buffered = 0
+    total = 0
+
+    for document in documents:
+        encoded = json_encoder.encode(document)
+        total += len(encoded) + 1
+        if max_bytes and total > max_bytes:
+            cut_off(documents, max_bytes)
+            break
+        buffer.append(encoded)
+        buffer.append("\n")
+        buffered += len(encoded) + 1
+
+        if buffered >= chunk_size:
+            yield "".join(buffer)
+            buffer = []
+            buffered = 0
+
+    if buffer:
+        yield "".join(buffer)
@@ -23,3 +23,73 @@ class ResourceNameNotFoundError(MangoRestException):
 class EmptyQueryFatalActionError(MangoRestException):
     def __init__(self, *args: object) -> None:
         super().__init__(*args)
+
+
+class InvalidPageTokenError(MangoRestException):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class PasswordHasherBusyError(MangoRestException):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class InvalidPipelineError(MangoRestException):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class ForbiddenPipelineStageError(MangoRestException):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class InvalidBulkOperationError(MangoRestException):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class InvalidReturnOptionError(MangoRestException):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class InvalidIndexSpecError(MangoRestException):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class ProtectedIndexError(MangoRestException):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class IndexNotFoundError(MangoRestException):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class QueryLimitError(MangoRestException):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class ResponseTooLargeError(MangoRestException):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class UnsupportedWatchFilterError(MangoRestException):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class InvalidResumeTokenError(MangoRestException):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class InvalidProjectionError(MangoRestException):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
@@ -0,0 +1,101 @@
+"""Password hashing and verification on a bounded worker pool."""
+
+import concurrent.futures
+import os
+import threading
+from typing import Any, Callable, Dict, Optional
+
+import nacl.pwhash
+
+from mangorest import config, exceptions
+
+
+class PasswordHasher:
+    """Runs Argon2 hashing and verification on a small, size-limited thread pool.
+
+    Hashing deliberately burns CPU and memory, so at most max_workers hashes run
+    at the same time in a worker process and at most max_pending more may wait
+    for a thread. Requests beyond that are rejected right away with
+    PasswordHasherBusyError instead of queueing behind the ones in progress.
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        max_pending: int,
+        timeout: Optional[float] = None,
+        opslimit: Optional[int] = None,
+        memlimit: Optional[int] = None,
+    ) -> None:
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.hash_params: Dict[str, int] = {}
+        if opslimit:
+            self.hash_params["opslimit"] = opslimit
+        if memlimit:
+            self.hash_params["memlimit"] = memlimit
+
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._executor_pid: Optional[int] = None
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        # threads do not survive a fork, so each process starts its own pool
+        pid = os.getpid()
+        if self._executor is None or self._executor_pid != pid:
+            with self._lock:
+                if self._executor is None or self._executor_pid != pid:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self.max_workers,
+                        thread_name_prefix="mangorest-pwhash",
+                    )
+                    self._slots = threading.BoundedSemaphore(
+                        self.max_workers + self.max_pending
+                    )
+                    self._executor_pid = pid
+        return self._executor
+
+    def _run(self, function: Callable, *args: Any) -> Any:
+        executor = self._get_executor()
+        slots = self._slots
+
+        if not slots.acquire(blocking=False):
+            raise exceptions.PasswordHasherBusyError(
+                "Too many password hashing requests in progress. Try again later."
+            )
+
+        try:
+            future = executor.submit(function, *args)
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            raise exceptions.PasswordHasherBusyError(
+                "Password hashing timed out. Try again later."
+            )
+
+    def hash(self, password: bytes) -> bytes:
+        return self._run(self._hash, password)
+
+    def verify(self, hashed_password: bytes, password: bytes) -> bool:
+        """Raises nacl.exceptions.InvalidkeyError if the password does not match."""
+
+        return self._run(nacl.pwhash.verify, hashed_password, password)
+
+    def _hash(self, password: bytes) -> bytes:
+        return nacl.pwhash.str(password, **self.hash_params)
+
+
+password_hasher = PasswordHasher(
+    max_workers=config.PASSWORD_HASH_WORKERS,
+    max_pending=config.PASSWORD_HASH_QUEUE_DEPTH,
+    timeout=config.PASSWORD_HASH_TIMEOUT,
+    opslimit=config.PASSWORD_HASH_OPSLIMIT,
+    memlimit=config.PASSWORD_HASH_MEMLIMIT,
+)
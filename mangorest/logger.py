@@ -8,6 +8,10 @@ LOGGING_CONFIG = {
             "format": "{levelname} | {module} | {message}",
             "style": "{",
         },
+        "message": {
+            "format": "{message}",
+            "style": "{",
+        },
     },
     "handlers": {
         "console": {
@@ -15,7 +19,19 @@ LOGGING_CONFIG = {
             "formatter": "simple",
             "level": "DEBUG",
         },
+        "slow_query": {
+            "class": "logging.StreamHandler",
+            "formatter": "message",
+            "level": "DEBUG",
+        },
+    },
+    "loggers": {
+        # one JSON object per line, see mangorest.slowlog
+        "mangorest.slowlog": {
+            "level": "INFO",
+            "handlers": ["slow_query"],
+            "propagate": False,
+        },
     },
-    "loggers": {},
     "root": {"level": "INFO", "handlers": LOG_HANDLERS},
 }
@@ -0,0 +1,330 @@
+"""Prometheus metrics of the HTTP requests and the MongoDB client, exposed at /metrics.
+
+Needs the `prometheus_client` package. Under gunicorn, set PROMETHEUS_MULTIPROC_DIR
+to an empty directory shared by the workers so that /metrics adds up the metrics
+of all of them instead of only the worker answering the scrape (see gunicorn.conf.py).
+"""
+
+import functools
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from flask import Flask, g, has_request_context, request
+from flask.wrappers import Response
+from pymongo import monitoring
+
+from mangorest import config
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:  # pragma: no cover
+    prometheus_client = None
+
+# how the time of a request is split up, "other" being routing, auth, response writing, etc.
+PHASES = ["parse", "database", "serialize", "other"]
+
+RESPONSE_BYTES_BUCKETS = [2**exponent for exponent in range(8, 28, 2)]
+
+
+def enabled() -> bool:
+    return config.METRICS_ENABLED and prometheus_client is not None
+
+
+if prometheus_client is not None:
+    REQUESTS = prometheus_client.Counter(
+        "mangorest_http_requests_total",
+        "HTTP requests handled.",
+        ["method", "route", "resource", "status"],
+    )
+    REQUEST_DURATION = prometheus_client.Histogram(
+        "mangorest_http_request_duration_seconds",
+        "Time from receiving a request until its response is fully sent.",
+        ["method", "route", "resource"],
+    )
+    REQUEST_PHASE_DURATION = prometheus_client.Histogram(
+        "mangorest_http_request_phase_seconds",
+        "Time of a request spent parsing the query string, waiting on MongoDB, "
+        "serializing JSON and everything else.",
+        ["route", "phase"],
+    )
+    RESPONSE_BYTES = prometheus_client.Histogram(
+        "mangorest_http_response_bytes",
+        "Size of the response bodies as sent, after compression.",
+        ["route", "resource"],
+        buckets=RESPONSE_BYTES_BUCKETS,
+    )
+    MONGODB_COMMAND_DURATION = prometheus_client.Histogram(
+        "mangorest_mongodb_command_duration_seconds",
+        "Duration of the MongoDB commands, as measured by the driver.",
+        ["command", "collection", "status"],
+    )
+    MONGODB_DOCUMENTS_RETURNED = prometheus_client.Counter(
+        "mangorest_mongodb_documents_returned_total",
+        "Documents returned by find, getMore and aggregate commands.",
+        ["collection"],
+    )
+    MONGODB_POOL_CONNECTIONS = prometheus_client.Gauge(
+        "mangorest_mongodb_pool_connections",
+        "Open connections in the MongoDB connection pools.",
+        ["address"],
+        multiprocess_mode="livesum",
+    )
+    MONGODB_POOL_CONNECTIONS_IN_USE = prometheus_client.Gauge(
+        "mangorest_mongodb_pool_connections_in_use",
+        "Connections checked out of the MongoDB connection pools.",
+        ["address"],
+        multiprocess_mode="livesum",
+    )
+    MONGODB_POOL_CHECKOUT_FAILURES = prometheus_client.Counter(
+        "mangorest_mongodb_pool_checkout_failures_total",
+        "Failed connection checkouts, eg. because of a full pool (timeout).",
+        ["address", "reason"],
+    )
+    SLOW_QUERY_EXPLAINS_DROPPED = prometheus_client.Counter(
+        "mangorest_slow_query_explains_dropped_total",
+        "Sampled slow queries logged without an explain, because the explain queue was full.",
+    )
+
+
+# ===============================================
+# request phases
+# ===============================================
+
+
+def add_phase_time(phase: str, seconds: float) -> None:
+    if has_request_context() and "metrics_timings" in g:
+        g.metrics_timings[phase] += seconds
+
+
+@contextmanager
+def phase_timer(phase: str) -> Iterator[None]:
+    """Count the time spent in the block towards a phase of the current request."""
+
+    if not enabled():
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase_time(phase, time.perf_counter() - start)
+
+
+def timed(phase: str) -> Callable:
+    """Decorator counting the time spent in a function towards a request phase."""
+
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with phase_timer(phase):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# ===============================================
+# pymongo listeners
+# ===============================================
+
+
+def count_dropped_explain() -> None:
+    if enabled():
+        SLOW_QUERY_EXPLAINS_DROPPED.inc()
+
+
+def command_collection(command_name: str, command: Dict) -> str:
+    if command_name == "getMore":
+        return str(command.get("collection", ""))
+    target = command.get(command_name)
+    return target if isinstance(target, str) else ""
+
+
+def returned_documents(reply: Dict) -> int:
+    cursor = reply.get("cursor")
+    if not isinstance(cursor, dict):
+        return 0
+    return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Times every MongoDB command and counts the documents the reads return."""
+
+    def __init__(self) -> None:
+        self._started: Dict[Tuple[Any, int], str] = {}
+        self._lock = threading.Lock()
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        collection = command_collection(event.command_name, event.command)
+        with self._lock:
+            self._started[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        collection = self._finish(event)
+        self._observe(event, collection, "succeeded")
+        if event.command_name in ("find", "getMore", "aggregate"):
+            count = returned_documents(event.reply)
+            if count:
+                MONGODB_DOCUMENTS_RETURNED.labels(collection).inc(count)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._observe(event, self._finish(event), "failed")
+
+    def _finish(self, event: Any) -> str:
+        with self._lock:
+            return self._started.pop((event.connection_id, event.request_id), "")
+
+    def _observe(self, event: Any, collection: str, status: str) -> None:
+        seconds = event.duration_micros / 1e6
+        MONGODB_COMMAND_DURATION.labels(event.command_name, collection, status).observe(
+            seconds
+        )
+        add_phase_time("database", seconds)
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Tracks the open and checked out connections of the MongoDB connection pools."""
+
+    def pool_created(self, event: Any) -> None:
+        pass
+
+    def pool_cleared(self, event: Any) -> None:
+        pass
+
+    def pool_closed(self, event: Any) -> None:
+        pass
+
+    def connection_created(self, event: Any) -> None:
+        MONGODB_POOL_CONNECTIONS.labels(address(event)).inc()
+
+    def connection_ready(self, event: Any) -> None:
+        pass
+
+    def connection_closed(self, event: Any) -> None:
+        MONGODB_POOL_CONNECTIONS.labels(address(event)).dec()
+
+    def connection_check_out_started(self, event: Any) -> None:
+        pass
+
+    def connection_check_out_failed(self, event: Any) -> None:
+        MONGODB_POOL_CHECKOUT_FAILURES.labels(address(event), event.reason).inc()
+
+    def connection_checked_out(self, event: Any) -> None:
+        MONGODB_POOL_CONNECTIONS_IN_USE.labels(address(event)).inc()
+
+    def connection_checked_in(self, event: Any) -> None:
+        MONGODB_POOL_CONNECTIONS_IN_USE.labels(address(event)).dec()
+
+
+def address(event: Any) -> str:
+    host, port = event.address
+    return f"{host}:{port}"
+
+
+def event_listeners() -> List[Any]:
+    """Listeners to pass to MongoClient."""
+
+    if not enabled():
+        return []
+    return [CommandMetrics(), PoolMetrics()]
+
+
+# ===============================================
+# flask hooks
+# ===============================================
+
+
+def start_request() -> None:
+    g.metrics_start = time.perf_counter()
+    g.metrics_timings = defaultdict(float)
+
+
+def count_bytes(chunks: Iterable, sizes: List[int], charset: str) -> Iterator[bytes]:
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode(charset)
+        sizes.append(len(chunk))
+        yield chunk
+
+
+def finish_request(response: Response) -> Response:
+    """Records the request once its response is sent, including streamed ones."""
+
+    if "metrics_start" not in g:
+        return response
+
+    start = g.metrics_start
+    timings = g.metrics_timings
+    method = request.method
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    status = response.status_code
+    # resource names of 404s are left out so that random URLs don't add new series
+    resource = "" if status == 404 else (request.view_args or {}).get("resource", "")
+
+    sizes: List[int] = []
+    if response.is_streamed:
+        response.response = count_bytes(response.response, sizes, response.charset)
+    else:
+        sizes.append(response.calculate_content_length() or 0)
+
+    def observe() -> None:
+        duration = time.perf_counter() - start
+        observe_request(method, route, resource, status, duration, sum(sizes), timings)
+
+    response.call_on_close(observe)
+    return response
+
+
+def observe_request(
+    method: str,
+    route: str,
+    resource: str,
+    status: int,
+    duration: float,
+    size: int,
+    timings: Optional[Dict[str, float]] = None,
+) -> None:
+    """Records a finished request. Phases are left out without timings."""
+
+    REQUESTS.labels(method, route, resource, str(status)).inc()
+    REQUEST_DURATION.labels(method, route, resource).observe(duration)
+    RESPONSE_BYTES.labels(route, resource).observe(size)
+
+    if timings is None:
+        return
+    timings["other"] = max(duration - sum(timings.values()), 0.0)
+    for phase in PHASES:
+        REQUEST_PHASE_DURATION.labels(route, phase).observe(timings[phase])
+
+
+def generate_latest() -> Tuple[bytes, str]:
+    """The metrics in the Prometheus text format, added up over all workers in
+    multiprocess mode. Returns the body and its content type.
+    """
+
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return (
+        prometheus_client.generate_latest(registry),
+        prometheus_client.CONTENT_TYPE_LATEST,
+    )
+
+
+def init_app(app: Flask) -> None:
+    """Register the hooks. Call before other after_request hooks (eg. compression)
+    so that the response sizes are measured as sent.
+    """
+
+    if enabled():
+        app.before_request(start_request)
+        app.after_request(finish_request)
@@ -1,29 +1,71 @@
 import logging
+import os
+import threading
 from typing import Any, Dict, List, Optional, Tuple
 
 import bson
 import pymongo
 from bson.objectid import ObjectId
-from pymongo.collection import Collection
+from bson.son import SON
+from pymongo.change_stream import ChangeStream
+from pymongo.collection import Collection, ReturnDocument
+from pymongo.command_cursor import CommandCursor
 from pymongo.cursor import Cursor
 from pymongo.database import Database
 from pymongo.errors import (
     AutoReconnect,
+    BulkWriteError,
     ConfigurationError,
     ConnectionFailure,
     DuplicateKeyError,
+    OperationFailure,
 )
+from pymongo.mongo_client import MongoClient
 
-from mangorest import config
+from mangorest import config, metrics, slowlog
 
 logger = logging.getLogger(__name__)
 
 
+_client: Optional[MongoClient] = None
+_client_pid: Optional[int] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> MongoClient:
+    """Returns the MongoClient shared by everything in the current process.
+
+    A client must not be used across a fork, so a new one is created the first
+    time this is called in a process, eg. in each gunicorn worker. The client
+    and its connection pool are then reused for the lifetime of the worker.
+    """
+
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = pymongo.MongoClient(
+                    config.MONGODB_URI,
+                    event_listeners=metrics.event_listeners()
+                    + slowlog.event_listeners(),
+                    **config.mongo_client_options(),
+                )
+                _client_pid = pid
+    return _client
+
+
+def get_database() -> Database:
+    """Returns the configured database from the shared client."""
+
+    return get_client()[config.DATABASE]
+
+
 def connect() -> Database:
     try:
         logger.info("Connecting to MongoDB.")
-        client = pymongo.MongoClient(config.MONGODB_URI)
-        database = client[config.DATABASE]
+        database = get_database()
         logger.info("Connection to MongoDB successful.")
         return database
     except ConfigurationError:
@@ -44,10 +86,11 @@ def connect() -> Database:
 def query_collection(
     db_collection: Collection,
     query: Optional[Dict],
-    projection: Optional[List],
+    projection: Optional[Dict],
     sort_options: Optional[List],
     limit: Optional[int],
     skip: Optional[int],
+    max_time_ms: Optional[int] = None,
 ) -> Cursor:
     try:
         result = db_collection.find(
@@ -56,6 +99,7 @@ def query_collection(
             sort=sort_options,
             limit=limit,
             skip=skip,
+            max_time_ms=max_time_ms,
         )
         return result
     except Exception:
@@ -63,6 +107,142 @@ def query_collection(
         raise
 
 
+def count_documents(
+    db_collection: Collection, query: Optional[Dict], max_time_ms: Optional[int] = None
+) -> int:
+    """Counts the documents matching query without transferring them.
+
+    An empty query uses the collection metadata count, which avoids a collection scan.
+    """
+
+    options = {"maxTimeMS": max_time_ms} if max_time_ms else {}
+    try:
+        if not query:
+            return db_collection.estimated_document_count(**options)
+        return db_collection.count_documents(query, **options)
+    except Exception:
+        logger.exception("An unexpected error happened.")
+        raise
+
+
+def aggregate(
+    db_collection: Collection,
+    pipeline: List[Dict],
+    allow_disk_use: bool,
+    max_time_ms: Optional[int],
+) -> CommandCursor:
+    try:
+        result = db_collection.aggregate(
+            pipeline, allowDiskUse=allow_disk_use, maxTimeMS=max_time_ms
+        )
+        return result
+    except OperationFailure:
+        logger.info("Aggregation failed.")
+        raise
+    except Exception:
+        logger.exception("An unexpected error happened.")
+        raise
+
+
+def explain_find_command(
+    db_collection: Collection,
+    query: Optional[Dict],
+    sort_options: Optional[List],
+    max_time_ms: Optional[int] = None,
+) -> SON:
+    """The find command explained by explain_query."""
+
+    command = SON([("find", db_collection.name), ("filter", query or {})])
+    if sort_options:
+        command["sort"] = SON(sort_options)
+    if max_time_ms:
+        command["maxTimeMS"] = max_time_ms
+    return command
+
+
+def explain_query(
+    db_collection: Collection,
+    query: Optional[Dict],
+    sort_options: Optional[List],
+    max_time_ms: Optional[int] = None,
+) -> Dict:
+    """Returns the query plan MongoDB would choose for the filter and sort.
+
+    Explained with the queryPlanner verbosity, which does not run the winning plan.
+    """
+
+    try:
+        return db_collection.database.command(
+            "explain",
+            explain_find_command(db_collection, query, sort_options, max_time_ms),
+            verbosity="queryPlanner",
+            read_preference=db_collection.read_preference,
+        )
+    except OperationFailure:
+        logger.info("Explain failed.")
+        raise
+    except Exception:
+        logger.exception("An unexpected error happened.")
+        raise
+
+
+def watch_collection(
+    db_collection: Collection,
+    pipeline: List[Dict],
+    resume_after: Optional[Dict] = None,
+    max_await_time_ms: Optional[int] = None,
+) -> ChangeStream:
+    """Opens a change stream of the collection, with the current version of updated documents."""
+
+    try:
+        return db_collection.watch(
+            pipeline=pipeline,
+            full_document="updateLookup",
+            resume_after=resume_after,
+            max_await_time_ms=max_await_time_ms,
+        )
+    except OperationFailure:
+        logger.info("Opening the change stream failed.")
+        raise
+    except Exception:
+        logger.exception("An unexpected error happened.")
+        raise
+
+
+def list_indexes(db_collection: Collection) -> List[Dict]:
+    try:
+        return list(db_collection.list_indexes())
+    except Exception:
+        logger.exception("An unexpected error happened.")
+        raise
+
+
+def create_index(
+    db_collection: Collection, keys: List[Tuple[str, Any]], options: Dict
+) -> str:
+    """Builds the index if it doesn't exist yet. Returns the name of the index."""
+
+    try:
+        return db_collection.create_index(keys, **options)
+    except OperationFailure:
+        logger.info("Index creation failed.")
+        raise
+    except Exception:
+        logger.exception("An unexpected error happened.")
+        raise
+
+
+def drop_index(db_collection: Collection, index_name: str) -> None:
+    try:
+        db_collection.drop_index(index_name)
+    except OperationFailure:
+        logger.info("Dropping the index failed.")
+        raise
+    except Exception:
+        logger.exception("An unexpected error happened.")
+        raise
+
+
 def insert_single_document(db_collection: Collection, document_obj: Dict) -> ObjectId:
     try:
         document_obj_id = db_collection.insert_one(document_obj).inserted_id
@@ -89,9 +269,34 @@ def insert_multiple_documents(
         raise
 
 
-def query_document(db_collection: Collection, oid: str) -> Dict:
+def bulk_write_operations(db_collection: Collection, operations: List) -> Dict:
+    """Runs the operations unordered, so one failing operation doesn't stop the rest.
+
+    Returns:
+        The raw bulk write result, including the writeErrors of the failed operations.
+    """
+
     try:
-        document = db_collection.find_one({"_id": ObjectId(oid)})
+        result = db_collection.bulk_write(operations, ordered=False)
+        return result.bulk_api_result
+    except BulkWriteError as e:
+        logger.info("Some bulk write operations failed.")
+        return e.details
+    except Exception:
+        logger.exception("An unexpected error happened.")
+        raise
+
+
+def query_document(
+    db_collection: Collection,
+    oid: str,
+    projection: Optional[List] = None,
+    max_time_ms: Optional[int] = None,
+) -> Dict:
+    try:
+        document = db_collection.find_one(
+            {"_id": ObjectId(oid)}, projection, max_time_ms=max_time_ms
+        )
         return document
     except bson.errors.InvalidId:
         logger.info("Invalid ObjectId.")
@@ -103,10 +308,42 @@ def query_document(db_collection: Collection, oid: str) -> Dict:
 
 def update_single_document(
     db_collection: Collection, oid: str, document_obj: Dict
+) -> int:
+    """Updates the document without sending it back. Returns the number of matched documents."""
+
+    try:
+        result = db_collection.update_one(
+            {"_id": ObjectId(oid)}, {"$set": document_obj}
+        )
+        return result.matched_count
+    except bson.errors.InvalidId:
+        logger.info("Invalid ObjectId.")
+        raise
+    except DuplicateKeyError:
+        logger.info("Key already exists.")
+        raise
+    except Exception:
+        logger.exception("An unexpected error happened.")
+        raise
+
+
+def find_and_update_single_document(
+    db_collection: Collection,
+    oid: str,
+    document_obj: Dict,
+    return_after: bool,
+    projection: Optional[Dict],
 ) -> Any:
+    """Updates the document and returns it as it was before or after the update."""
+
+    return_document = ReturnDocument.AFTER if return_after else ReturnDocument.BEFORE
+
     try:
         result = db_collection.find_one_and_update(
-            {"_id": ObjectId(oid)}, {"$set": document_obj}
+            {"_id": ObjectId(oid)},
+            {"$set": document_obj},
+            projection=projection,
+            return_document=return_document,
         )
         return result
     except bson.errors.InvalidId:
@@ -131,9 +368,29 @@ def update_multiple_documents(
         raise
 
 
-def delete_single_document(db_collection: Collection, oid: str) -> Any:
+def delete_single_document(db_collection: Collection, oid: str) -> int:
+    """Deletes the document without sending it back. Returns the number of deleted documents."""
+
     try:
-        result = db_collection.find_one_and_delete({"_id": ObjectId(oid)})
+        result = db_collection.delete_one({"_id": ObjectId(oid)})
+        return result.deleted_count
+    except bson.errors.InvalidId:
+        logger.info("Invalid ObjectId.")
+        raise
+    except Exception:
+        logger.exception("An unexpected error happened.")
+        raise
+
+
+def find_and_delete_single_document(
+    db_collection: Collection, oid: str, projection: Optional[Dict]
+) -> Any:
+    """Deletes the document and returns it as it was before the delete."""
+
+    try:
+        result = db_collection.find_one_and_delete(
+            {"_id": ObjectId(oid)}, projection=projection
+        )
         return result
     except bson.errors.InvalidId:
         logger.info("Invalid ObjectId.")
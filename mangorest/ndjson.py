@@ -0,0 +1,76 @@
+"""Reading newline-delimited JSON (NDJSON) request bodies as a stream."""
+
+from itertools import islice
+from typing import IO, Any, Iterable, Iterator, List, NamedTuple, Optional
+
+from bson import json_util
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+
+class Record(NamedTuple):
+    """A parsed NDJSON line. error is set instead of value if the line is not valid JSON."""
+
+    index: int
+    value: Any
+    error: Optional[str] = None
+
+
+def iter_records(stream: IO[bytes], max_line_bytes: int) -> Iterator[Record]:
+    """Parse the lines of a stream one at a time as Extended JSON.
+
+    Blank lines are skipped and do not count towards the record index.
+    Only one line of at most max_line_bytes is held in memory at a time. Longer
+    lines are skipped and recorded as errors.
+    """
+
+    index = 0
+    for line in iter_lines(stream, max_line_bytes):
+        if line is None:
+            yield Record(
+                index, None, f"Line exceeds the maximum of {max_line_bytes} bytes."
+            )
+            index += 1
+            continue
+
+        line = line.strip()
+        if not line:
+            continue
+
+        yield parse_record(index, line)
+        index += 1
+
+
+def iter_lines(stream: IO[bytes], max_line_bytes: int) -> Iterator[Optional[bytes]]:
+    """Read the lines of a stream. Lines longer than max_line_bytes are yielded as None."""
+
+    while True:
+        line = stream.readline(max_line_bytes + 1)
+        if not line:
+            return
+
+        if len(line) > max_line_bytes and not line.endswith(b"\n"):
+            # the rest of the line is read and dropped, max_line_bytes at a time
+            while line and not line.endswith(b"\n"):
+                line = stream.readline(max_line_bytes + 1)
+            yield None
+        else:
+            yield line
+
+
+def parse_record(index: int, line: bytes) -> Record:
+    try:
+        return Record(index, json_util.loads(line))
+    except ValueError as e:
+        return Record(index, None, f"Invalid JSON: {e}")
+
+
+def batched(iterable: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """Split an iterable into lists of at most size items."""
+
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,206 @@
+"""Keyset (cursor-based) pagination.
+
+A page token stores the sort key values of the last document of a page. The next
+page is then fetched with a range filter on those keys instead of skipping over
+the previous pages, so its cost does not depend on how deep the page is.
+"""
+
+import base64
+import binascii
+from typing import Any, Dict, List, Optional, Tuple
+
+import pymongo
+from bson import json_util
+from bson.json_util import CANONICAL_JSON_OPTIONS
+
+from mangorest import exceptions
+
+MISSING = object()
+
+
+def sort_spec(sort_options: Optional[List[Tuple[str, int]]]) -> List[Tuple[str, int]]:
+    """Append _id to the sort keys as a tie-breaker so the ordering is total."""
+
+    spec = list(sort_options or [])
+    if "_id" not in [key for key, _ in spec]:
+        spec.append(("_id", pymongo.ASCENDING))
+    return spec
+
+
+def get_path(document: Dict, path: str) -> Any:
+    """Get the value of a (possibly dotted) field path in a document."""
+
+    value: Any = document
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return MISSING
+        value = value[part]
+    return value
+
+
+def is_projected(path: str, fields: List[str]) -> bool:
+    """Whether a field path is included by a list of projected fields."""
+
+    return any(path == field or path.startswith(f"{field}.") for field in fields)
+
+
+def paths_collide(path: str, other: str) -> bool:
+    """Whether two field paths are the same or one contains the other."""
+
+    return is_projected(path, [other]) or is_projected(other, [path])
+
+
+def is_inclusion(projection: Dict) -> bool:
+    """Whether a projection only returns the fields it names (and _id), as opposed
+    to all the fields but the excluded ones.
+    """
+
+    return any(
+        value == 1 or (isinstance(value, dict) and "$elemMatch" in value)
+        for value in projection.values()
+    )
+
+
+def project_sort_keys(
+    projection: Dict, spec: List[Tuple[str, int]]
+) -> Tuple[Dict, List[str]]:
+    """Make a projection return the sort keys, which the page token is built from.
+
+    Sort keys are added to an inclusion projection, and exclusions overlapping a
+    sort key are dropped. Returns the projection and the paths to remove from the
+    documents afterwards to give them the requested shape.
+
+    Raises:
+        InvalidProjectionError: if a sort key is partly projected, eg. sliced
+    """
+
+    inclusion = is_inclusion(projection)
+    projection = dict(projection)
+    hidden_paths: List[str] = []
+
+    for key, _ in spec:
+        for path, value in list(projection.items()):
+            if not paths_collide(key, path):
+                continue
+            if value == 0:
+                del projection[path]
+                hidden_paths.append(path)
+            elif value != 1 or not is_projected(key, [path]):
+                raise exceptions.InvalidProjectionError(
+                    f"Cannot paginate by {key}, which is only partly returned by _projection."
+                )
+        if (
+            inclusion
+            and key != "_id"
+            and not any(paths_collide(key, path) for path in projection)
+        ):
+            projection[key] = 1
+            hidden_paths.append(key)
+
+    return projection, hidden_paths
+
+
+def remove_path(document: Dict, path: str) -> None:
+    """Remove a (possibly dotted) field path from a document, if present.
+
+    Embedded documents left empty by the removal are removed as well.
+    """
+
+    part, _, rest = path.partition(".")
+    if part not in document:
+        return
+    if rest:
+        if isinstance(document[part], dict):
+            remove_path(document[part], rest)
+            if not document[part]:
+                del document[part]
+    else:
+        del document[part]
+
+
+def sort_values(document: Dict, spec: List[Tuple[str, int]]) -> List[Any]:
+    """The sort key values of a document, null for the missing ones as MongoDB orders them."""
+
+    values = [get_path(document, key) for key, _ in spec]
+    return [None if value is MISSING else value for value in values]
+
+
+def encode_token(values: List[Any], spec: List[Tuple[str, int]]) -> str:
+    """Build the page token pointing after the document with the given sort key values."""
+
+    payload = json_util.dumps(
+        {"sort": [[key, direction] for key, direction in spec], "values": values},
+        json_options=CANONICAL_JSON_OPTIONS,
+    )
+    return base64.urlsafe_b64encode(payload.encode("UTF-8")).decode("ascii").rstrip("=")
+
+
+def decode_token(token: str, spec: List[Tuple[str, int]]) -> List[Any]:
+    """Get the sort key values stored in a page token.
+
+    Raises:
+        InvalidPageTokenError: if the token is malformed or was issued for a different sort
+    """
+
+    try:
+        padded_token = token + "=" * (-len(token) % 4)
+        payload = base64.urlsafe_b64decode(padded_token.encode("ascii")).decode("UTF-8")
+        content = json_util.loads(payload, json_options=CANONICAL_JSON_OPTIONS)
+        token_spec = [(key, direction) for key, direction in content["sort"]]
+        values = content["values"]
+    except (binascii.Error, UnicodeError, ValueError, KeyError, TypeError):
+        raise exceptions.InvalidPageTokenError("Malformed _after page token.")
+
+    if token_spec != spec or len(values) != len(spec):
+        raise exceptions.InvalidPageTokenError(
+            "The _after page token does not match the _sort of this query."
+        )
+    return values
+
+
+def after_value(key: str, direction: int, value: Any) -> Optional[Dict]:
+    """Build the condition matching the values of a sort key that come after the given
+    one, or None if no value does.
+
+    Null (and missing) values come first in ascending order and last in descending
+    order, but are not matched by $gt/$lt, so they are handled separately.
+    """
+
+    if direction == pymongo.ASCENDING:
+        if value is None:
+            return {key: {"$ne": None}}
+        return {key: {"$gt": value}}
+    if value is None:
+        return None
+    return {"$or": [{key: {"$lt": value}}, {key: None}]}
+
+
+def keyset_filter(spec: List[Tuple[str, int]], values: List[Any]) -> Dict:
+    """Build the filter matching the documents that come after the given sort key values.
+
+    For sort keys (a, b, _id) this is
+    a > va OR (a == va AND b > vb) OR (a == va AND b == vb AND _id > v_id),
+    with > flipped to < for descending keys.
+    """
+
+    branches: List[Dict] = []
+    for index, (key, direction) in enumerate(spec):
+        condition = after_value(key, direction, values[index])
+        if condition is None:
+            continue
+        branch: Dict[str, Any] = {
+            prev_key: values[prev_index]
+            for prev_index, (prev_key, _) in enumerate(spec[:index])
+        }
+        branch.update(condition)
+        branches.append(branch)
+
+    if len(branches) == 1:
+        return branches[0]
+    return {"$or": branches}
+
+
+def combine_filters(query: Optional[Dict], page_filter: Dict) -> Dict:
+    if not query:
+        return page_filter
+    return {"$and": [query, page_filter]}
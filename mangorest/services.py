@@ -1,28 +1,64 @@
 import datetime
+import functools
+import hashlib
 import json
 import logging
 import re
-from typing import Any, Dict, List, Optional, Tuple
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 
 import pymongo
-from bson import json_util
 from bson.objectid import ObjectId
+from pymongo.collection import Collection
+from pymongo.command_cursor import CommandCursor
+from pymongo.common import (
+    validate_is_document_type,
+    validate_is_mapping,
+    validate_ok_for_replace,
+    validate_ok_for_update,
+)
+from pymongo.cursor import Cursor
 from pymongo.database import Database
-
-from mangorest import config, exceptions, mongo
+from pymongo.errors import ExecutionTimeout, OperationFailure
+
+from mangorest import (
+    advisor,
+    cache,
+    config,
+    encoder,
+    exceptions,
+    metrics,
+    mongo,
+    ndjson,
+    pagination,
+    watch,
+)
 
 logger = logging.getLogger(__name__)
 
 if config.COLLECTION == "*":
-    mapper = config.MangoConfigurator.from_unmapped_all_collections()
+    mapper = config.MangoConfigurator.from_unmapped_all_collections(
+        mongo.get_database()
+    )
 else:
     resource_to_collection_list = config.COLLECTION.split(",")
     mapper = config.MangoConfigurator(resource_to_collection_list)
 
 mapper.resource_collection_map_parser()
-mapper.verify_collection_exists()
+mapper.verify_collection_exists(mongo.get_database())
+mapper.load_resource_options(config.RESOURCE_OPTIONS_FILE)
 endpoints = mapper.resource_name_map
 collection_set = mapper.collection_set
+collection_options = mapper.collection_options
 
 # ===============================================
 # utilities
@@ -30,15 +66,19 @@ collection_set = mapper.collection_set
 
 
 def parse_object_id(document):
-    """Converts ObjectIds within document to be serializable."""
+    """Converts ObjectIds within document to be serializable.
+
+    Responses no longer need this since the app's JSON encoder handles BSON types
+    directly (see mangorest.encoder). Kept for callers that want plain Extended JSON dicts.
+    """
 
     if (
         type(document) is ObjectId
     ):  # case where the ObjectId itself is directly passed to the function
-        oid = json.loads(json_util.dumps(document))
+        oid = json.loads(encoder.dumps(document))
         oid_dict = {"_id": oid}
         return oid_dict
-    return json.loads(json_util.dumps(document))
+    return json.loads(encoder.dumps(document))
 
 
 def check_resource_name(resource_name):
@@ -49,34 +89,200 @@ def check_resource_name(resource_name):
     return endpoints[resource_name]
 
 
-def cast_query_types(query_type, query_value) -> Any:
-    supported_types = {
-        "int": int,
-        "float": float,
-        "bool": bool,
-        "str": str,
-        "date": datetime.date,
-        "time": datetime.time,
-        "datetime": datetime.datetime,
-        "timedelta": datetime.timedelta,
-    }
+# Type hint tables used by cast_query_types.
+SUPPORTED_TYPES = {
+    "int": int,
+    "float": float,
+    "bool": bool,
+    "str": str,
+    "date": datetime.date,
+    "time": datetime.time,
+    "datetime": datetime.datetime,
+    "timedelta": datetime.timedelta,
+}
+
+# used for enforcing the type of the list items
+LIST_VARIANT_TYPES = {
+    "list-int": int,
+    "list-float": float,
+    "list-str": str,
+    "list-date": datetime.date,
+    "list-time": datetime.time,
+    "list-datetime": datetime.datetime,
+    "list-timedelta": datetime.timedelta,
+}
+
+# Logical Query Operators, see parse_logical_query
+LOGICAL_PATTERN = re.compile(r"^\((.+)\)$")
+EXPRESSION_PATTERN = re.compile(r"^(.+)\.(\w+)\[(.+)\]\.(.+)")
+
+# Pattern for when matching directly NON-STRING values:
+# After the "=", type hint of the field must be provided.
+# Example: /api/rockets?is_active=[bool].true
+EQUALITY_PATTERN = re.compile(r"^\[(\w+)\]\.(\w+)")
+
+# For Comparison Query Operators:
+# Query string must have the operator name with type hint
+# of the field then a "." (dot) to identify the operator.
+# This is then followed by the value.
+# Example: /api/rockets?thrust_to_weight_ratio=lt[int].70
+# Referrence: https://docs.mongodb.com/manual/reference/operator/query-comparison/
+COMPARISON_OPERATOR_PATTERN = re.compile(r"(^\w+)\[(.+)\]\.(.+)")
+
+SORT_PAIR_PATTERN = re.compile(r"^\((.+)\:(.+)\)$")
+SORT_DIRECTIONS = {"ascending": pymongo.ASCENDING, "descending": pymongo.DESCENDING}
+
+# Array projections, see parse_projection
+# Example: /api/rockets?_projection=name,tests.slice.-5,stages.elemMatch.(name.eq[str].first)
+PROJECTION_SLICE_PATTERN = re.compile(r"^(.+)\.slice\.(-?\d+|\((-?\d+),(\d+)\))$")
+PROJECTION_ELEM_MATCH_PATTERN = re.compile(r"^(.+)\.elemMatch\.(\(.+\))$")
+
+
+class FrozenDict(dict):
+    """A dict that cannot be modified, returned for cached query filters.
+
+    Still a dict subclass so it can be passed as is to pymongo and bson.
+    """
 
-    # used for enforcing the type of the list items
-    list_variant = {
-        "list-int": int,
-        "list-float": float,
-        "list-str": str,
-        "list-date": datetime.date,
-        "list-time": datetime.time,
-        "list-datetime": datetime.datetime,
-        "list-timedelta": datetime.timedelta,
-    }
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("Compiled query filters are immutable. Copy them first.")
+
+    __setitem__ = __delitem__ = __ior__ = _immutable  # type: ignore
+    clear = pop = popitem = setdefault = update = _immutable  # type: ignore
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+
+def freeze(obj: Any) -> Any:
+    """Recursively convert dicts to FrozenDicts and lists to tuples."""
+
+    if isinstance(obj, dict):
+        return FrozenDict((key, freeze(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return tuple(freeze(item) for item in obj)
+    return obj
+
+
+def thaw(obj: Any) -> Any:
+    """Recursively copy FrozenDicts to dicts and tuples to lists, undoing freeze."""
+
+    if isinstance(obj, dict):
+        return {key: thaw(value) for key, value in obj.items()}
+    if isinstance(obj, tuple):
+        return [thaw(item) for item in obj]
+    return obj
+
+
+DEFAULT_COLLECTION_OPTIONS = config.CollectionOptions()
+
+
+def get_db_collection(db: Database, collection_name: Any) -> Collection:
+    """Get the collection with its configured read preference and read/write concerns."""
+
+    options = get_collection_options(collection_name)
+    return db.get_collection(
+        collection_name,
+        read_preference=options.read_preference,
+        read_concern=options.read_concern,
+        write_concern=options.write_concern,
+    )
+
+
+def get_collection_options(collection_name: Any) -> config.CollectionOptions:
+    return collection_options.get(collection_name, DEFAULT_COLLECTION_OPTIONS)
+
+
+def resolve_limit(collection_name: Any, limit: Optional[str]) -> int:
+    """The number of documents a query may return. 0 means no limit.
+
+    Without _limit, the resource's default limit applies, or its maximum if it
+    has no default. _limit=0 asks for no limit, which is the maximum if there is one.
+
+    Raises:
+        QueryLimitError: if the limit is not a non-negative integer or exceeds the maximum
+    """
+
+    options = get_collection_options(collection_name)
+    default_limit = options.default_limit or config.QUERY_DEFAULT_LIMIT
+    max_limit = options.max_limit or config.QUERY_MAX_LIMIT
+
+    if limit:
+        try:
+            limit_count = int(limit)
+        except ValueError:
+            raise exceptions.QueryLimitError("_limit must be an integer.")
+        if limit_count < 0:
+            raise exceptions.QueryLimitError("_limit must not be negative.")
+        if limit_count == 0:
+            limit_count = max_limit
+    else:
+        limit_count = default_limit or max_limit
+
+    if max_limit and limit_count > max_limit:
+        raise exceptions.QueryLimitError(
+            f"_limit exceeds the maximum of {max_limit}. Use _after to paginate."
+        )
+    return limit_count
+
+
+def resolve_skip(skip: Optional[str]) -> int:
+    """The number of documents a query skips.
+
+    Raises:
+        QueryLimitError: if skip is not a non-negative integer
+    """
+
+    if not skip:
+        return 0
+    try:
+        skip_count = int(skip)
+    except ValueError:
+        raise exceptions.QueryLimitError("_skip must be an integer.")
+    if skip_count < 0:
+        raise exceptions.QueryLimitError("_skip must not be negative.")
+    return skip_count
+
+
+def resolve_max_time_ms(
+    collection_name: Any, max_time_ms: Optional[str] = None
+) -> Optional[int]:
+    """The maxTimeMS of a query, capped to the resource's or the global maximum.
+
+    Raises:
+        QueryLimitError: if max_time_ms is not a positive integer
+    """
 
-    if query_type in list_variant:
+    time_limit = (
+        get_collection_options(collection_name).max_time_ms or config.QUERY_MAX_TIME_MS
+    )
+    if not max_time_ms:
+        return time_limit or None
+
+    try:
+        requested_time_limit = int(max_time_ms)
+    except ValueError:
+        raise exceptions.QueryLimitError("_max_time_ms must be an integer.")
+    if requested_time_limit <= 0:
+        raise exceptions.QueryLimitError("_max_time_ms must be greater than 0.")
+
+    if time_limit:
+        return min(requested_time_limit, time_limit)
+    return requested_time_limit
+
+
+def get_response_max_bytes(collection_name: Any) -> int:
+    options = get_collection_options(collection_name)
+    return options.max_response_bytes or config.RESPONSE_MAX_BYTES
+
+
+def cast_query_types(query_type, query_value) -> Any:
+    if query_type in LIST_VARIANT_TYPES:
         parsed_query_value = query_value[1:-1].split(",")
-        query_value = [list_variant[query_type](item) for item in parsed_query_value]
+        item_type = LIST_VARIANT_TYPES[query_type]
+        query_value = [item_type(item) for item in parsed_query_value]
         return query_value
-    return supported_types[query_type](query_value)
+    return SUPPORTED_TYPES[query_type](query_value)
 
 
 def parse_logical_query(query) -> List[Dict]:
@@ -101,15 +307,12 @@ def parse_logical_query(query) -> List[Dict]:
 
     expressions_list: List[Dict] = []
 
-    logical_pattern = r"^\((.+)\)$"
-    expression_pattern = r"^(.+)\.(\w+)\[(.+)\]\.(.+)"
-
-    logical_match = re.search(logical_pattern, query)
+    logical_match = LOGICAL_PATTERN.search(query)
     if logical_match:
         raw_expressions_list = logical_match.group(1).split(",")
 
         for item in raw_expressions_list:
-            expression_match = re.search(expression_pattern, item)
+            expression_match = EXPRESSION_PATTERN.search(item)
             field_name = expression_match.group(1)  # type: ignore
             operator = expression_match.group(2)  # type: ignore
             field_type = expression_match.group(3)  # type: ignore
@@ -122,9 +325,13 @@ def parse_logical_query(query) -> List[Dict]:
     return expressions_list
 
 
+@metrics.timed("parse")
 def map_to_query_operator(query_params: Dict) -> Dict[Any, Any]:
     """Parse and convert query string to a form accepted by pymongo.
 
+    Compiled filters are cached by their normalized (sorted) query params, so
+    repeated filter shapes skip parsing. The returned filter is immutable.
+
     Args:
         query_params: A dictionary of the parsed query string.
 
@@ -132,27 +339,20 @@ def map_to_query_operator(query_params: Dict) -> Dict[Any, Any]:
         Dict (representing as SON object) in the form {"field": "value"} or {"field":{"$operator":"value"}}
     """
 
-    filter_dict = {}  # dict representing as SON object
-
-    # Pattern for when matching directly NON-STRING values:
-    # After the "=", type hint of the field must be provided.
-    # Example: /api/rockets?is_active=[bool].true
+    normalized_params = tuple(sorted(query_params.items()))
+    return compile_query(normalized_params)
 
-    equality_pattern = r"^\[(\w+)\]\.(\w+)"
 
-    # For Comparison Query Operators:
-    # Query string must have the operator name with type hint
-    # of the field then a "." (dot) to identify the operator.
-    # This is then followed by the value.
-    # Example: /api/rockets?thrust_to_weight_ratio=lt[int].70
-    # Referrence: https://docs.mongodb.com/manual/reference/operator/query-comparison/
+@functools.lru_cache(maxsize=config.QUERY_CACHE_SIZE)
+def compile_query(query_params: Tuple[Tuple[str, str], ...]) -> FrozenDict:
+    """Compile normalized query params to a pymongo filter. See map_to_query_operator."""
 
-    comparison_operator_pattern = r"(^\w+)\[(.+)\]\.(.+)"
+    filter_dict: Dict[str, Any] = {}  # dict representing as SON object
 
-    for key, value in query_params.items():
+    for key, value in query_params:
         # regex matching
-        equality_match = re.search(equality_pattern, value)
-        comparison_match = re.search(comparison_operator_pattern, value)
+        equality_match = EQUALITY_PATTERN.search(value)
+        comparison_match = COMPARISON_OPERATOR_PATTERN.search(value)
 
         if equality_match:
             typed_query_value = cast_query_types(
@@ -172,22 +372,545 @@ def map_to_query_operator(query_params: Dict) -> Dict[Any, Any]:
         else:
             filter_dict[key] = value
 
-    return filter_dict
+    return freeze(filter_dict)
 
 
+@functools.lru_cache(maxsize=config.QUERY_CACHE_SIZE)
 def parse_sort(sort: str) -> Any:
-    sort_pairs = sort.split(",")
+    """Parse the _sort param to a tuple of (field, direction) pairs. Results are cached."""
+
     sort_list: List = []
-    direction_table = {"ascending": pymongo.ASCENDING, "descending": pymongo.DESCENDING}
 
-    pair_pattern = r"^\((.+)\:(.+)\)$"
-    for pair in sort_pairs:
-        pair_match = re.search(pair_pattern, pair)
+    for pair in sort.split(","):
+        pair_match = SORT_PAIR_PATTERN.search(pair)
         if pair_match:
-            pair_tuple = (pair_match.group(1), direction_table[pair_match.group(2)])
+            pair_tuple = (pair_match.group(1), SORT_DIRECTIONS[pair_match.group(2)])
             sort_list.append(pair_tuple)
 
-    return sort_list
+    return tuple(sort_list)
+
+
+def split_fields(value: str) -> List[str]:
+    """Split a comma separated list, leaving the commas inside parentheses."""
+
+    fields = []
+    depth = 0
+    start = 0
+    for index, char in enumerate(value):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            fields.append(value[start:index])
+            start = index + 1
+    fields.append(value[start:])
+    return fields
+
+
+def parse_elem_match(expressions: str) -> Dict[str, Any]:
+    """Parse the expressions of an elemMatch projection, written like the and/or
+    expressions of parse_logical_query, to the conditions on the array elements.
+    """
+
+    conditions: Dict[str, Any] = {}
+    for expression in parse_logical_query(expressions):
+        for field_name, condition in expression.items():
+            conditions.setdefault(field_name, {}).update(condition)
+    return conditions
+
+
+@functools.lru_cache(maxsize=config.QUERY_CACHE_SIZE)
+def parse_projection(projection: str) -> FrozenDict:
+    """Parse the _projection param to a pymongo projection. Results are cached.
+
+    Fields are included by name (dotted paths for embedded fields), or excluded
+    with a leading "-". Arrays can be sliced with field.slice.<n> (the first n
+    elements, or the last n if negative) or field.slice.(<skip>,<n>), and cut down
+    to their first element matching field.elemMatch.(<expressions>).
+
+    Raises:
+        InvalidProjectionError: if a field (or its slice or elemMatch) is malformed,
+            fields are both included and excluded (other than excluding _id), or a
+            path is projected twice
+    """
+
+    projection_dict: Dict[str, Any] = {}
+
+    for field in split_fields(projection):
+        slice_match = PROJECTION_SLICE_PATTERN.search(field)
+        elem_match = PROJECTION_ELEM_MATCH_PATTERN.search(field)
+        value: Any
+        if slice_match:
+            path = slice_match.group(1)
+            if slice_match.group(3) is None:
+                value = {"$slice": int(slice_match.group(2))}
+            else:
+                skip_count = int(slice_match.group(3))
+                value = {"$slice": [skip_count, int(slice_match.group(4))]}
+        elif elem_match:
+            path = elem_match.group(1)
+            try:
+                value = {"$elemMatch": parse_elem_match(elem_match.group(2))}
+            except (AttributeError, KeyError, ValueError):
+                raise exceptions.InvalidProjectionError(
+                    f"Invalid elemMatch expressions in _projection: {field}."
+                )
+        elif ".slice." in field or ".elemMatch." in field:
+            raise exceptions.InvalidProjectionError(
+                f"Invalid slice or elemMatch in _projection: {field!r}."
+            )
+        elif field.startswith("-"):
+            path, value = field[1:], 0
+        else:
+            path, value = field, 1
+
+        if not path or path.startswith("$") or "" in path.split("."):
+            raise exceptions.InvalidProjectionError(
+                f"Invalid field in _projection: {field!r}."
+            )
+        for projected_path in projection_dict:
+            if pagination.paths_collide(path, projected_path):
+                raise exceptions.InvalidProjectionError(
+                    f"Path collision in _projection between {projected_path} and {path}."
+                )
+        projection_dict[path] = value
+
+    excluded = [path for path, value in projection_dict.items() if value == 0]
+    if pagination.is_inclusion(projection_dict) and set(excluded) - {"_id"}:
+        raise exceptions.InvalidProjectionError(
+            "Fields of _projection cannot be both included and excluded, "
+            "except for excluding _id."
+        )
+
+    return freeze(projection_dict)
+
+
+def resolve_projection(projection: Optional[str]) -> Optional[Dict]:
+    """The projection of a find for the _projection param, if any. Copied from the
+    cached one, as drivers may add to it (eg. _id).
+    """
+
+    return thaw(parse_projection(projection)) if projection else None
+
+
+def query_cache_stats() -> Dict[str, Any]:
+    """Hit/miss counters of the compiled filter, sort and projection caches."""
+
+    stats = {}
+    for name, cached_function in (
+        ("filter", compile_query),
+        ("sort", parse_sort),
+        ("projection", parse_projection),
+    ):
+        info = cached_function.cache_info()
+        stats[name] = {
+            "hits": info.hits,
+            "misses": info.misses,
+            "size": info.currsize,
+            "maxsize": info.maxsize,
+        }
+    return stats
+
+
+def validate_pipeline(pipeline: Any) -> List[Dict]:
+    """Check an aggregation pipeline against the allowed stages.
+
+    Stages that read other collections ($lookup, $graphLookup, $unionWith)
+    refer to them by resource name. These are mapped to their collection
+    names in the returned copy of the pipeline, and nested pipelines are
+    checked as well.
+
+    Raises:
+        InvalidPipelineError: if the pipeline is malformed
+        ForbiddenPipelineStageError: if a stage or operator is not allowed
+        ResourceNameNotFoundError: if a stage refers to an unknown resource
+    """
+
+    if not isinstance(pipeline, list):
+        raise exceptions.InvalidPipelineError("Pipeline must be a list of stages.")
+
+    validated_pipeline = []
+    for stage in pipeline:
+        if not isinstance(stage, dict) or len(stage) != 1:
+            raise exceptions.InvalidPipelineError(
+                "Each pipeline stage must be an object with a single stage operator."
+            )
+
+        [(stage_name, stage_spec)] = stage.items()
+        if stage_name not in config.AGGREGATE_ALLOWED_STAGES:
+            raise exceptions.ForbiddenPipelineStageError(
+                f"Aggregation stage {stage_name} is not allowed."
+            )
+        check_forbidden_operators(stage_spec)
+
+        if stage_name == "$facet" and isinstance(stage_spec, dict):
+            stage_spec = {
+                name: validate_pipeline(sub_pipeline)
+                for name, sub_pipeline in stage_spec.items()
+            }
+        elif stage_name in ("$lookup", "$graphLookup") and isinstance(stage_spec, dict):
+            stage_spec = dict(stage_spec)
+            stage_spec["from"] = lookup_collection_name(stage_spec.get("from"))
+            if "pipeline" in stage_spec:
+                stage_spec["pipeline"] = validate_pipeline(stage_spec["pipeline"])
+        elif stage_name == "$unionWith":
+            if isinstance(stage_spec, str):
+                stage_spec = lookup_collection_name(stage_spec)
+            elif isinstance(stage_spec, dict):
+                stage_spec = dict(stage_spec)
+                stage_spec["coll"] = lookup_collection_name(stage_spec.get("coll"))
+                if "pipeline" in stage_spec:
+                    stage_spec["pipeline"] = validate_pipeline(stage_spec["pipeline"])
+
+        validated_pipeline.append({stage_name: stage_spec})
+
+    return validated_pipeline
+
+
+def lookup_collection_name(resource_name: Any) -> str:
+    if not isinstance(resource_name, str):
+        raise exceptions.InvalidPipelineError(
+            "Stages reading other collections must name them by resource name."
+        )
+    return check_resource_name(resource_name)
+
+
+def check_forbidden_operators(spec: Any) -> None:
+    """Raises ForbiddenPipelineStageError if spec uses a server-side JavaScript operator."""
+
+    if isinstance(spec, dict):
+        for key, value in spec.items():
+            if key in config.AGGREGATE_FORBIDDEN_OPERATORS:
+                raise exceptions.ForbiddenPipelineStageError(
+                    f"Operator {key} is not allowed."
+                )
+            check_forbidden_operators(value)
+    elif isinstance(spec, list):
+        for item in spec:
+            check_forbidden_operators(item)
+
+
+BULK_OPERATIONS = {
+    "insertOne": (pymongo.InsertOne, ("document",), ()),
+    "updateOne": (pymongo.UpdateOne, ("filter", "update"), ("upsert",)),
+    "updateMany": (pymongo.UpdateMany, ("filter", "update"), ("upsert",)),
+    "replaceOne": (pymongo.ReplaceOne, ("filter", "replacement"), ("upsert",)),
+    "deleteOne": (pymongo.DeleteOne, ("filter",), ()),
+    "deleteMany": (pymongo.DeleteMany, ("filter",), ()),
+}
+# pymongo only checks these when the operations are run, in the middle of a chunk
+BULK_ARGUMENT_VALIDATORS = {
+    "document": functools.partial(validate_is_document_type, "document"),
+    "filter": functools.partial(validate_is_mapping, "filter"),
+    "update": validate_ok_for_update,
+    "replacement": validate_ok_for_replace,
+}
+
+
+def parse_bulk_operation(operation: Any) -> Any:
+    """Convert a bulk operation object to its pymongo write operation.
+
+    An operation is in the form {"<operation name>": {<arguments>}}, eg.
+    {"updateOne": {"filter": {"name": "RD-180"}, "update": {"$set": {"country": "Russia"}}}}
+
+    Raises:
+        InvalidBulkOperationError: if the operation is malformed, eg. an update without
+            $ operators or a document that is not an object, or an updateMany/deleteMany
+            has an empty filter
+    """
+
+    if not isinstance(operation, dict) or len(operation) != 1:
+        raise exceptions.InvalidBulkOperationError(
+            "Each operation must be an object with a single operation name."
+        )
+
+    [(name, arguments)] = operation.items()
+    if name not in BULK_OPERATIONS or not isinstance(arguments, dict):
+        raise exceptions.InvalidBulkOperationError(
+            f"Unknown bulk operation {name}. "
+            f"Supported operations: {', '.join(BULK_OPERATIONS)}."
+        )
+
+    operation_class, required, optional = BULK_OPERATIONS[name]
+    missing = [argument for argument in required if argument not in arguments]
+    if missing:
+        raise exceptions.InvalidBulkOperationError(
+            f"Missing {', '.join(missing)} for {name}."
+        )
+    for argument in required:
+        try:
+            BULK_ARGUMENT_VALIDATORS[argument](arguments[argument])
+        except (TypeError, ValueError) as e:
+            raise exceptions.InvalidBulkOperationError(f"Invalid {name}: {e}")
+    if name in ("updateMany", "deleteMany") and not arguments["filter"]:
+        raise exceptions.InvalidBulkOperationError(
+            f"{name} with an empty filter is not allowed."
+        )
+
+    args = [arguments[argument] for argument in required]
+    kwargs = {
+        argument: arguments[argument] for argument in optional if argument in arguments
+    }
+    try:
+        return operation_class(*args, **kwargs)
+    except (TypeError, ValueError) as e:
+        raise exceptions.InvalidBulkOperationError(str(e))
+
+
+# ===============================================
+# index management
+# ===============================================
+
+INDEX_KEY_TYPES = [
+    pymongo.ASCENDING,
+    pymongo.DESCENDING,
+    pymongo.TEXT,
+    pymongo.HASHED,
+    pymongo.GEOSPHERE,
+    pymongo.GEO2D,
+]
+INDEX_OPTIONS = [
+    "name",
+    "unique",
+    "sparse",
+    "expireAfterSeconds",
+    "partialFilterExpression",
+    "collation",
+    "hidden",
+]
+
+# query shapes seen by find_documents and count_collection when the advisor is enabled
+shape_recorder = advisor.ShapeRecorder(config.INDEX_ADVISOR_MAX_SHAPES)
+
+
+def parse_index_spec(spec: Any) -> Tuple[List[Tuple[str, Any]], Dict]:
+    """Parse an index spec like {"keys": {"name": 1, "thrust": -1}, "unique": true}.
+
+    keys may also be a list of [field, type] pairs.
+
+    Raises:
+        InvalidIndexSpecError: if the keys or options are not valid
+    """
+
+    if not isinstance(spec, dict) or not spec.get("keys"):
+        raise exceptions.InvalidIndexSpecError(
+            "An index must be an object with the index keys in keys."
+        )
+
+    keys = spec["keys"]
+    pairs = list(keys.items()) if isinstance(keys, dict) else keys
+    try:
+        index_keys = [(field, key_type) for field, key_type in pairs]
+    except (TypeError, ValueError):
+        raise exceptions.InvalidIndexSpecError(
+            "Index keys must be an object or a list of [field, type] pairs."
+        )
+
+    for field, key_type in index_keys:
+        if (
+            not isinstance(field, str)
+            or isinstance(key_type, bool)
+            or key_type not in INDEX_KEY_TYPES
+        ):
+            raise exceptions.InvalidIndexSpecError(
+                f"Invalid index key: {field}. Key types are {INDEX_KEY_TYPES}."
+            )
+
+    options = {key: value for key, value in spec.items() if key != "keys"}
+    unknown_options = [key for key in options if key not in INDEX_OPTIONS]
+    if unknown_options:
+        raise exceptions.InvalidIndexSpecError(
+            f"Unsupported index options: {unknown_options}."
+        )
+    return index_keys, options
+
+
+def list_collection_indexes(db: Database, collection_name: Any) -> List[Dict]:
+    db_collection = get_db_collection(db, collection_name)
+    return mongo.list_indexes(db_collection)
+
+
+def create_collection_index(db: Database, collection_name: Any, spec: Any) -> str:
+    """Creates an index on the specified collection. Returns its name."""
+
+    index_keys, options = parse_index_spec(spec)
+    db_collection = get_db_collection(db, collection_name)
+    return mongo.create_index(db_collection, index_keys, options)
+
+
+def drop_collection_index(db: Database, collection_name: Any, index_name: str) -> None:
+    if index_name == "_id_":
+        raise exceptions.ProtectedIndexError("The _id index cannot be dropped.")
+
+    db_collection = get_db_collection(db, collection_name)
+    if index_name not in [index["name"] for index in mongo.list_indexes(db_collection)]:
+        raise exceptions.IndexNotFoundError("Index not found.")
+    mongo.drop_index(db_collection, index_name)
+
+
+def record_query_shape(
+    collection_name: Any, query: Optional[Dict], sort_options: Optional[List]
+) -> None:
+    if config.INDEX_ADVISOR_ENABLED:
+        shape_recorder.record(collection_name, query, sort_options)
+
+
+def advise_indexes(
+    db: Database, collection_name: Any, top: Optional[int] = None
+) -> Dict[str, Any]:
+    """Explains the most frequent query shapes recorded for the specified collection.
+
+    Shapes whose winning plan scans the whole collection (COLLSCAN) or sorts
+    in memory (SORT) come with a suggested compound index.
+    """
+
+    db_collection = get_db_collection(db, collection_name)
+    shapes = shape_recorder.most_frequent(
+        collection_name, top or config.INDEX_ADVISOR_EXPLAIN_TOP
+    )
+
+    max_time_ms = resolve_max_time_ms(collection_name)
+    report = []
+    for shape, count, sample_query in shapes:
+        try:
+            explain = mongo.explain_query(
+                db_collection, sample_query, list(shape.sort) or None, max_time_ms
+            )
+        except ExecutionTimeout:
+            error = f"Explain exceeded {max_time_ms} ms."
+            report.append(shape_report(shape, count, sample_query, error=error))
+            continue
+        except OperationFailure as e:
+            report.append(shape_report(shape, count, sample_query, error=str(e)))
+            continue
+        report.append(shape_report(shape, count, sample_query, explain))
+
+    return advisor_report(report)
+
+
+def shape_report(
+    shape: advisor.QueryShape,
+    count: int,
+    sample_query: Dict,
+    explain: Optional[Dict] = None,
+    error: Optional[str] = None,
+) -> Dict[str, Any]:
+    """The advisor report entry of a query shape, from its explain output."""
+
+    entry: Dict[str, Any] = {
+        "filter": json.loads(shape.filter_shape),
+        "sort": [[key, direction] for key, direction in shape.sort],
+        "count": count,
+    }
+    if explain is None:
+        entry["error"] = error
+        return entry
+
+    stages = advisor.winning_plan_stages(explain)
+    entry["stages"] = stages
+    entry["collscan"] = "COLLSCAN" in stages
+    entry["in_memory_sort"] = "SORT" in stages
+    if entry["collscan"] or entry["in_memory_sort"]:
+        suggested_keys = advisor.suggest_index(sample_query, list(shape.sort) or None)
+        entry["suggested_index"] = [
+            [key, direction] for key, direction in suggested_keys
+        ] or None
+    return entry
+
+
+def advisor_report(entries: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        "enabled": config.INDEX_ADVISOR_ENABLED,
+        "dropped_shapes": shape_recorder.dropped,
+        "shapes": entries,
+    }
+
+
+# ===============================================
+# response cache
+# ===============================================
+
+
+def open_change_stream(collection_name: Any, resume_after: Optional[Dict] = None):
+    db_collection = get_db_collection(mongo.get_database(), collection_name)
+    return mongo.watch_collection(
+        db_collection, watch.PIPELINE, resume_after, watch.MAX_AWAIT_TIME_MS
+    )
+
+
+# serialized GET /api/<resource> responses of the resources with cache options
+response_cache = cache.create_response_cache(
+    "responses", config.RESPONSE_CACHE_MAX_BYTES, config.RESPONSE_CACHE_MAX_ENTRIES
+)
+cache_invalidator = watch.CacheInvalidator(
+    open_change_stream, response_cache.invalidate
+)
+
+
+def invalidates_responses(function: Callable) -> Callable:
+    """Decorator invalidating the cached responses of the collection written by a
+    service, once it returns or fails (a bulk write may fail halfway).
+    The collection name is the second argument of the service.
+    """
+
+    @functools.wraps(function)
+    def wrapper(db: Any, collection_name: Any, *args, **kwargs):
+        try:
+            return function(db, collection_name, *args, **kwargs)
+        finally:
+            response_cache.invalidate(collection_name)
+
+    return wrapper
+
+
+def response_cache_key(
+    collection_name: Any,
+    query_params: Any,
+    projection: Optional[str],
+    sort: Optional[str],
+    limit: Optional[str],
+    skip: Optional[str],
+    after: Optional[str],
+    count: bool,
+) -> Optional[Tuple]:
+    """The key of a GET /api/<resource> response in response_cache, normalized like
+    map_to_query_operator. None if the response must not be cached: the resource
+    has no cache options, or the change stream invalidating it is not open yet.
+    """
+
+    options = get_collection_options(collection_name)
+    if not response_cache.max_bytes or not options.cached:
+        return None
+    if options.cache_watch and not cache_invalidator.watching(collection_name):
+        return None
+
+    projection_fields = tuple(sorted(split_fields(projection))) if projection else None
+    return (
+        collection_name,
+        tuple(sorted(query_params.items())),
+        projection_fields,
+        sort,
+        limit,
+        skip,
+        after,
+        count,
+    )
+
+
+def cache_response(
+    cache_key: Tuple, generation: int, body: bytes, headers: List[Tuple[str, str]]
+) -> bool:
+    """Store a response read at the given generation of response_cache."""
+
+    collection_name = cache_key[0]
+    return response_cache.set(
+        collection_name,
+        cache_key,
+        cache.CachedResponse(body, headers),
+        generation,
+        get_collection_options(collection_name).cache_ttl,
+    )
 
 
 # ===============================================
@@ -195,6 +918,180 @@ def parse_sort(sort: str) -> Any:
 # ===============================================
 
 
+class FindOptions(NamedTuple):
+    """Arguments of a find, as passed to mongo.query_collection."""
+
+    query: Optional[Dict]
+    projection: Optional[Dict]
+    sort: Optional[List[Tuple[str, int]]]
+    limit: int
+    skip: int
+    max_time_ms: Optional[int]
+
+
+def prepare_find(
+    collection_name: Any,
+    query: Optional[Dict],
+    projection: Optional[str],
+    sort: Optional[str],
+    limit: Optional[str],
+    skip: Optional[str],
+    after: Optional[str] = None,
+    max_time_ms: Optional[str] = None,
+) -> FindOptions:
+    """Turns the query string modifiers into the arguments of a find.
+
+    When after is given (an empty string for the first page), results are
+    ordered by the sort keys plus _id and start after the page token.
+    """
+
+    projection_spec = resolve_projection(projection)
+    sort_options = list(parse_sort(sort)) if sort else None
+    limit_count = resolve_limit(collection_name, limit)
+    skip_value = resolve_skip(skip)
+
+    if after is not None:
+        sort_options = pagination.sort_spec(sort_options)
+
+    # recorded before adding the page filter, which only differs from page to page
+    record_query_shape(collection_name, query, sort_options)
+
+    if after:
+        values = pagination.decode_token(after, sort_options)
+        query = pagination.combine_filters(
+            query, pagination.keyset_filter(sort_options, values)
+        )
+    if after is not None and projection_spec:
+        projection_spec, _ = pagination.project_sort_keys(projection_spec, sort_options)
+        # left empty when only sort keys were excluded, ie. all the fields are needed
+        projection_spec = projection_spec or None
+
+    return FindOptions(
+        query,
+        projection_spec,
+        sort_options,
+        limit_count,
+        skip_value,
+        resolve_max_time_ms(collection_name, max_time_ms),
+    )
+
+
+class PageBuilder:
+    """Encodes the documents of a page to JSON as they are pulled from the cursor.
+
+    The response size cap is counted on the encoded documents. When paginating
+    with after, the page ends at the last document that fits and its page token
+    points after it; otherwise, or if not even one document fits, going over the
+    cap raises ResponseTooLargeError.
+    Sort keys that were only projected to build the page token are removed
+    before encoding. The documents themselves are only kept with keep_documents.
+    """
+
+    def __init__(
+        self,
+        collection_name: Any,
+        projection: Optional[str],
+        sort: Optional[str],
+        limit: Optional[str],
+        after: Optional[str] = None,
+        sort_keys: bool = True,
+        keep_documents: bool = False,
+    ) -> None:
+        self.keep_documents = keep_documents
+        self.max_bytes = get_response_max_bytes(collection_name)
+        self.limit_count = resolve_limit(collection_name, limit)
+        self.spec: Optional[List[Tuple[str, int]]] = None
+        self.hidden_paths: List[str] = []
+        if after is not None:
+            self.spec = pagination.sort_spec(parse_sort(sort) if sort else None)
+            if projection:
+                _, self.hidden_paths = pagination.project_sort_keys(
+                    parse_projection(projection), self.spec
+                )
+
+        self.json_encoder = encoder.MangoJSONEncoder(
+            separators=(",", ":"), sort_keys=sort_keys
+        )
+        self.documents: List[Dict] = []
+        self.encoded: List[str] = []
+        self.count = 0
+        self.size = len("[]\n")
+        self.last_values: Optional[List[Any]] = None
+        self.cut_off = False
+
+    def add(self, document: Dict) -> bool:
+        """Add a document to the page. Returns False if it did not fit.
+
+        Raises:
+            ResponseTooLargeError: if the document does not fit and the page has no token
+        """
+
+        values = pagination.sort_values(document, self.spec) if self.spec else None
+        for path in self.hidden_paths:
+            pagination.remove_path(document, path)
+
+        encoded = self.json_encoder.encode(document)
+        size = self.size + len(encoded) + (1 if self.encoded else 0)
+        if self.max_bytes and size > self.max_bytes:
+            if self.spec is None or not self.count:
+                raise exceptions.ResponseTooLargeError(
+                    f"Response exceeds the maximum of {self.max_bytes} bytes. "
+                    "Use _limit and _after to paginate."
+                )
+            logger.info("Page cut off at %s bytes.", self.max_bytes)
+            self.cut_off = True
+            return False
+
+        self.size = size
+        self.count += 1
+        if self.keep_documents:
+            self.documents.append(document)
+        self.encoded.append(encoded)
+        self.last_values = values
+        return True
+
+    def body(self) -> str:
+        """The page as a JSON array."""
+
+        return "[" + ",".join(self.encoded) + "]\n"
+
+    def next_token(self) -> Optional[str]:
+        """The page token for the next page, when paginating with after and the
+        page is full (or was cut off at the size cap).
+        """
+
+        if self.spec is None or self.last_values is None:
+            return None
+        full = self.limit_count and self.count >= self.limit_count
+        if not (full or self.cut_off):
+            return None
+        return pagination.encode_token(self.last_values, self.spec)
+
+
+def find_documents(
+    db: Database,
+    collection_name: Any,
+    query: Optional[Dict],
+    projection: Optional[str],
+    sort: Optional[str],
+    limit: Optional[str],
+    skip: Optional[str],
+    after: Optional[str] = None,
+    max_time_ms: Optional[str] = None,
+) -> Cursor:
+    """Returns a cursor over the documents of the specified collection.
+
+    Documents are only pulled from MongoDB as the cursor is iterated.
+    See prepare_find for the arguments.
+    """
+
+    options = prepare_find(
+        collection_name, query, projection, sort, limit, skip, after, max_time_ms
+    )
+    db_collection = get_db_collection(db, collection_name)
+    return mongo.query_collection(db_collection, *options)
+
+
 def fetch_collection(
     db: Database,
     collection_name: Any,
@@ -203,59 +1100,389 @@ def fetch_collection(
     sort: Optional[str],
     limit: Optional[str],
     skip: Optional[str],
+    after: Optional[str] = None,
+    max_time_ms: Optional[str] = None,
 ) -> List[Dict]:
     """Fetches documents of the specified collection."""
 
-    response_fields = projection.split(",") if projection else None
-    sort_options = parse_sort(sort) if sort else None
-    limit_count = int(limit) if limit else 0
-    skip_value = int(skip) if skip else 0
-
-    db_collection = db[collection_name]
-    query_result = mongo.query_collection(
-        db_collection, query, response_fields, sort_options, limit_count, skip_value
+    documents, _ = fetch_collection_page(
+        db, collection_name, query, projection, sort, limit, skip, after, max_time_ms
     )
-    documents = [parse_object_id(item) for item in query_result]
     return documents
 
 
+def fetch_page(
+    db: Database,
+    collection_name: Any,
+    query: Optional[Dict],
+    projection: Optional[str],
+    sort: Optional[str],
+    limit: Optional[str],
+    skip: Optional[str],
+    after: Optional[str] = None,
+    max_time_ms: Optional[str] = None,
+    sort_keys: bool = True,
+    keep_documents: bool = False,
+) -> PageBuilder:
+    """Fetches a page of documents of the specified collection, encoded to JSON as
+    they come. See PageBuilder for the response size cap and the page token.
+
+    Raises:
+        ResponseTooLargeError: if the documents go over the response size cap
+    """
+
+    query_result = find_documents(
+        db, collection_name, query, projection, sort, limit, skip, after, max_time_ms
+    )
+    page = PageBuilder(
+        collection_name, projection, sort, limit, after, sort_keys, keep_documents
+    )
+    for document in query_result:
+        if not page.add(document):
+            query_result.close()
+            break
+    return page
+
+
+def fetch_collection_page(
+    db: Database,
+    collection_name: Any,
+    query: Optional[Dict],
+    projection: Optional[str],
+    sort: Optional[str],
+    limit: Optional[str],
+    skip: Optional[str],
+    after: Optional[str] = None,
+    max_time_ms: Optional[str] = None,
+) -> Tuple[List[Dict], Optional[str]]:
+    """Fetches a page of documents of the specified collection.
+
+    Returns:
+        Tuple of the documents and the page token for the next page. The token is
+        only given when paginating with after and the page is full.
+
+    Raises:
+        ResponseTooLargeError: if the documents go over the response size cap
+    """
+
+    page = fetch_page(
+        db,
+        collection_name,
+        query,
+        projection,
+        sort,
+        limit,
+        skip,
+        after,
+        max_time_ms,
+        keep_documents=True,
+    )
+    return page.documents, page.next_token()
+
+
+def count_collection(
+    db: Database,
+    collection_name: Any,
+    query: Optional[Dict],
+    max_time_ms: Optional[str] = None,
+) -> int:
+    """Counts the documents of the specified collection matching query."""
+
+    if query:
+        # an empty query is counted from the collection metadata
+        record_query_shape(collection_name, query, None)
+
+    db_collection = get_db_collection(db, collection_name)
+    time_limit = resolve_max_time_ms(collection_name, max_time_ms)
+    return mongo.count_documents(db_collection, query, time_limit)
+
+
+def aggregate_collection(
+    db: Database,
+    collection_name: Any,
+    pipeline: Any,
+    allow_disk_use: bool = False,
+    max_time_ms: Optional[int] = None,
+) -> CommandCursor:
+    """Runs an aggregation pipeline on the specified collection.
+
+    allowDiskUse is only passed on if enabled in the config, and maxTimeMS is
+    capped to the configured maximum.
+    """
+
+    validated_pipeline = validate_pipeline(pipeline)
+    db_collection = get_db_collection(db, collection_name)
+    return mongo.aggregate(
+        db_collection,
+        validated_pipeline,
+        allow_disk_use=bool(allow_disk_use) and config.AGGREGATE_ALLOW_DISK_USE,
+        max_time_ms=aggregate_time_limit(collection_name, max_time_ms),
+    )
+
+
+def aggregate_time_limit(
+    collection_name: Any, max_time_ms: Optional[int] = None
+) -> Optional[int]:
+    resource_max_time_ms = get_collection_options(collection_name).max_time_ms
+    time_limit = int(
+        max_time_ms or resource_max_time_ms or config.AGGREGATE_MAX_TIME_MS or 0
+    )
+    if config.AGGREGATE_MAX_TIME_MS:
+        time_limit = min(time_limit, config.AGGREGATE_MAX_TIME_MS)
+    return time_limit or None
+
+
+def watch_collection(
+    db: Database,
+    collection_name: Any,
+    query: Optional[Dict],
+    resume_after: Optional[str] = None,
+) -> Iterator[str]:
+    """Subscribes to the changes of the specified collection matching query.
+
+    Changes after the event id resume_after are sent first. The change streams
+    are opened here, so that errors are raised before the response is started.
+
+    Returns:
+        Iterator of Server-Sent Events, ending when the change stream is closed.
+
+    Raises:
+        UnsupportedWatchFilterError: if the query can't be matched against changes
+        InvalidResumeTokenError: if resume_after is malformed
+        OperationFailure: eg. if the deployment is not a replica set
+    """
+
+    query = query or {}
+    watch.check_filter(query)
+    resume_token = watch.decode_token(resume_after) if resume_after else None
+
+    hub = watch.get_hub(open_change_stream)
+    subscription = watch.Subscription(query, config.WATCH_MAX_PENDING_EVENTS)
+    hub.subscribe(collection_name, subscription)
+    catch_up_stream = None
+    try:
+        if resume_token is not None:
+            catch_up_stream = open_change_stream(collection_name, resume_token)
+    except Exception:
+        hub.unsubscribe(collection_name, subscription)
+        raise
+
+    return watch.iter_events(
+        hub,
+        collection_name,
+        subscription,
+        catch_up_stream,
+        resume_token,
+        config.WATCH_KEEPALIVE_SECONDS,
+    )
+
+
+@invalidates_responses
 def create_document(db: Database, collection_name: Any, document_obj: Any):
     """Inserts a single or multiple  documents. Returns the objectid."""
 
-    db_collection = db[collection_name]
+    db_collection = get_db_collection(db, collection_name)
 
     if type(document_obj) is dict:
         document_oid = mongo.insert_single_document(db_collection, document_obj)
-        return parse_object_id(document_oid)
+        return {"_id": document_oid}
     elif type(document_obj) is list:
         document_oids = mongo.insert_multiple_documents(db_collection, document_obj)
-        return [parse_object_id(item) for item in document_oids]
+        return [{"_id": item} for item in document_oids]
+
+
+class BulkWriteReport:
+    """Adds up the results of the chunks of a bulk write."""
+
+    def __init__(self) -> None:
+        self.totals = {
+            "inserted": 0,
+            "matched": 0,
+            "modified": 0,
+            "deleted": 0,
+            "upserted": 0,
+        }
+        self.chunks: List[Dict] = []
+        self.errors: List[Dict] = []
+
+    def parse_chunk(self, chunk: List[ndjson.Record]) -> Tuple[List[Any], List[int]]:
+        """Parses the operations of a chunk, recording the ones that are not valid.
+
+        Returns:
+            Tuple of the operations to send and their index in the stream.
+        """
+
+        operations = []
+        indexes = []
+        for record in chunk:
+            try:
+                if record.error:
+                    raise exceptions.InvalidBulkOperationError(record.error)
+                operations.append(parse_bulk_operation(record.value))
+                indexes.append(record.index)
+            except exceptions.InvalidBulkOperationError as e:
+                self.errors.append({"index": record.index, "message": str(e)})
+        return operations, indexes
+
+    def add_chunk(
+        self, chunk: List[ndjson.Record], indexes: List[int], result: Dict
+    ) -> None:
+        """Records the raw bulk write result of the operations sent for a chunk."""
+
+        chunk_result = {
+            "inserted": result.get("nInserted", 0),
+            "matched": result.get("nMatched", 0),
+            "modified": result.get("nModified", 0),
+            "deleted": result.get("nRemoved", 0),
+            "upserted": result.get("nUpserted", 0),
+        }
+        write_errors = result.get("writeErrors", [])
+        for write_error in write_errors:
+            self.errors.append(
+                {
+                    "index": indexes[write_error["index"]],
+                    "code": write_error.get("code"),
+                    "message": write_error.get("errmsg"),
+                }
+            )
+
+        for key, value in chunk_result.items():
+            self.totals[key] += value
+        self.chunks.append(
+            {
+                **chunk_result,
+                "operations": len(chunk),
+                "errors": len(chunk) - len(indexes) + len(write_errors),
+            }
+        )
+
+    def result(self) -> Dict[str, Any]:
+        return {**self.totals, "chunks": self.chunks, "errors": self.errors}
+
+
+@invalidates_responses
+def bulk_write_documents(
+    db: Database,
+    collection_name: Any,
+    records: Iterable[ndjson.Record],
+    chunk_size: int,
+) -> Dict[str, Any]:
+    """Runs a stream of bulk operations in unordered chunks of chunk_size.
+
+    Operations that can't be parsed are reported as errors without being sent,
+    and the rest still run.
+
+    Returns:
+        Dict of the total counts, the counts of each chunk and the errors of
+        the failed operations, identified by their index in the stream.
+    """
+
+    db_collection = get_db_collection(db, collection_name)
+    report = BulkWriteReport()
+
+    for chunk in ndjson.batched(records, chunk_size):
+        operations, indexes = report.parse_chunk(chunk)
+        result = {}
+        if operations:
+            result = mongo.bulk_write_operations(db_collection, operations)
+        report.add_chunk(chunk, indexes, result)
+
+    return report.result()
+
+
+def to_insert_operation(record: ndjson.Record) -> ndjson.Record:
+    """Turns an NDJSON document into an insertOne bulk operation."""
+
+    if record.error:
+        return record
+    if not isinstance(record.value, dict):
+        return record._replace(value=None, error="Each line must be a JSON object.")
+    return record._replace(value={"insertOne": {"document": record.value}})
+
+
+def ingest_report(result: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "inserted": result["inserted"],
+        "batches": len(result["chunks"]),
+        "errors": result["errors"],
+    }
+
+
+def ingest_documents(
+    db: Database,
+    collection_name: Any,
+    records: Iterable[ndjson.Record],
+    batch_size: int,
+) -> Dict[str, Any]:
+    """Inserts a stream of documents in batches of batch_size as they are read.
+
+    Only one batch is held in memory at a time. Lines that are not JSON objects
+    and documents that fail to insert are reported as errors without stopping the rest.
+
+    Returns:
+        Dict of the number of inserted documents, the number of batches and the errors.
+    """
+
+    operations = (to_insert_operation(record) for record in records)
+    result = bulk_write_documents(db, collection_name, operations, batch_size)
+    return ingest_report(result)
 
 
 def fetch_document(db: Database, collection_name: Any, oid: str) -> Dict:
     """Fetches the document with the given objectid."""
 
-    db_collection = db[collection_name]
-    query_result = mongo.query_document(db_collection, oid)
+    db_collection = get_db_collection(db, collection_name)
+    max_time_ms = resolve_max_time_ms(collection_name)
+    query_result = mongo.query_document(db_collection, oid, max_time_ms=max_time_ms)
 
     if query_result is None:
         raise exceptions.DocumentNotFoundError(
             f"Document with ObjectId {oid} not found."
         )
 
-    parsed_document = parse_object_id(query_result)
-    return parsed_document
+    return query_result
 
 
+def fetch_document_version(
+    db: Database, collection_name: Any, oid: str, version_field: str
+) -> Any:
+    """Fetches only the version field of the document with the given objectid.
+
+    Returns None if the document has no version field.
+    """
+
+    db_collection = get_db_collection(db, collection_name)
+    max_time_ms = resolve_max_time_ms(collection_name)
+    query_result = mongo.query_document(
+        db_collection, oid, [version_field], max_time_ms
+    )
+
+    if query_result is None:
+        raise exceptions.DocumentNotFoundError(
+            f"Document with ObjectId {oid} not found."
+        )
+
+    version = pagination.get_path(query_result, version_field)
+    return None if version is pagination.MISSING else version
+
+
+def document_etag(oid: Any, version: Any) -> str:
+    """Entity tag of a document derived from its objectid and version field value."""
+
+    version_key = f"{oid}:{encoder.dumps(version, sort_keys=True)}"
+    return hashlib.sha1(version_key.encode("UTF-8")).hexdigest()
+
+
+@invalidates_responses
 def update_document(
     db: Database, collection_name: Any, oid: str, document_obj: Any
 ) -> bool:
     """Updates a single document with the given objectid."""
 
-    db_collection = db[collection_name]
-    update_result = mongo.update_single_document(db_collection, oid, document_obj)
+    db_collection = get_db_collection(db, collection_name)
+    matched_count = mongo.update_single_document(db_collection, oid, document_obj)
 
-    if update_result is None:
+    if not matched_count:
         raise exceptions.DocumentNotFoundError(
             f"No UPDATE performed. Document with ObjectId {oid} not found."
         )
@@ -263,6 +1490,45 @@ def update_document(
     return True
 
 
+def check_return_option(return_document: str, deleting: bool = False) -> None:
+    if deleting and return_document != "before":
+        raise exceptions.InvalidReturnOptionError(
+            "_return must be before when deleting."
+        )
+    if return_document not in ("before", "after"):
+        raise exceptions.InvalidReturnOptionError(
+            "_return must be either before or after."
+        )
+
+
+@invalidates_responses
+def update_and_fetch_document(
+    db: Database,
+    collection_name: Any,
+    oid: str,
+    document_obj: Any,
+    return_document: str,
+    projection: Optional[str] = None,
+) -> Dict:
+    """Updates a single document and returns it as it was "before" or "after" the update."""
+
+    check_return_option(return_document)
+
+    db_collection = get_db_collection(db, collection_name)
+    response_fields = resolve_projection(projection)
+    document = mongo.find_and_update_single_document(
+        db_collection, oid, document_obj, return_document == "after", response_fields
+    )
+
+    if document is None:
+        raise exceptions.DocumentNotFoundError(
+            f"No UPDATE performed. Document with ObjectId {oid} not found."
+        )
+
+    return document
+
+
+@invalidates_responses
 def update_many_documents(
     db: Database, collection_name: Any, query: Dict, changes: Dict
 ) -> Tuple[int, int]:
@@ -274,7 +1540,7 @@ def update_many_documents(
     Raises:
         EmptyQueryFatalActionError: if query is empty
     """
-    db_collection = db[collection_name]
+    db_collection = get_db_collection(db, collection_name)
     if not query:
         raise exceptions.EmptyQueryFatalActionError(
             "Updating aborted. Updates with empty query are not allowed."
@@ -284,13 +1550,14 @@ def update_many_documents(
     return result
 
 
+@invalidates_responses
 def delete_document(db: Database, collection_name: Any, oid: str) -> bool:
     """Deletes a single document with the given objectid."""
 
-    db_collection = db[collection_name]
-    delete_result = mongo.delete_single_document(db_collection, oid)
+    db_collection = get_db_collection(db, collection_name)
+    deleted_count = mongo.delete_single_document(db_collection, oid)
 
-    if delete_result is None:
+    if not deleted_count:
         raise exceptions.DocumentNotFoundError(
             f"No DELETE performed. Document with ObjectId {oid} not found."
         )
@@ -298,6 +1565,33 @@ def delete_document(db: Database, collection_name: Any, oid: str) -> bool:
     return True
 
 
+@invalidates_responses
+def delete_and_fetch_document(
+    db: Database,
+    collection_name: Any,
+    oid: str,
+    return_document: str,
+    projection: Optional[str] = None,
+) -> Dict:
+    """Deletes a single document and returns it as it was "before" the delete."""
+
+    check_return_option(return_document, deleting=True)
+
+    db_collection = get_db_collection(db, collection_name)
+    response_fields = resolve_projection(projection)
+    document = mongo.find_and_delete_single_document(
+        db_collection, oid, response_fields
+    )
+
+    if document is None:
+        raise exceptions.DocumentNotFoundError(
+            f"No DELETE performed. Document with ObjectId {oid} not found."
+        )
+
+    return document
+
+
+@invalidates_responses
 def delete_many_documents(db: Database, collection_name: Any, query: Dict) -> int:
     """Deletes multiple documents.
 
@@ -307,7 +1601,7 @@ def delete_many_documents(db: Database, collection_name: Any, query: Dict) -> in
     Raises:
         EmptyQueryFatalActionError: if query is empty
     """
-    db_collection = db[collection_name]
+    db_collection = get_db_collection(db, collection_name)
     if not query:
         raise exceptions.EmptyQueryFatalActionError(
             "Deleting aborted. Deletes with empty query are not allowed."
@@ -0,0 +1,407 @@
+"""A cache segment in a memory-mapped file, shared by the worker processes of a host.
+
+The file holds a header, per-worker counters, namespace generations, an index
+and a data region:
+
+- The index is set associative: a key (a 16 bytes digest) belongs to a bucket
+  of WAYS entries, and storing in a full bucket evicts its least recently used
+  entry.
+- Values are appended to the data region, used as a ring buffer. An entry
+  whose value has been overwritten since is a miss.
+- Invalidating a namespace bumps its generation. Entries stored at an older
+  generation are misses.
+
+Every operation holds an exclusive flock on the file, so evictions and updates
+are atomic across processes without an external service. flock does not
+exclude the threads of a process, so a thread lock is held too. Only POSIX
+systems are supported.
+"""
+
+import contextlib
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"MANGOSHM"
+VERSION = 1
+WAYS = 8
+NAMESPACE_SLOTS = 1024
+WORKER_SLOTS = 256
+
+# magic, version, buckets, data size
+HEADER = struct.Struct("<8sIIQ")
+# epoch, write position, LRU clock, hits, misses, evictions, invalidations
+STATE = struct.Struct("<QQQQQQQ")
+STATE_OFFSET = HEADER.size
+HEADER_SIZE = 128
+# pid, hits, misses
+WORKER = struct.Struct("<qQQ")
+# namespace digest, generation
+NAMESPACE = struct.Struct("<16sQ")
+# key digest, epoch, namespace slot, namespace generation, expires at, last used,
+# position of the value in the data region (not wrapped), length of the value
+ENTRY = struct.Struct("<16sQiQdQQI")
+
+EMPTY_DIGEST = bytes(16)
+
+
+def digest(key: Any) -> bytes:
+    """The digest of a key made of strings, numbers, None, and tuples of them."""
+
+    return hashlib.blake2b(repr(key).encode("UTF-8"), digest_size=16).digest()
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Segment:
+    """A LRU cache of bytes values in the file at path.
+
+    The file is created if needed, and recreated if it has another layout.
+    Each process maps it the first time it uses the segment, so a segment
+    created before a fork is shared by the forked workers.
+    """
+
+    def __init__(self, path: str, entries: int, data_size: int) -> None:
+        if fcntl is None:  # pragma: no cover
+            raise RuntimeError("Shared caches need a POSIX system (fcntl).")
+
+        self.path = path
+        self.buckets = max(1, -(-entries // WAYS))
+        self.data_size = data_size
+        self.workers_offset = HEADER_SIZE
+        self.namespaces_offset = self.workers_offset + WORKER_SLOTS * WORKER.size
+        self.index_offset = self.namespaces_offset + NAMESPACE_SLOTS * NAMESPACE.size
+        self.data_offset = self.index_offset + self.buckets * WAYS * ENTRY.size
+        self.size = self.data_offset + data_size
+
+        self._fd = -1
+        self._map: Optional[mmap.mmap] = None
+        self._pid: Optional[int] = None
+        self._worker_slot = -1
+        self._lock = threading.Lock()
+
+    # ===============================================
+    # file
+    # ===============================================
+
+    def _open(self) -> None:
+        if self._map is not None:
+            # inherited from the parent process
+            self._map.close()
+            os.close(self._fd)
+
+        # the segment may be in a directory shared with other users: don't
+        # follow a planted symlink, nor use (and truncate) a file of theirs
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        if os.fstat(fd).st_uid != os.getuid():
+            os.close(fd)
+            raise PermissionError(
+                f"The shared cache segment {self.path} is owned by another user."
+            )
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            header = HEADER.pack(MAGIC, VERSION, self.buckets, self.data_size)
+            if (
+                os.fstat(fd).st_size != self.size
+                or os.pread(fd, HEADER.size, 0) != header
+            ):
+                logger.info("Creating the shared cache segment %s.", self.path)
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+                os.pwrite(fd, header + STATE.pack(1, 0, 0, 0, 0, 0, 0), 0)
+            self._map = mmap.mmap(fd, self.size)
+            self._fd = fd
+            self._pid = os.getpid()
+            self._worker_slot = self._claim_worker_slot()
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _claim_worker_slot(self) -> int:
+        pid = os.getpid()
+        free_slot = -1
+        for slot in range(WORKER_SLOTS):
+            slot_pid, _, _ = WORKER.unpack_from(self._map, self._worker_offset(slot))
+            if slot_pid == pid:
+                return slot
+            if free_slot < 0 and (slot_pid == 0 or not pid_alive(slot_pid)):
+                free_slot = slot
+        if free_slot >= 0:
+            WORKER.pack_into(self._map, self._worker_offset(free_slot), pid, 0, 0)
+        return free_slot
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[List[int]]:
+        """Holds the segment for the calling thread. Yields the mutable state,
+        written back on exit.
+        """
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                state = list(STATE.unpack_from(self._map, STATE_OFFSET))
+                yield state
+                STATE.pack_into(self._map, STATE_OFFSET, *state)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    # ===============================================
+    # layout
+    # ===============================================
+
+    def _worker_offset(self, slot: int) -> int:
+        return self.workers_offset + slot * WORKER.size
+
+    def _namespace_offset(self, slot: int) -> int:
+        return self.namespaces_offset + slot * NAMESPACE.size
+
+    def _entry_offsets(self, key_digest: bytes) -> range:
+        bucket = int.from_bytes(key_digest[:8], "little") % self.buckets
+        start = self.index_offset + bucket * WAYS * ENTRY.size
+        return range(start, start + WAYS * ENTRY.size, ENTRY.size)
+
+    def _namespace_slot(self, namespace_digest: bytes, create: bool) -> int:
+        start = int.from_bytes(namespace_digest[:8], "little") % NAMESPACE_SLOTS
+        for probe in range(NAMESPACE_SLOTS):
+            slot = (start + probe) % NAMESPACE_SLOTS
+            slot_digest, _ = NAMESPACE.unpack_from(
+                self._map, self._namespace_offset(slot)
+            )
+            if slot_digest == namespace_digest:
+                return slot
+            if slot_digest == EMPTY_DIGEST:
+                if create:
+                    NAMESPACE.pack_into(
+                        self._map, self._namespace_offset(slot), namespace_digest, 0
+                    )
+                    return slot
+                return -1
+        return -1
+
+    def _namespace_generation(self, slot: int) -> int:
+        if slot < 0:
+            return 0
+        return NAMESPACE.unpack_from(self._map, self._namespace_offset(slot))[1]
+
+    def _is_live(self, entry: Tuple, state: List[int], now: float) -> bool:
+        _, epoch, namespace_slot, generation, expires_at, _, start, _ = entry
+        return (
+            epoch == state[0]
+            and (not expires_at or expires_at > now)
+            and state[1] - start <= self.data_size
+            and (
+                namespace_slot < 0
+                or self._namespace_generation(namespace_slot) == generation
+            )
+        )
+
+    def _read(self, start: int, length: int) -> bytes:
+        """Read a value of the data region, wrapping around its end."""
+
+        data_offset = self.data_offset
+        position = start % self.data_size
+        first = min(length, self.data_size - position)
+        head_start = data_offset + position
+        head_end = head_start + first
+        tail_end = data_offset + length - first
+        return self._map[head_start:head_end] + self._map[data_offset:tail_end]
+
+    def _write(self, start: int, value: bytes) -> None:
+        data_offset = self.data_offset
+        position = start % self.data_size
+        first = min(len(value), self.data_size - position)
+        head_start = data_offset + position
+        head_end = head_start + first
+        tail_end = data_offset + len(value) - first
+        self._map[head_start:head_end] = value[:first]
+        self._map[data_offset:tail_end] = value[first:]
+
+    def _count(self, state: List[int], hit: bool) -> None:
+        state[3 if hit else 4] += 1
+        if self._worker_slot >= 0:
+            offset = self._worker_offset(self._worker_slot)
+            pid, hits, misses = WORKER.unpack_from(self._map, offset)
+            if hit:
+                hits += 1
+            else:
+                misses += 1
+            WORKER.pack_into(self._map, offset, pid, hits, misses)
+
+    # ===============================================
+    # operations
+    # ===============================================
+
+    def get(self, key_digest: bytes) -> Optional[bytes]:
+        now = time.time()
+        with self._locked() as state:
+            for offset in self._entry_offsets(key_digest):
+                entry = ENTRY.unpack_from(self._map, offset)
+                if entry[0] != key_digest or entry[1] != state[0]:
+                    continue
+                if not self._is_live(entry, state, now):
+                    break
+
+                value = self._read(entry[6], entry[7])
+                state[2] += 1
+                ENTRY.pack_into(self._map, offset, *entry[:5], state[2], *entry[6:])
+                self._count(state, hit=True)
+                return value
+
+            self._count(state, hit=False)
+            return None
+
+    def set(
+        self,
+        key_digest: bytes,
+        value: bytes,
+        ttl: Optional[float] = None,
+        namespace_digest: Optional[bytes] = None,
+        generation: Optional[int] = None,
+    ) -> bool:
+        """Store a value. With a namespace, only if its generation is still the given one.
+
+        Values over a quarter of the data region are not stored.
+        """
+
+        if len(value) > self.data_size // 4:
+            return False
+
+        now = time.time()
+        with self._locked() as state:
+            namespace_slot = -1
+            namespace_generation = 0
+            if namespace_digest is not None:
+                namespace_slot = self._namespace_slot(namespace_digest, create=True)
+                if namespace_slot < 0:
+                    return False
+                namespace_generation = self._namespace_generation(namespace_slot)
+                if generation is not None and generation != namespace_generation:
+                    return False
+
+            target = None
+            least_recently_used = None
+            for offset in self._entry_offsets(key_digest):
+                entry = ENTRY.unpack_from(self._map, offset)
+                if entry[0] == key_digest or not self._is_live(entry, state, now):
+                    target = offset
+                    if entry[0] == key_digest:
+                        break
+                elif (
+                    least_recently_used is None or entry[5] < least_recently_used[1][5]
+                ):
+                    least_recently_used = (offset, entry)
+            if target is None:
+                target = least_recently_used[0]  # type: ignore
+                state[5] += 1
+
+            start = state[1]
+            self._write(start, value)
+            state[1] += len(value)
+            state[2] += 1
+            ENTRY.pack_into(
+                self._map,
+                target,
+                key_digest,
+                state[0],
+                namespace_slot,
+                namespace_generation,
+                now + ttl if ttl else 0.0,
+                state[2],
+                start,
+                len(value),
+            )
+            return True
+
+    def delete(self, key_digest: bytes) -> None:
+        with self._locked() as state:
+            for offset in self._entry_offsets(key_digest):
+                entry = ENTRY.unpack_from(self._map, offset)
+                if entry[0] == key_digest and entry[1] == state[0]:
+                    ENTRY.pack_into(self._map, offset, entry[0], 0, *entry[2:])
+
+    def generation(self, namespace_digest: bytes) -> int:
+        with self._locked():
+            slot = self._namespace_slot(namespace_digest, create=False)
+            return self._namespace_generation(slot)
+
+    def invalidate(self, namespace_digest: bytes) -> None:
+        """Drop the entries of a namespace, everything if there are too many namespaces."""
+
+        with self._locked() as state:
+            state[6] += 1
+            slot = self._namespace_slot(namespace_digest, create=True)
+            if slot < 0:
+                state[0] += 1
+                return
+            generation = self._namespace_generation(slot) + 1
+            NAMESPACE.pack_into(
+                self._map, self._namespace_offset(slot), namespace_digest, generation
+            )
+
+    def clear(self) -> None:
+        with self._locked() as state:
+            # entries of older epochs are misses
+            state[0] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters of the whole segment, and of each worker process using it."""
+
+        now = time.time()
+        with self._locked() as state:
+            entries = 0
+            for offset in range(self.index_offset, self.data_offset, ENTRY.size):
+                if self._is_live(ENTRY.unpack_from(self._map, offset), state, now):
+                    entries += 1
+
+            workers = []
+            for slot in range(WORKER_SLOTS):
+                pid, hits, misses = WORKER.unpack_from(
+                    self._map, self._worker_offset(slot)
+                )
+                if pid and pid_alive(pid):
+                    workers.append(
+                        {
+                            "pid": pid,
+                            "hits": hits,
+                            "misses": misses,
+                            "hit_rate": hits / (hits + misses)
+                            if hits + misses
+                            else 0.0,
+                        }
+                    )
+
+            hits, misses = state[3], state[4]
+            return {
+                "path": self.path,
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+                "entries": entries,
+                "max_entries": self.buckets * WAYS,
+                "max_bytes": self.data_size,
+                "evictions": state[5],
+                "invalidations": state[6],
+                "worker": os.getpid(),
+                "workers": workers,
+            }
@@ -0,0 +1,300 @@
+"""Slow query log.
+
+MongoDB commands that take longer than SLOW_QUERY_THRESHOLD_MS are logged as one
+JSON object per line on the `mangorest.slowlog` logger, with the resource and the
+shape of the filter, sort and projection (values taken out, see mangorest.advisor).
+A cursor is timed over its whole life, ie. the find or aggregate plus its getMores.
+
+A sample of the slow reads is explained (executionStats) in a background thread
+to add the number of documents and index keys examined and the plan stages.
+Explaining runs the query again, so keep the sample rate low. At most
+SLOW_QUERY_EXPLAIN_QUEUE_DEPTH explains wait for the thread, the slow queries
+sampled beyond that are logged without one.
+"""
+
+import concurrent.futures
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from flask import has_request_context, request
+from pymongo import monitoring
+
+from mangorest import advisor, config, metrics
+
+logger = logging.getLogger(__name__)
+
+# commands that can be explained, with the fields holding their filter, sort and projection
+COMMAND_SHAPES = {
+    "find": ("filter", "sort", "projection"),
+    "count": ("query", None, None),
+    "distinct": ("query", None, None),
+    "findAndModify": ("query", "sort", "fields"),
+}
+EXPLAINABLE_COMMANDS = ["find", "aggregate", "count", "distinct"]
+
+# cursors followed at a time, in case some are never exhausted or killed
+MAX_OPEN_CURSORS = 1000
+
+
+class Operation:
+    """A command, or a cursor with its getMores, being timed."""
+
+    def __init__(
+        self, command_name: str, command: Dict, database_name: str, resource: str
+    ) -> None:
+        self.command_name = command_name
+        self.command = command
+        self.database_name = database_name
+        self.resource = resource
+        self.duration_micros = 0
+        self.docs_returned = 0
+
+
+def command_collection(command_name: str, command: Dict) -> str:
+    target = command.get(command_name)
+    return target if isinstance(target, str) else ""
+
+
+def describe(command_name: str, command: Dict) -> Dict[str, Any]:
+    """The shape of the filter, sort and projection (or pipeline) of a command."""
+
+    description: Dict[str, Any] = {
+        "command": command_name,
+        "collection": command_collection(command_name, command),
+    }
+
+    if command_name == "aggregate":
+        description["pipeline"] = advisor.normalize_filter(command.get("pipeline", []))
+    elif command_name in ("update", "delete"):
+        statements = command.get(f"{command_name}s", [])
+        description["statements"] = len(statements)
+        if statements:
+            description["filter"] = advisor.normalize_filter(statements[0].get("q"))
+    elif command_name in COMMAND_SHAPES:
+        filter_field, sort_field, projection_field = COMMAND_SHAPES[command_name]
+        description["filter"] = advisor.normalize_filter(
+            command.get(filter_field) or {}
+        )
+        if sort_field and command.get(sort_field):
+            description["sort"] = normalize_spec(command[sort_field])
+        if projection_field and command.get(projection_field):
+            description["projection"] = normalize_spec(command[projection_field])
+    return description
+
+
+def normalize_spec(spec: Dict) -> Dict[str, Any]:
+    """The shape of a sort or projection.
+
+    Directions and inclusion flags are kept, anything else (eg. the query of an
+    $elemMatch) has its values replaced like a filter.
+    """
+
+    return {
+        key: value
+        if isinstance(value, (int, float))
+        else advisor.normalize_filter(value)
+        for key, value in dict(spec).items()
+    }
+
+
+def find_value(document: Any, key: str) -> Any:
+    """The first value of key in a nested explain output."""
+
+    if isinstance(document, dict):
+        if key in document:
+            return document[key]
+        values = document.values()
+    elif isinstance(document, list):
+        values = document
+    else:
+        return None
+
+    for value in values:
+        found = find_value(value, key)
+        if found is not None:
+            return found
+    return None
+
+
+def explain_stats(explain: Dict) -> Dict[str, Any]:
+    execution_stats = find_value(explain, "executionStats") or {}
+    return {
+        "docs_examined": execution_stats.get("totalDocsExamined"),
+        "keys_examined": execution_stats.get("totalKeysExamined"),
+        "plan": advisor.plan_stages(find_value(explain, "winningPlan")),
+    }
+
+
+def explain_command(command: Dict) -> Dict:
+    """The explain command for a command as sent by the driver."""
+
+    explained = {
+        key: value
+        for key, value in command.items()
+        if not key.startswith("$")
+        and key not in ("lsid", "txnNumber", "readConcern", "writeConcern")
+    }
+    return {"explain": explained, "verbosity": "executionStats"}
+
+
+class SlowQueryListener(monitoring.CommandListener):
+    def __init__(
+        self,
+        threshold_ms: float,
+        explain_sample_rate: float,
+        explain_queue_depth: int = 10,
+    ) -> None:
+        self.threshold_micros = threshold_ms * 1000
+        self.explain_sample_rate = explain_sample_rate
+        self.explain_queue_depth = explain_queue_depth
+        # operations in progress, with the id of the cursor for getMores
+        self._started: Dict[Tuple[Any, int], Tuple[Operation, int]] = {}
+        self._cursors: "OrderedDict[int, Operation]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._executor_pid: Optional[int] = None
+        # the explain running plus the ones waiting for the thread
+        self._explain_slots = threading.BoundedSemaphore(1 + explain_queue_depth)
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        command_name = event.command_name
+        if command_name == "explain":
+            return
+
+        cursor_id = 0
+        with self._lock:
+            if command_name == "getMore":
+                cursor_id = event.command.get("getMore")
+                operation = self._cursors.get(cursor_id)
+            elif command_name == "killCursors":
+                operation = None
+                for cursor_id in event.command.get("cursors", []):
+                    killed = self._cursors.pop(cursor_id, None)
+                    if killed is not None:
+                        self._finish(killed)
+            else:
+                resource = ""
+                if has_request_context() and request.view_args:
+                    resource = request.view_args.get("resource", "")
+                operation = Operation(
+                    command_name, event.command, event.database_name, resource
+                )
+
+            if operation is not None:
+                self._started[(event.connection_id, event.request_id)] = (
+                    operation,
+                    cursor_id,
+                )
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        with self._lock:
+            started = self._started.pop((event.connection_id, event.request_id), None)
+            if started is None:
+                return
+            operation, previous_cursor_id = started
+            operation.duration_micros += event.duration_micros
+
+            cursor = event.reply.get("cursor")
+            if not isinstance(cursor, dict):
+                self._finish(operation)
+                return
+
+            operation.docs_returned += len(
+                cursor.get("firstBatch", cursor.get("nextBatch", []))
+            )
+            cursor_id = cursor.get("id", 0)
+            if cursor_id:
+                self._cursors[cursor_id] = operation
+                self._cursors.move_to_end(cursor_id)
+                while len(self._cursors) > MAX_OPEN_CURSORS:
+                    self._cursors.popitem(last=False)
+            else:
+                self._cursors.pop(previous_cursor_id, None)
+                self._finish(operation)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        with self._lock:
+            started = self._started.pop((event.connection_id, event.request_id), None)
+            if started is None:
+                return
+            operation, previous_cursor_id = started
+            operation.duration_micros += event.duration_micros
+            self._cursors.pop(previous_cursor_id, None)
+            self._finish(operation, failed=True)
+
+    def _finish(self, operation: Operation, failed: bool = False) -> None:
+        if operation.duration_micros < self.threshold_micros:
+            return
+
+        record = {
+            "event": "slow_query",
+            "resource": operation.resource,
+            **describe(operation.command_name, operation.command),
+            "duration_ms": round(operation.duration_micros / 1000, 3),
+            "docs_returned": operation.docs_returned,
+            "failed": failed,
+        }
+
+        if (
+            operation.command_name in EXPLAINABLE_COMMANDS
+            and random.random() < self.explain_sample_rate
+        ):
+            executor = self._get_executor()
+            slots = self._explain_slots
+            if slots.acquire(blocking=False):
+                future = executor.submit(self._explain_and_log, record, operation)
+                future.add_done_callback(lambda _: slots.release())
+                return
+            record["explain_dropped"] = True
+            metrics.count_dropped_explain()
+        log(record)
+
+    def _explain_and_log(self, record: Dict[str, Any], operation: Operation) -> None:
+        # imported here since mangorest.mongo creates the client with this listener
+        from mangorest import mongo
+
+        try:
+            database = mongo.get_client()[operation.database_name]
+            explain = database.command(explain_command(operation.command))
+            record.update(explain_stats(explain))
+        except Exception as e:
+            record["explain_error"] = str(e)
+        log(record)
+
+    def _get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        # threads do not survive a fork, so each process starts its own
+        pid = os.getpid()
+        if self._executor is None or self._executor_pid != pid:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="mangorest-slowlog"
+            )
+            self._explain_slots = threading.BoundedSemaphore(
+                1 + self.explain_queue_depth
+            )
+            self._executor_pid = pid
+        return self._executor
+
+
+def log(record: Dict[str, Any]) -> None:
+    record["timestamp"] = time.time()
+    logger.warning(json.dumps(record, default=str, sort_keys=True))
+
+
+def event_listeners() -> List[Any]:
+    """Listeners to pass to MongoClient."""
+
+    if not config.SLOW_QUERY_THRESHOLD_MS:
+        return []
+    return [
+        SlowQueryListener(
+            config.SLOW_QUERY_THRESHOLD_MS,
+            config.SLOW_QUERY_EXPLAIN_SAMPLE_RATE,
+            config.SLOW_QUERY_EXPLAIN_QUEUE_DEPTH,
+        )
+    ]
@@ -1,17 +1,50 @@
-from typing import Tuple
+from typing import Optional, Tuple
 
 import bson
 import flask_cors
 import flask_jwt_extended as flask_jwt
 import nacl.exceptions
-from flask import abort, jsonify, request
+from bson import json_util
+from flask import abort, jsonify, request, stream_with_context
 from flask.wrappers import Response
-
-from mangorest import app, auth, config, exceptions, mongo, services
+from pymongo.errors import ExecutionTimeout, OperationFailure
+from werkzeug.local import LocalProxy
+
+from mangorest import (
+    app,
+    auth,
+    config,
+    encoder,
+    exceptions,
+    metrics,
+    mongo,
+    ndjson,
+    pagination,
+    services,
+)
 
 jwt_auth = flask_jwt.JWTManager(app)
-cors_init = flask_cors.CORS(app, resources={r"/api/*": {"origins": "*"}})
-db = mongo.connect()  # The mongodb database configured to be exposed to REST clients
+cors_init = flask_cors.CORS(
+    app,
+    resources={r"/api/*": {"origins": "*"}},
+    expose_headers=["ETag", "X-Next-Page-Token", "X-Total-Count"],
+)
+# The mongodb database configured to be exposed to REST clients. Resolved on each
+# access so that every worker process uses its own client created after fork.
+db = LocalProxy(mongo.get_database)
+
+# query string parameters that modify how results are returned instead of filtering them
+QUERY_MODIFIERS = [
+    "_projection",
+    "_sort",
+    "_limit",
+    "_skip",
+    "_after",
+    "_count",
+    "_stream",
+    "_max_time_ms",
+    "_resume_after",
+]
 
 # ===============================================
 # error handlers for serializing error messages
@@ -38,6 +71,90 @@ def resource_not_found(e):
     return jsonify(error=str(e)), 404
 
 
+@app.errorhandler(501)
+def not_implemented(e):
+    return jsonify(error=str(e)), 501
+
+
+@app.errorhandler(503)
+def service_unavailable(e):
+    return jsonify(error=str(e)), 503, {"Retry-After": "1"}
+
+
+# ===============================================
+# streaming helpers
+# ===============================================
+
+
+def is_true(param: Optional[str]) -> bool:
+    return param is not None and param.lower() in ("true", "1")
+
+
+def stream_requested(stream_param) -> bool:
+    """Responses are streamed when asked with _stream=true or an NDJSON Accept header."""
+
+    if is_true(stream_param):
+        return True
+    return request.accept_mimetypes.best == ndjson.NDJSON_MIMETYPE
+
+
+def stream_documents(documents, max_bytes: int = 0) -> Response:
+    """Stream documents as a JSON array, or as NDJSON if the client accepts it.
+
+    Documents are encoded as they are pulled from the cursor, so memory use
+    does not grow with the size of the result. The response ends cleanly after
+    the last document that fits in max_bytes.
+    """
+
+    sort_keys = app.config["JSON_SORT_KEYS"]
+
+    if request.accept_mimetypes.best == ndjson.NDJSON_MIMETYPE:
+        body = encoder.iter_ndjson(documents, sort_keys=sort_keys, max_bytes=max_bytes)
+        mimetype = ndjson.NDJSON_MIMETYPE
+    else:
+        body = encoder.iter_json_array(
+            documents, sort_keys=sort_keys, max_bytes=max_bytes
+        )
+        mimetype = "application/json"
+
+    return Response(stream_with_context(body), mimetype=mimetype)
+
+
+# ===============================================
+# conditional requests
+# ===============================================
+
+
+def conditional_response(response: Response, etag: Optional[str] = None) -> Response:
+    """Tag the response with a weak ETag and answer If-None-Match with 304.
+
+    Without an explicit etag, the ETag is a hash of the response body.
+    """
+
+    if etag:
+        response.set_etag(etag, weak=True)
+    else:
+        response.add_etag(weak=True)
+    return response.make_conditional(request)
+
+
+# ===============================================
+# response cache
+# ===============================================
+
+# headers stored with the body of a cached GET /api/<resource> response
+CACHED_HEADERS = ["ETag", "X-Next-Page-Token", "X-Total-Count"]
+
+
+def cache_response(cache_key, generation: int, response: Response) -> None:
+    headers = [
+        (name, response.headers[name])
+        for name in CACHED_HEADERS
+        if name in response.headers
+    ]
+    services.cache_response(cache_key, generation, response.get_data(), headers)
+
+
 # ===============================================
 # endpoints
 # ===============================================
@@ -59,23 +176,219 @@ def get_collection(resource) -> Response:
 
         limit = request_args.pop("_limit", None)  # eg. _limit=23
         skip = request_args.pop("_skip", None)  # eg. _skip=10
+        after = request_args.pop("_after", None)  # eg. _after=<X-Next-Page-Token>
+        count = request_args.pop("_count", None)  # eg. _count=true
+        stream = request_args.pop("_stream", None)  # eg. _stream=true
+        max_time_ms = request_args.pop("_max_time_ms", None)  # eg. _max_time_ms=500
 
         query = services.map_to_query_operator(request_args)
-        documents = services.fetch_collection(
-            db, collection_name, query, projection, sort, limit, skip
+        headers = {}
+
+        streamed = stream_requested(stream)
+        if streamed and after is not None:
+            # the page token is only known after the last document is sent
+            raise exceptions.InvalidPageTokenError(
+                "_after cannot be used with streamed responses."
+            )
+        cache_key = None
+        if not streamed:
+            cache_key = services.response_cache_key(
+                collection_name,
+                request_args,
+                projection,
+                sort,
+                limit,
+                skip,
+                after,
+                is_true(count),
+            )
+        if cache_key is not None:
+            cached = services.response_cache.get(cache_key)
+            if cached is not None:
+                return conditional_response(
+                    Response(
+                        cached.body, mimetype="application/json", headers=cached.headers
+                    )
+                )
+            generation = services.response_cache.generation(collection_name)
+
+        if is_true(count):
+            total = services.count_collection(db, collection_name, query, max_time_ms)
+            headers["X-Total-Count"] = str(total)
+
+        if streamed:
+            cursor = services.find_documents(
+                db,
+                collection_name,
+                query,
+                projection,
+                sort,
+                limit,
+                skip,
+                after,
+                max_time_ms,
+            )
+            response = stream_documents(
+                cursor, services.get_response_max_bytes(collection_name)
+            )
+            response.headers.update(headers)
+            return response
+
+        page = services.fetch_page(
+            db,
+            collection_name,
+            query,
+            projection,
+            sort,
+            limit,
+            skip,
+            after,
+            max_time_ms,
+            sort_keys=app.config["JSON_SORT_KEYS"],
         )
-        return jsonify(documents)
+        response = Response(page.body(), mimetype="application/json")
+        response.headers.update(headers)
+        next_token = page.next_token()
+        if next_token:
+            response.headers["X-Next-Page-Token"] = next_token
+        response = conditional_response(response)
+        if cache_key is not None and response.status_code == 200:
+            cache_response(cache_key, generation, response)
+        return response
     except exceptions.ResourceNameNotFoundError as e:
         abort(404, description=e)
+    except (
+        exceptions.InvalidPageTokenError,
+        exceptions.InvalidProjectionError,
+        exceptions.QueryLimitError,
+        exceptions.ResponseTooLargeError,
+    ) as e:
+        abort(400, description=e)
+    except ExecutionTimeout as e:
+        abort(503, description=e)
+
+
+@app.get("/api/<resource>/_count")
+def count_collection(resource) -> Response:
+    """Endpoint for counting the documents matching the query string filters."""
+
+    try:
+        collection_name = services.check_resource_name(resource)
+        request_args = request.args.copy()
+        max_time_ms = request_args.get("_max_time_ms")
+
+        for item in QUERY_MODIFIERS:
+            request_args.pop(item, None)
+
+        query = services.map_to_query_operator(request_args)
+        count = services.count_collection(db, collection_name, query, max_time_ms)
+        return jsonify(count=count)
+    except exceptions.ResourceNameNotFoundError as e:
+        abort(404, description=e)
+    except exceptions.QueryLimitError as e:
+        abort(400, description=e)
+    except ExecutionTimeout as e:
+        abort(503, description=e)
+
+
+@app.get("/api/<resource>/_watch")
+def watch_collection(resource) -> Response:
+    """Endpoint streaming the changes of the documents matching the query string
+    filters as Server-Sent Events. Reconnecting clients resume after the
+    Last-Event-ID header or the _resume_after param.
+
+    Each client holds the thread serving it, so servers running one request at a
+    time per process (eg. gunicorn sync workers) are refused.
+    """
+
+    try:
+        collection_name = services.check_resource_name(resource)
+        if not request.environ.get("wsgi.multithread"):
+            abort(
+                501,
+                description="Watching needs a server running the requests on threads, "
+                "eg. gunicorn with gthread workers (see gunicorn.conf.py) or the ASGI app.",
+            )
+
+        request_args = request.args.copy()
+        resume_after = request_args.get("_resume_after") or request.headers.get(
+            "Last-Event-ID"
+        )
+
+        for item in QUERY_MODIFIERS:
+            request_args.pop(item, None)
+
+        query = services.map_to_query_operator(request_args)
+        changes = services.watch_collection(db, collection_name, query, resume_after)
+        return Response(
+            stream_with_context(changes),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    except exceptions.ResourceNameNotFoundError as e:
+        abort(404, description=e)
+    except (
+        exceptions.UnsupportedWatchFilterError,
+        exceptions.InvalidResumeTokenError,
+        OperationFailure,
+    ) as e:
+        abort(400, description=e)
+
+
+@app.post("/api/<resource>/_aggregate")
+def aggregate_collection(resource) -> Response:
+    """Endpoint for running an aggregation pipeline. Results are streamed.
+
+    The body is either the pipeline itself or an object with the pipeline and
+    the allowDiskUse and maxTimeMS options. Extended JSON (eg. {"$oid": ...}) is supported.
+    """
+
+    try:
+        collection_name = services.check_resource_name(resource)
+        body = json_util.loads(request.get_data(as_text=True))
+
+        if isinstance(body, dict):
+            pipeline = body.get("pipeline")
+            allow_disk_use = body.get("allowDiskUse", False)
+            max_time_ms = body.get("maxTimeMS")
+        else:
+            pipeline, allow_disk_use, max_time_ms = body, False, None
+
+        cursor = services.aggregate_collection(
+            db, collection_name, pipeline, allow_disk_use, max_time_ms
+        )
+        return stream_documents(
+            cursor, services.get_response_max_bytes(collection_name)
+        )
+    except exceptions.ResourceNameNotFoundError as e:
+        abort(404, description=e)
+    except exceptions.ForbiddenPipelineStageError as e:
+        abort(403, description=e)
+    except ExecutionTimeout as e:
+        abort(503, description=e)
+    except (ValueError, exceptions.InvalidPipelineError, OperationFailure) as e:
+        abort(400, description=e)
 
 
 @app.post("/api/<resource>")
 @flask_jwt.jwt_required()
 def create_document_in_collection(resource) -> Tuple[Response, int]:
-    """Endpoint for creating single or multiple documents."""
+    """Endpoint for creating single or multiple documents.
+
+    NDJSON bodies (one document per line) are read and inserted in batches
+    while they are being uploaded.
+    """
 
     try:
         collection_name = services.check_resource_name(resource)
+
+        if request.mimetype == ndjson.NDJSON_MIMETYPE:
+            records = ndjson.iter_records(request.stream, config.NDJSON_MAX_LINE_BYTES)
+            result = services.ingest_documents(
+                db, collection_name, records, config.INGEST_BATCH_SIZE
+            )
+            return jsonify(result), 201
+
         document = request.json
         document_id = services.create_document(db, collection_name, document)
         return jsonify(document_id), 201
@@ -83,6 +396,26 @@ def create_document_in_collection(resource) -> Tuple[Response, int]:
         abort(404, description=e)
 
 
+@app.post("/api/<resource>/_bulk")
+@flask_jwt.jwt_required()
+def bulk_write_in_collection(resource) -> Tuple[Response, int]:
+    """Endpoint for running a stream of insert/update/replace/delete operations.
+
+    The body is NDJSON with one operation per line. It is read line by line and
+    sent to MongoDB in unordered chunks, so failed operations don't stop the rest.
+    """
+
+    try:
+        collection_name = services.check_resource_name(resource)
+        records = ndjson.iter_records(request.stream, config.NDJSON_MAX_LINE_BYTES)
+        result = services.bulk_write_documents(
+            db, collection_name, records, config.BULK_CHUNK_SIZE
+        )
+        return jsonify(result), 200
+    except exceptions.ResourceNameNotFoundError as e:
+        abort(404, description=e)
+
+
 @app.patch("/api/<resource>")
 @flask_jwt.jwt_required()
 def update_documents_in_collection(resource) -> Tuple[Response, int]:
@@ -91,9 +424,7 @@ def update_documents_in_collection(resource) -> Tuple[Response, int]:
     try:
         collection_name = services.check_resource_name(resource)
         request_args = request.args.copy()
-        filters = ["_projection", "_sort", "_limit", "_skip"]
-
-        for item in filters:
+        for item in QUERY_MODIFIERS:
             request_args.pop(item, None)
 
         modifications = request.json
@@ -116,9 +447,7 @@ def delete_documents_in_collection(resource) -> Tuple[Response, int]:
     try:
         collection_name = services.check_resource_name(resource)
         request_args = request.args.copy()
-        filters = ["_projection", "_sort", "_limit", "_skip"]
-
-        for item in filters:
+        for item in QUERY_MODIFIERS:
             request_args.pop(item, None)
 
         query = services.map_to_query_operator(request_args)
@@ -132,18 +461,101 @@ def delete_documents_in_collection(resource) -> Tuple[Response, int]:
         abort(403, description=e)
 
 
+@app.get("/api/<resource>/_indexes")
+@flask_jwt.jwt_required()
+def list_indexes(resource) -> Response:
+    try:
+        collection_name = services.check_resource_name(resource)
+        indexes = services.list_collection_indexes(db, collection_name)
+        return jsonify(indexes)
+    except exceptions.ResourceNameNotFoundError as e:
+        abort(404, description=e)
+
+
+@app.post("/api/<resource>/_indexes")
+@flask_jwt.jwt_required()
+def create_index(resource) -> Tuple[Response, int]:
+    """Endpoint for creating an index, eg. {"keys": {"name": 1}, "unique": true}.
+
+    Extended JSON (eg. in a partialFilterExpression) is supported.
+    """
+
+    try:
+        collection_name = services.check_resource_name(resource)
+        spec = json_util.loads(request.get_data(as_text=True))
+        index_name = services.create_collection_index(db, collection_name, spec)
+        return jsonify(name=index_name), 201
+    except exceptions.ResourceNameNotFoundError as e:
+        abort(404, description=e)
+    except (ValueError, exceptions.InvalidIndexSpecError, OperationFailure) as e:
+        abort(400, description=e)
+
+
+@app.delete("/api/<resource>/_indexes/<index_name>")
+@flask_jwt.jwt_required()
+def drop_index(resource, index_name) -> Tuple[Response, int]:
+    try:
+        collection_name = services.check_resource_name(resource)
+        services.drop_collection_index(db, collection_name, index_name)
+        return jsonify(), 204
+    except exceptions.ResourceNameNotFoundError as e:
+        abort(404, description=e)
+    except exceptions.IndexNotFoundError as e:
+        abort(404, description=e)
+    except exceptions.ProtectedIndexError as e:
+        abort(403, description=e)
+    except OperationFailure as e:
+        abort(400, description=e)
+
+
+@app.get("/api/<resource>/_advisor")
+@flask_jwt.jwt_required()
+def advise_indexes(resource) -> Response:
+    """Endpoint for the index advisor report of the most frequent query shapes."""
+
+    try:
+        collection_name = services.check_resource_name(resource)
+        top = request.args.get("_top")  # eg. _top=5
+        report = services.advise_indexes(db, collection_name, int(top) if top else None)
+        return jsonify(report)
+    except exceptions.ResourceNameNotFoundError as e:
+        abort(404, description=e)
+    except ValueError as e:
+        abort(400, description=e)
+
+
 @app.get("/api/<resource>/<oid>")
 def get_document(resource, oid) -> Response:
     try:
         collection_name = services.check_resource_name(resource)
+        version_field = config.ETAG_VERSION_FIELD
+
+        if version_field and request.if_none_match:
+            # answer with 304 from the version field alone when the client is up to date
+            version = services.fetch_document_version(
+                db, collection_name, oid, version_field
+            )
+            if version is not None:
+                etag = services.document_etag(oid, version)
+                if request.if_none_match.contains_weak(etag):
+                    return conditional_response(Response(), etag)
+
         document = services.fetch_document(db, collection_name, oid)
-        return jsonify(document)
+        etag = None
+        if version_field:
+            version = pagination.get_path(document, version_field)
+            if version is not pagination.MISSING:
+                etag = services.document_etag(oid, version)
+
+        return conditional_response(jsonify(document), etag)
     except exceptions.ResourceNameNotFoundError as e:
         abort(404, description=e)
     except exceptions.DocumentNotFoundError as e:
         abort(404, description=e)
     except bson.errors.InvalidId as e:
         abort(400, description=e)
+    except ExecutionTimeout as e:
+        abort(503, description=e)
 
 
 @app.patch("/api/<resource>/<oid>")
@@ -152,13 +564,30 @@ def update_document_in_collection(resource, oid) -> Tuple[Response, int]:
     try:
         collection_name = services.check_resource_name(resource)
         document = request.json
+        return_document = request.args.get("_return")  # eg. _return=after
+
+        if return_document:
+            updated_document = services.update_and_fetch_document(
+                db,
+                collection_name,
+                oid,
+                document,
+                return_document,
+                request.args.get("_projection"),
+            )
+            return jsonify(updated_document), 200
+
         services.update_document(db, collection_name, oid, document)
         return jsonify(), 204
     except exceptions.ResourceNameNotFoundError as e:
         abort(404, description=e)
     except exceptions.DocumentNotFoundError as e:
         abort(404, description=e)
-    except bson.errors.InvalidId as e:
+    except (
+        bson.errors.InvalidId,
+        exceptions.InvalidProjectionError,
+        exceptions.InvalidReturnOptionError,
+    ) as e:
         abort(400, description=e)
 
 
@@ -167,13 +596,29 @@ def update_document_in_collection(resource, oid) -> Tuple[Response, int]:
 def delete_document_in_collection(resource, oid) -> Tuple[Response, int]:
     try:
         collection_name = services.check_resource_name(resource)
+        return_document = request.args.get("_return")  # eg. _return=before
+
+        if return_document:
+            deleted_document = services.delete_and_fetch_document(
+                db,
+                collection_name,
+                oid,
+                return_document,
+                request.args.get("_projection"),
+            )
+            return jsonify(deleted_document), 200
+
         services.delete_document(db, collection_name, oid)
         return jsonify(), 204
     except exceptions.ResourceNameNotFoundError as e:
         abort(404, description=e)
     except exceptions.DocumentNotFoundError as e:
         abort(404, description=e)
-    except bson.errors.InvalidId as e:
+    except (
+        bson.errors.InvalidId,
+        exceptions.InvalidProjectionError,
+        exceptions.InvalidReturnOptionError,
+    ) as e:
         abort(400, description=e)
 
 
@@ -183,7 +628,7 @@ def delete_document_in_collection(resource, oid) -> Tuple[Response, int]:
 @jwt_auth.user_lookup_loader
 def user_lookup_callback(_jwt_header, jwt_data):
     identity = jwt_data["sub"]
-    user = auth.get_user(db[config.MANGO_USER_COLLECTION], identity)
+    user = auth.get_cached_user(db[config.MANGO_USER_COLLECTION], identity)
     return user
 
 
@@ -200,9 +645,31 @@ def login() -> Response:
         return jsonify(access_token=access_token)
     except (AttributeError, ValueError, nacl.exceptions.InvalidkeyError):
         abort(401, description="Bad username or password")
+    except exceptions.PasswordHasherBusyError as e:
+        abort(503, description=e)
 
 
 @app.get("/me")
 @flask_jwt.jwt_required()
 def current_user_endpoint():
     return jsonify(username=flask_jwt.current_user.username)
+
+
+@app.get("/metrics")
+def metrics_endpoint() -> Response:
+    """Prometheus metrics of all the worker processes."""
+
+    if not metrics.enabled():
+        abort(404, description="Metrics are not enabled.")
+    body, content_type = metrics.generate_latest()
+    return Response(body, content_type=content_type)
+
+
+@app.get("/stats")
+@flask_jwt.jwt_required()
+def stats_endpoint():
+    return jsonify(
+        user_cache=auth.user_cache.stats(),
+        query_cache=services.query_cache_stats(),
+        response_cache=services.response_cache.stats(),
+    )
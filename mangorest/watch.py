@@ -0,0 +1,610 @@
+"""Change streams shared by the subscribers of a collection, sent as Server-Sent Events.
+
+A process opens at most one change stream per collection. It is read on a
+background thread and every change is put on the queue of each subscriber.
+Subscribers filter the changes with the query string grammar, matched in the
+process against the changed document. Deletes carry no document and go to every subscriber.
+
+The id of each event is its resume token. A client reconnecting with it (the
+Last-Event-ID header) first reads the changes it missed on a change stream of
+its own, then continues on the shared one.
+
+The same change streams invalidate the cached responses of the collections
+cached until they change, see CacheInvalidator.
+"""
+
+import base64
+import binascii
+import functools
+import logging
+import operator
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+
+from bson import json_util
+from bson.json_util import CANONICAL_JSON_OPTIONS
+from pymongo.errors import PyMongoError
+
+from mangorest import encoder, exceptions
+
+logger = logging.getLogger(__name__)
+
+WATCHED_OPERATIONS = ["insert", "update", "replace", "delete"]
+PIPELINE = [{"$match": {"operationType": {"$in": WATCHED_OPERATIONS}}}]
+
+# fields of a change event sent to the clients
+EVENT_FIELDS = [
+    "operationType",
+    "clusterTime",
+    "documentKey",
+    "fullDocument",
+    "updateDescription",
+]
+
+# how long a change stream waits for changes before checking for subscribers
+MAX_AWAIT_TIME_MS = 1000
+
+KEEPALIVE = ": keepalive\n\n"
+
+# put on a subscriber's queue when its subscription ends
+CLOSED = object()
+
+
+# ===============================================
+# filters
+# ===============================================
+
+COMPARISONS = {
+    "$gt": operator.gt,
+    "$gte": operator.ge,
+    "$lt": operator.lt,
+    "$lte": operator.le,
+}
+SUPPORTED_OPERATORS = ["$eq", "$ne", "$in", "$nin", "$exists", *COMPARISONS]
+LOGICAL_OPERATORS = ["$and", "$or", "$nor"]
+
+
+def is_operator_condition(condition: Any) -> bool:
+    return (
+        isinstance(condition, dict)
+        and bool(condition)
+        and all(str(key).startswith("$") for key in condition)
+    )
+
+
+def check_filter(query: Dict) -> None:
+    """Raises UnsupportedWatchFilterError if the filter can't be matched in process."""
+
+    for key, condition in query.items():
+        if key in LOGICAL_OPERATORS:
+            for clause in condition:
+                check_filter(clause)
+        elif key.startswith("$"):
+            raise exceptions.UnsupportedWatchFilterError(
+                f"{key} is not supported by _watch."
+            )
+        elif is_operator_condition(condition):
+            for operator_name in condition:
+                if operator_name not in SUPPORTED_OPERATORS:
+                    raise exceptions.UnsupportedWatchFilterError(
+                        f"{operator_name[1:]} is not supported by _watch."
+                    )
+
+
+def field_values(document: Dict, path: str) -> List[Any]:
+    """The values at a dotted path, reaching into arrays like MongoDB does.
+
+    Arrays are returned both as is and element by element.
+    """
+
+    values: List[Any] = [document]
+    for part in path.split("."):
+        next_values = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    next_values.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    next_values.append(value[int(part)])
+                next_values.extend(
+                    item[part]
+                    for item in value
+                    if isinstance(item, dict) and part in item
+                )
+        values = next_values
+
+    expanded = []
+    for value in values:
+        expanded.append(value)
+        if isinstance(value, list):
+            expanded.extend(value)
+    return expanded
+
+
+def normalize(value: Any) -> Any:
+    # compiled filters hold tuples instead of lists, see services.freeze
+    return list(value) if isinstance(value, tuple) else value
+
+
+def values_equal(value: Any, other: Any) -> bool:
+    other = normalize(other)
+    if isinstance(value, bool) != isinstance(other, bool):
+        return False
+    return value == other
+
+
+def comparable(value: Any, other: Any) -> bool:
+    """Whether MongoDB would compare the values, ie. both numbers or both the same type."""
+
+    if isinstance(value, bool) or isinstance(other, bool):
+        return type(value) is type(other)
+    if isinstance(value, (int, float)) and isinstance(other, (int, float)):
+        return True
+    return type(value) is type(other)
+
+
+def match_operator(values: List[Any], operator_name: str, operand: Any) -> bool:
+    if operator_name == "$eq":
+        return any(values_equal(value, operand) for value in values)
+    if operator_name == "$ne":
+        return not any(values_equal(value, operand) for value in values)
+    if operator_name == "$in":
+        return any(values_equal(value, item) for value in values for item in operand)
+    if operator_name == "$nin":
+        return not any(
+            values_equal(value, item) for value in values for item in operand
+        )
+    if operator_name == "$exists":
+        return bool(values) == bool(operand)
+
+    compare = COMPARISONS[operator_name]
+    return any(
+        comparable(value, operand) and compare(value, operand) for value in values
+    )
+
+
+def match_filter(document: Dict, query: Dict) -> bool:
+    """Whether a document matches a filter built by services.map_to_query_operator."""
+
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(match_filter(document, clause) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(match_filter(document, clause) for clause in condition):
+                return False
+        elif key == "$nor":
+            if any(match_filter(document, clause) for clause in condition):
+                return False
+        else:
+            values = field_values(document, key)
+            if is_operator_condition(condition):
+                if not all(
+                    match_operator(values, operator_name, operand)
+                    for operator_name, operand in condition.items()
+                ):
+                    return False
+            elif not any(values_equal(value, condition) for value in values):
+                return False
+    return True
+
+
+# ===============================================
+# events
+# ===============================================
+
+
+def encode_token(resume_token: Dict) -> str:
+    payload = json_util.dumps(resume_token, json_options=CANONICAL_JSON_OPTIONS)
+    return base64.urlsafe_b64encode(payload.encode("UTF-8")).decode("ascii").rstrip("=")
+
+
+def decode_token(token: str) -> Dict:
+    """The resume token of an event id.
+
+    Raises:
+        InvalidResumeTokenError: if the event id is malformed
+    """
+
+    try:
+        padded_token = token + "=" * (-len(token) % 4)
+        payload = base64.urlsafe_b64decode(padded_token.encode("ascii")).decode("UTF-8")
+        resume_token = json_util.loads(payload, json_options=CANONICAL_JSON_OPTIONS)
+    except (binascii.Error, UnicodeError, ValueError):
+        resume_token = None
+    if not isinstance(resume_token, dict) or "_data" not in resume_token:
+        raise exceptions.InvalidResumeTokenError("Malformed event id to resume after.")
+    return resume_token
+
+
+def format_event(event: Dict) -> str:
+    data = {key: event[key] for key in EVENT_FIELDS if key in event}
+    return (
+        f"id: {encode_token(event['_id'])}\n"
+        f"event: {event['operationType']}\n"
+        f"data: {encoder.dumps(data, separators=(',', ':'), sort_keys=True)}\n\n"
+    )
+
+
+def format_error(message: str) -> str:
+    return f"event: error\ndata: {encoder.dumps({'error': message})}\n\n"
+
+
+class ResumePoint:
+    """The last change a resuming subscriber got from its own change stream.
+
+    Changes of the shared stream up to that one were already sent and are skipped.
+    """
+
+    def __init__(self, resume_token: Optional[Dict]) -> None:
+        self.token = resume_token
+        self.cluster_time: Any = None
+        self.passed = resume_token is None
+
+    def update(self, event: Dict) -> None:
+        self.token = event["_id"]
+        self.cluster_time = event.get("clusterTime")
+
+    def is_new(self, event: Dict) -> bool:
+        if self.passed:
+            return True
+        if event["_id"] == self.token:
+            self.passed = True
+            return False
+        cluster_time = event.get("clusterTime")
+        if self.cluster_time is None or cluster_time is None:
+            self.passed = True
+        elif cluster_time > self.cluster_time:
+            self.passed = True
+        return self.passed
+
+
+# ===============================================
+# subscriptions
+# ===============================================
+
+
+class Subscription:
+    """The queue of changes of a subscriber, filled by the thread of the shared stream."""
+
+    def __init__(self, query: Dict, max_pending: int) -> None:
+        self.query = query
+        self.max_pending = max_pending
+        self.closed = False
+        self.error: Optional[str] = None
+        # cluster time of the first change queued, where a catch-up stream can stop
+        self.first_cluster_time: Any = None
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+
+    def matches(self, event: Dict) -> bool:
+        if event["operationType"] == "delete":
+            return True
+        document = event.get("fullDocument")
+        if document is None:
+            # updated, then deleted before the update was looked up
+            return not self.query
+        return match_filter(document, self.query)
+
+    def put(self, event: Dict) -> bool:
+        """Queue a change. Returns False once the subscription is closed."""
+
+        if self.closed:
+            return False
+        if self.pending() >= self.max_pending:
+            self.close("Too many pending changes. Reconnect to resume.")
+            return False
+        if self.first_cluster_time is None:
+            self.first_cluster_time = event.get("clusterTime")
+        self._enqueue(event)
+        return True
+
+    def close(self, error: Optional[str] = None) -> None:
+        if not self.closed:
+            self.closed = True
+            self.error = error
+            self._enqueue(CLOSED)
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _enqueue(self, item: Any) -> None:
+        self._queue.put(item)
+
+    def get(self, timeout: float) -> Any:
+        """The next change, CLOSED, or None after timeout seconds without changes."""
+
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class SharedStream:
+    def __init__(self, collection_name: Any) -> None:
+        self.collection_name = collection_name
+        self.subscriptions: List[Subscription] = []
+        self.ready = threading.Event()
+        self.error: Optional[Exception] = None
+
+
+class ChangeStreamHub:
+    """Runs one change stream per watched collection while it has subscribers.
+
+    open_stream(collection_name, resume_after) opens a change stream with PIPELINE.
+    """
+
+    def __init__(self, open_stream: Callable[[Any, Optional[Dict]], Any]) -> None:
+        self._open_stream = open_stream
+        self._streams: Dict[Any, SharedStream] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, collection_name: Any, subscription: Subscription) -> None:
+        """Add a subscriber, starting the change stream if needed. Changes from
+        the moment this returns are queued.
+
+        Raises:
+            PyMongoError: if the change stream could not be opened
+        """
+
+        with self._lock:
+            shared = self._streams.get(collection_name)
+            if shared is None:
+                shared = self._streams[collection_name] = SharedStream(collection_name)
+                threading.Thread(
+                    target=self._run,
+                    args=(shared,),
+                    name=f"mangorest-watch-{collection_name}",
+                    daemon=True,
+                ).start()
+            shared.subscriptions.append(subscription)
+
+        shared.ready.wait()
+        if shared.error is not None:
+            self.unsubscribe(collection_name, subscription)
+            raise shared.error
+
+    def unsubscribe(self, collection_name: Any, subscription: Subscription) -> None:
+        """Remove a subscriber. The change stream stops after its last subscriber."""
+
+        with self._lock:
+            shared = self._streams.get(collection_name)
+            if shared is not None and subscription in shared.subscriptions:
+                shared.subscriptions.remove(subscription)
+
+    def subscribers(self, collection_name: Any) -> int:
+        with self._lock:
+            shared = self._streams.get(collection_name)
+            return len(shared.subscriptions) if shared else 0
+
+    def _run(self, shared: SharedStream) -> None:
+        error = "The change stream was closed, eg. the collection was dropped."
+        try:
+            with self._open_stream(shared.collection_name, None) as stream:
+                shared.ready.set()
+                while stream.alive:
+                    if not self._has_subscribers(shared):
+                        return
+                    event = stream.try_next()
+                    if event is not None:
+                        self._broadcast(shared, event)
+        except PyMongoError as e:
+            logger.warning("Change stream of %s failed: %s", shared.collection_name, e)
+            shared.error = e
+            error = str(e)
+        except Exception as e:
+            logger.exception("Change stream of %s failed.", shared.collection_name)
+            shared.error = e
+            error = "The change stream failed."
+        finally:
+            # whatever ended the stream, no subscriber is left waiting on it
+            self._stop(shared, error)
+
+    def _has_subscribers(self, shared: SharedStream) -> bool:
+        with self._lock:
+            if shared.subscriptions:
+                return True
+            if self._streams.get(shared.collection_name) is shared:
+                del self._streams[shared.collection_name]
+            return False
+
+    def _broadcast(self, shared: SharedStream, event: Dict) -> None:
+        if event.get("operationType") not in WATCHED_OPERATIONS:
+            return
+        with self._lock:
+            subscriptions = list(shared.subscriptions)
+        for subscription in subscriptions:
+            if not subscription.put(event):
+                self.unsubscribe(shared.collection_name, subscription)
+
+    def _stop(self, shared: SharedStream, error: str) -> None:
+        with self._lock:
+            if self._streams.get(shared.collection_name) is shared:
+                del self._streams[shared.collection_name]
+            subscriptions, shared.subscriptions = shared.subscriptions, []
+        shared.ready.set()
+        for subscription in subscriptions:
+            subscription.close(error)
+
+
+class InvalidatingSubscription(Subscription):
+    """Calls invalidate on every change instead of queuing it.
+
+    Closing also invalidates, since the changes from then on are missed.
+    """
+
+    def __init__(self, invalidate: Callable[[], None]) -> None:
+        super().__init__({}, 0)
+        self._invalidate = invalidate
+
+    def put(self, event: Dict) -> bool:
+        if self.closed:
+            return False
+        self._invalidate()
+        return True
+
+    def close(self, error: Optional[str] = None) -> None:
+        if not self.closed:
+            self.closed = True
+            self.error = error
+            self._invalidate()
+
+
+class CacheInvalidator:
+    """Keeps a subscription invalidating the cached data of a collection on each of its changes.
+
+    invalidate(collection_name) is called on every change, and when the change
+    stream fails, after which it is reopened on the next call to watching.
+    """
+
+    # wait before reopening a change stream that failed to open, eg. on a standalone server
+    RETRY_SECONDS = 30
+
+    def __init__(
+        self,
+        open_stream: Callable[[Any, Optional[Dict]], Any],
+        invalidate: Callable[[Any], None],
+        timer: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._open_stream = open_stream
+        self._invalidate = invalidate
+        self._timer = timer
+        self._subscriptions: Dict[Any, Subscription] = {}
+        self._starting: Set[Any] = set()
+        self._failed_at: Dict[Any, float] = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def watching(self, collection_name: Any) -> bool:
+        """Whether the changes of the collection invalidate its cached data.
+
+        If not, the change stream is opened in the background. Never blocks.
+        """
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # the threads reading the change streams are not forked
+                self._subscriptions.clear()
+                self._starting.clear()
+                self._pid = os.getpid()
+
+            subscription = self._subscriptions.get(collection_name)
+            if subscription is not None and not subscription.closed:
+                return True
+            failed_at = self._failed_at.get(collection_name)
+            if collection_name in self._starting or (
+                failed_at is not None and self._timer() - failed_at < self.RETRY_SECONDS
+            ):
+                return False
+            self._starting.add(collection_name)
+
+        threading.Thread(
+            target=self._subscribe,
+            args=(collection_name,),
+            name=f"mangorest-invalidate-{collection_name}",
+            daemon=True,
+        ).start()
+        return False
+
+    def _subscribe(self, collection_name: Any) -> None:
+        subscription = InvalidatingSubscription(
+            functools.partial(self._invalidate, collection_name)
+        )
+        try:
+            get_hub(self._open_stream).subscribe(collection_name, subscription)
+        except Exception as e:
+            logger.warning(
+                "Cannot watch %s to invalidate its cache: %s", collection_name, e
+            )
+            with self._lock:
+                self._failed_at[collection_name] = self._timer()
+                self._starting.discard(collection_name)
+            return
+
+        # changes made while not watching (eg. before a restart, for a shared cache)
+        self._invalidate(collection_name)
+        with self._lock:
+            self._subscriptions[collection_name] = subscription
+            self._failed_at.pop(collection_name, None)
+            self._starting.discard(collection_name)
+
+
+_hub: Optional[ChangeStreamHub] = None
+_hub_pid: Optional[int] = None
+_hub_lock = threading.Lock()
+
+
+def get_hub(open_stream: Callable[[Any, Optional[Dict]], Any]) -> ChangeStreamHub:
+    """The hub of the current process. Threads do not survive a fork, so each
+    worker process starts its own.
+    """
+
+    global _hub, _hub_pid
+
+    pid = os.getpid()
+    with _hub_lock:
+        if _hub is None or _hub_pid != pid:
+            _hub = ChangeStreamHub(open_stream)
+            _hub_pid = pid
+    return _hub
+
+
+# ===============================================
+# event streams
+# ===============================================
+
+
+def caught_up(event: Dict, subscription: Subscription) -> bool:
+    """Whether a catch-up stream reached the changes queued on the subscription."""
+
+    first_cluster_time = subscription.first_cluster_time
+    cluster_time = event.get("clusterTime")
+    return (
+        first_cluster_time is not None
+        and cluster_time is not None
+        and cluster_time >= first_cluster_time
+    )
+
+
+def iter_events(
+    hub: ChangeStreamHub,
+    collection_name: Any,
+    subscription: Subscription,
+    catch_up_stream: Any,
+    resume_token: Optional[Dict],
+    keepalive: float,
+) -> Iterator[str]:
+    """The changes of a subscription as Server-Sent Events, the ones of the
+    catch-up stream first. A comment is sent every keepalive seconds without changes.
+    """
+
+    resume_point = ResumePoint(resume_token)
+    try:
+        yield KEEPALIVE
+        if catch_up_stream is not None:
+            with catch_up_stream:
+                while not subscription.closed:
+                    event = catch_up_stream.try_next()
+                    if event is None:
+                        break
+                    resume_point.update(event)
+                    if subscription.matches(event):
+                        yield format_event(event)
+                    if caught_up(event, subscription):
+                        break
+
+        while True:
+            event = subscription.get(keepalive)
+            if event is CLOSED:
+                if subscription.error:
+                    yield format_error(subscription.error)
+                return
+            if event is None:
+                yield KEEPALIVE
+            elif resume_point.is_new(event) and subscription.matches(event):
+                yield format_event(event)
+    finally:
+        hub.unsubscribe(collection_name, subscription)
@@ -1,3 +1,3 @@
 #! /usr/bin/sh
 
-autoflake --imports=pymongo,bson --in-place --recursive mangorest tests && isort mangorest tests && black mangorest tests
\ No newline at end of file
+autoflake --imports=pymongo,bson --in-place --recursive mangorest tests benchmarks && isort mangorest tests benchmarks && black mangorest tests benchmarks
\ No newline at end of file
@@ -1,5 +1,5 @@
 #! /usr/bin/sh
 
-flake8 mangorest tests
-black mangorest tests --check
-isort mangorest tests --check-only
\ No newline at end of file
+flake8 mangorest tests benchmarks
+black mangorest tests benchmarks --check
+isort mangorest tests benchmarks --check-only
\ No newline at end of file
@@ -0,0 +1,65 @@
+import pymongo
+
+from mangorest import advisor
+
+
+def test_normalize_filter_replaces_values():
+    query = {
+        "name": "RD-180",
+        "thrust": {"$gt": 100},
+        "$or": [{"country": "USSR"}, {"country": {"$in": ["Russia", "USA"]}}],
+    }
+    assert advisor.normalize_filter(query) == {
+        "name": 1,
+        "thrust": {"$gt": 1},
+        "$or": [{"country": 1}, {"country": {"$in": 1}}],
+    }
+
+
+def test_query_shape_ignores_values():
+    first = advisor.query_shape("rocket_engines", {"name": "RD-180"}, [("name", 1)])
+    second = advisor.query_shape("rocket_engines", {"name": "RD-170"}, [("name", 1)])
+    other_sort = advisor.query_shape("rocket_engines", {"name": "RD-170"}, None)
+    assert first == second
+    assert first != other_sort
+
+
+def test_shape_recorder_counts_and_limits_shapes():
+    recorder = advisor.ShapeRecorder(max_shapes=2)
+    recorder.record("rocket_engines", {"name": "RD-180"}, None)
+    recorder.record("rocket_engines", {"name": "RD-170"}, None)
+    recorder.record("rocket_engines", {"country": "USSR"}, None)
+    recorder.record("rocket_engines", {"thrust": {"$gt": 1}}, None)
+
+    (shape, count, sample_query), _ = recorder.most_frequent("rocket_engines")
+    assert count == 2
+    assert sample_query == {"name": "RD-170"}
+    assert recorder.dropped == 1
+    assert recorder.most_frequent("launch_vehicles") == []
+
+
+def test_winning_plan_stages():
+    explain = {
+        "queryPlanner": {
+            "winningPlan": {
+                "stage": "SORT",
+                "inputStage": {"stage": "COLLSCAN", "direction": "forward"},
+            }
+        }
+    }
+    assert advisor.winning_plan_stages(explain) == ["SORT", "COLLSCAN"]
+
+
+def test_suggest_index_equality_sort_range():
+    query = {
+        "thrust": {"$gte": 100},
+        "country": "USSR",
+        "$and": [{"manufacturer": {"$in": ["NPO Energomash"]}}],
+    }
+    sort_options = [("name", pymongo.DESCENDING)]
+    assert advisor.suggest_index(query, sort_options) == [
+        ("country", pymongo.ASCENDING),
+        ("manufacturer", pymongo.ASCENDING),
+        ("name", pymongo.DESCENDING),
+        ("thrust", pymongo.ASCENDING),
+    ]
@@ -0,0 +1,217 @@
+import asyncio
+import gzip
+import json
+from typing import Dict, List, NamedTuple, Optional
+
+import pytest
+
+pytest.importorskip("a2wsgi")
+
+import mangorest.auth as auth  # noqa: E402
+import mangorest.mongo as mongo  # noqa: E402
+import mangorest.ndjson as ndjson  # noqa: E402
+from mangorest import config, watch  # noqa: E402
+from mangorest.asgi import app  # noqa: E402
+
+USERNAME = "asgi-user"
+PASSWORD = "qwerty123"
+
+
+class AsgiResponse(NamedTuple):
+    status: int
+    headers: Dict[str, str]
+    body: bytes
+
+    @property
+    def json(self):
+        return json.loads(self.body)
+
+
+@pytest.fixture(scope="module")
+def event_loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def call(event_loop):
+    def call(
+        method: str,
+        path: str,
+        headers: Optional[Dict[str, str]] = None,
+        body: bytes = b"",
+        chunk_size: Optional[int] = None,
+    ) -> AsgiResponse:
+        path, _, query_string = path.partition("?")
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "scheme": "http",
+            "server": ("testserver", 80),
+            "client": ("127.0.0.1", 50000),
+            "root_path": "",
+            "method": method,
+            "path": path,
+            "query_string": query_string.encode(),
+            "headers": [
+                (name.lower().encode(), value.encode())
+                for name, value in (headers or {}).items()
+            ],
+        }
+        # the body is received in chunks of chunk_size bytes
+        received: List[Dict] = []
+        while body:
+            chunk, body = body[:chunk_size], body[chunk_size:] if chunk_size else b""
+            received.append({"type": "http.request", "body": chunk, "more_body": True})
+        received.append({"type": "http.request", "body": b"", "more_body": False})
+        sent: List[Dict] = []
+
+        async def receive():
+            if received:
+                return received.pop(0)
+            # the client stays connected until the response is sent
+            await asyncio.Event().wait()
+
+        async def send(message):
+            sent.append(message)
+
+        event_loop.run_until_complete(app(scope, receive, send))
+        start = sent[0]
+        return AsgiResponse(
+            start["status"],
+            {name.decode(): value.decode() for name, value in start["headers"]},
+            b"".join(message.get("body", b"") for message in sent[1:]),
+        )
+
+    return call
+
+
+@pytest.fixture
+def auth_headers(call):
+    users = mongo.get_database()[config.MANGO_USER_COLLECTION]
+    if auth.get_user(users, USERNAME) is None:
+        auth.create_user(users, USERNAME, PASSWORD)
+
+    resp = call(
+        "POST",
+        "/login",
+        {"Content-Type": "application/json"},
+        json.dumps({"username": USERNAME, "password": PASSWORD}).encode(),
+    )
+    return {"Authorization": f"Bearer {resp.json['access_token']}"}
+
+
+def test_asgi_document_lifecycle(call, auth_headers):
+    headers = {**auth_headers, "Content-Type": "application/json"}
+    resp = call(
+        "POST", "/api/rockets", headers, json.dumps({"name": "RD-asgi"}).encode()
+    )
+    assert resp.status == 201
+    oid = resp.json["_id"]["$oid"]
+
+    resp = call("GET", f"/api/rockets/{oid}")
+    assert resp.json["name"] == "RD-asgi"
+    not_modified = call(
+        "GET", f"/api/rockets/{oid}", {"If-None-Match": resp.headers["etag"]}
+    )
+    assert not_modified.status == 304
+
+    resp = call(
+        "PATCH",
+        f"/api/rockets/{oid}?_return=after",
+        headers,
+        json.dumps({"country": "Moon"}).encode(),
+    )
+    assert resp.json["country"] == "Moon"
+
+    assert call("DELETE", f"/api/rockets/{oid}", auth_headers).status == 204
+    assert call("GET", f"/api/rockets/{oid}").status == 404
+
+
+def test_asgi_get_collection(call):
+    resp = call("GET", "/api/rockets?_count=true")
+    assert resp.status == 200
+    assert isinstance(resp.json, list)
+    assert int(resp.headers["x-total-count"]) == len(resp.json)
+
+    streamed = call("GET", "/api/rockets?_stream=true", {"Accept-Encoding": "gzip"})
+    assert streamed.headers["content-encoding"] == "gzip"
+    assert json.loads(gzip.decompress(streamed.body)) == resp.json
+
+    assert call("GET", "/api/rockets/_count").json["count"] == len(resp.json)
+
+
+def test_asgi_errors(call):
+    resp = call("GET", "/api/unknown")
+    assert resp.status == 404
+    assert "Resource name not found" in resp.json["error"]
+    assert call("GET", "/api/rockets/not-an-objectid").status == 400
+    assert call("POST", "/api/rockets", body=b"{}").json == {
+        "msg": "Missing Authorization Header"
+    }
+    assert call("PUT", "/api/rockets").status == 405
+
+
+def test_asgi_cors_headers_are_the_ones_of_the_flask_app(call):
+    from mangorest import app as flask_app
+
+    headers = {"Origin": "https://example.com"}
+    resp = call("GET", "/api/rockets", headers)
+    with flask_app.test_client() as client:
+        flask_resp = client.get("/api/rockets", headers=headers)
+    for name in ["Access-Control-Allow-Origin", "Access-Control-Expose-Headers"]:
+        assert resp.headers[name.lower()] == flask_resp.headers[name]
+
+
+def test_asgi_ndjson_ingest(call, auth_headers):
+    documents = [
+        {"name": "RD-5", "manufacturer": "Asyncmasher"},
+        {"name": "RD-6", "manufacturer": "Asyncmasher"},
+        ["not", "an", "object"],
+    ]
+    resp = call(
+        "POST",
+        "/api/rockets",
+        {**auth_headers, "Content-Type": ndjson.NDJSON_MIMETYPE},
+        "\n".join(json.dumps(item) for item in documents).encode(),
+        chunk_size=7,
+    )
+    assert resp.status == 201
+    assert resp.json["inserted"] == 2
+    assert resp.json["errors"][0]["index"] == 2
+
+    resp = call("DELETE", "/api/rockets?manufacturer=Asyncmasher", auth_headers)
+    assert resp.json["items_deleted"] == 2
+
+
+def test_asgi_watch(call, monkeypatch):
+    from tests.test_watch import FakeChangeStream, change, parse_events
+
+    class EndingChangeStream(FakeChangeStream):
+        # ends like a change stream invalidated by dropping the collection
+        def try_next(self):
+            event = super().try_next()
+            if event is None:
+                self.close()
+            return event
+
+    def open_stream(collection_name, resume_after):
+        return EndingChangeStream(
+            [
+                change("insert", 1, {"country": "USA"}),
+                change("insert", 2, {"country": "USSR"}),
+                change("delete", 3),
+            ]
+        )
+
+    monkeypatch.setattr(watch, "get_hub", lambda _: watch.ChangeStreamHub(open_stream))
+    resp = call("GET", "/api/rockets/_watch?country=USSR")
+    assert resp.status == 200
+    assert resp.headers["content-type"].startswith("text/event-stream")
+    events = parse_events(resp.body.decode().split("\n\n")[:-1])
+    assert [event["event"] for event in events] == ["insert", "delete", "error"]
+    assert events[0]["data"]["fullDocument"]["country"] == "USSR"
+
+    assert call("GET", "/api/rockets/_watch?name=regex[str].^RD").status == 400
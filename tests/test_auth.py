@@ -1,11 +1,15 @@
 from typing import NamedTuple
 
+import nacl.exceptions
 import pytest
 from bson.objectid import ObjectId
 
 import mangorest.auth as auth
+import mangorest.cache as cache
 import mangorest.config as config
+import mangorest.hashing as hashing
 import mangorest.mongo as mongo
+from mangorest import exceptions
 
 
 @pytest.fixture
@@ -32,3 +36,55 @@ def test_login_service(db_connection, user):
     user_collection = db_connection[config.MANGO_USER_COLLECTION]
     resp = auth.login_service(user_collection, user.username, user.password)
     assert type(resp) is auth.MangoUser
+
+
+def test_get_cached_user(db_connection, user):
+    user_collection = db_connection[config.MANGO_USER_COLLECTION]
+    auth.user_cache.clear()
+    first = auth.get_cached_user(user_collection, user.username)
+    hits = auth.user_cache.stats()["hits"]
+    second = auth.get_cached_user(user_collection, user.username)
+    assert first == second
+    assert auth.user_cache.stats()["hits"] == hits + 1
+
+
+def test_create_user_invalidates_cached_user(db_connection, user):
+    user_collection = db_connection[config.MANGO_USER_COLLECTION]
+    auth.user_cache.set("someone", auth.MangoUser("someone", b"stale"))
+    auth.create_user(user_collection, "someone", "qwerty123")
+    assert auth.user_cache.get("someone") is None
+
+
+def test_ttl_cache_expires_entries():
+    now = [0.0]
+    ttl_cache = cache.TTLCache(maxsize=2, ttl=10, timer=lambda: now[0])
+    ttl_cache.set("a", 1)
+    assert ttl_cache.get("a") == 1
+    now[0] = 11
+    assert ttl_cache.get("a") is None
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    ttl_cache = cache.TTLCache(maxsize=2, ttl=10)
+    ttl_cache.set("a", 1)
+    ttl_cache.set("b", 2)
+    ttl_cache.get("a")
+    ttl_cache.set("c", 3)
+    assert ttl_cache.get("b") is None
+    assert ttl_cache.get("a") == 1
+
+
+def test_password_hasher_hash_and_verify():
+    hasher = hashing.PasswordHasher(max_workers=1, max_pending=0)
+    hashed_password = hasher.hash(b"123qwerty")
+    assert hasher.verify(hashed_password, b"123qwerty")
+    with pytest.raises(nacl.exceptions.InvalidkeyError):
+        hasher.verify(hashed_password, b"wrong")
+
+
+def test_password_hasher_rejects_requests_beyond_queue_depth():
+    hasher = hashing.PasswordHasher(max_workers=1, max_pending=0)
+    hasher._get_executor()
+    hasher._slots.acquire()
+    with pytest.raises(exceptions.PasswordHasherBusyError):
+        hasher.hash(b"123qwerty")
@@ -0,0 +1,55 @@
+import datetime
+import json
+
+import pytest
+from bson import json_util
+from bson.binary import Binary
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+
+from mangorest import app, encoder
+
+
+@pytest.fixture
+def raw_document():
+    return {
+        "_id": ObjectId("61a993c68cd8469da9bd1eb4"),
+        "name": "RD-180",
+        "launched": datetime.datetime(2021, 12, 3, 4, 5, 6, 789000),
+        "price": Decimal128("1234.50"),
+        "blob": Binary(b"\x00\x01\x02"),
+        "stages": [
+            {"engine_id": ObjectId("61a993c68cd8469da9bd1eb5"), "count": 2},
+            [1.5, None, True],
+        ],
+    }
+
+
+def test_dumps_matches_json_util(raw_document):
+    expected = json.loads(json_util.dumps(raw_document))
+    assert json.loads(encoder.dumps(raw_document)) == expected
+
+
+def test_jsonify_matches_json_util_round_trip(raw_document):
+    with app.test_request_context():
+        from flask import jsonify
+
+        expected = jsonify(json.loads(json_util.dumps(raw_document))).get_data()
+        assert jsonify(raw_document).get_data() == expected
+
+
+def test_iter_json_array_matches_dumps(raw_document):
+    documents = [raw_document] * 3
+    chunks = list(encoder.iter_json_array(iter(documents), chunk_size=64))
+    assert len(chunks) > 1
+    assert json.loads("".join(chunks)) == json.loads(encoder.dumps(documents))
+
+
+def test_iter_json_array_empty():
+    assert "".join(encoder.iter_json_array(iter([]))) == "[]\n"
+
+
+def test_iter_ndjson(raw_document):
+    lines = "".join(encoder.iter_ndjson(iter([raw_document] * 2))).splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[0]) == json.loads(encoder.dumps(raw_document))
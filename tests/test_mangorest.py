@@ -1,10 +1,33 @@
+import concurrent.futures
+import gzip
+import io
+import json
+import os
+import runpy
+import threading
 from typing import Dict, List, NamedTuple
 
+import nacl.pwhash
 import pytest
+from bson.objectid import ObjectId
+from pymongo.errors import ExecutionTimeout
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import ReadPreference
+from pymongo.write_concern import WriteConcern
 
+import mangorest.hashing as hashing
 import mangorest.mongo as mongo
 import mangorest.services as services
-from mangorest import app, exceptions
+from mangorest import (
+    app,
+    cache,
+    config,
+    encoder,
+    exceptions,
+    metrics,
+    ndjson,
+    pagination,
+)
 
 
 @pytest.fixture
@@ -100,16 +123,203 @@ def jwt_token(client, user):
     return resp.json["access_token"]
 
 
+# ============================================================
+# Testing connection
+# ============================================================
+
+
+def test_client_is_shared_within_process():
+    assert mongo.get_client() is mongo.get_client()
+
+
+def test_client_is_recreated_after_fork(monkeypatch):
+    monkeypatch.setattr(mongo, "_client_pid", -1)
+    mongo.get_client()
+    assert mongo._client_pid == os.getpid()
+
+
+def test_resource_options_parser():
+    mapper = config.MangoConfigurator(["rockets:rocket_engines"])
+    mapper.resource_collection_map_parser()
+    mapper.resource_options_parser(
+        {
+            "rockets": {
+                "read_preference": "secondaryPreferred",
+                "read_concern": "majority",
+                "write_concern": {"w": 1},
+                "max_time_ms": 500,
+            }
+        }
+    )
+    options = mapper.collection_options["rocket_engines"]
+    assert options.read_preference == ReadPreference.SECONDARY_PREFERRED
+    assert options.read_concern == ReadConcern("majority")
+    assert options.write_concern == WriteConcern(w=1)
+    assert options.max_time_ms == 500
+
+
+def test_resource_options_parser_rejects_unknown_resource():
+    mapper = config.MangoConfigurator(["rockets:rocket_engines"])
+    mapper.resource_collection_map_parser()
+    with pytest.raises(ValueError):
+        mapper.resource_options_parser({"engines": {"max_time_ms": 500}})
+
+
+def test_get_db_collection_applies_resource_options(
+    db_connection, test_args, monkeypatch
+):
+    monkeypatch.setitem(
+        services.collection_options,
+        test_args.collection_name,
+        config.CollectionOptions(write_concern=WriteConcern(w=1)),
+    )
+    db_collection = services.get_db_collection(db_connection, test_args.collection_name)
+    assert db_collection.write_concern == WriteConcern(w=1)
+
+
 # ============================================================
 # Testing services
 # ============================================================
 
 
+def test_map_to_query_operator():
+    query = services.map_to_query_operator(
+        {
+            "country": "USA",
+            "is_active": "[bool].true",
+            "thrust_to_weight_ratio": "gte[int].50",
+            "or": "(name.eq[str].RD-180,burn_time.lt[float].3.5)",
+            "cycle": "in[list-str].[staged,open]",
+        }
+    )
+    assert query == {
+        "country": "USA",
+        "is_active": True,
+        "thrust_to_weight_ratio": {"$gte": 50},
+        "$or": ({"name": {"$eq": "RD-180"}}, {"burn_time": {"$lt": 3.5}}),
+        "cycle": {"$in": ("staged", "open")},
+    }
+
+
+def test_map_to_query_operator_returns_cached_immutable_filter():
+    first = services.map_to_query_operator({"a": "gt[int].1", "b": "x"})
+    second = services.map_to_query_operator({"b": "x", "a": "gt[int].1"})
+    assert first is second
+    with pytest.raises(TypeError):
+        first["c"] = "y"
+
+
+def test_parse_sort():
+    result = services.parse_sort("(name:ascending),(burn_time:descending)")
+    assert list(result) == [("name", 1), ("burn_time", -1)]
+
+
+def test_parse_projection():
+    assert services.parse_projection("name,stages.name,-_id") == {
+        "name": 1,
+        "stages.name": 1,
+        "_id": 0,
+    }
+    assert services.parse_projection("-tests,stages.slice.-2,notes.slice.(10,5)") == {
+        "tests": 0,
+        "stages": {"$slice": -2},
+        "notes": {"$slice": (10, 5)},
+    }
+    assert services.parse_projection(
+        "name,stages.elemMatch.(name.eq[str].first,thrust.gt[int].10,thrust.lt[int].99)"
+    ) == {
+        "name": 1,
+        "stages": {
+            "$elemMatch": {"name": {"$eq": "first"}, "thrust": {"$gt": 10, "$lt": 99}}
+        },
+    }
+    assert services.parse_projection("name") is services.parse_projection("name")
+
+    for invalid in [
+        "name,-country",
+        "stages,stages.name",
+        "name,,country",
+        "stages.elemMatch.(thrust.gt[int].ten)",
+        "tags.slice.(1)",
+        "name.slice.x",
+        "stages.elemMatch.thrust",
+        "$where",
+    ]:
+        with pytest.raises(exceptions.InvalidProjectionError):
+            services.parse_projection(invalid)
+
+
+def test_project_sort_keys():
+    spec = [("country", 1), ("_id", 1)]
+    assert pagination.project_sort_keys({"name": 1, "_id": 0}, spec) == (
+        {"name": 1, "country": 1},
+        ["country", "_id"],
+    )
+    assert pagination.project_sort_keys({"country": 0, "tests": 0}, spec) == (
+        {"tests": 0},
+        ["country"],
+    )
+    for projection in [{"country": {"$slice": 1}}, {"name": 1, "country.code": 1}]:
+        with pytest.raises(exceptions.InvalidProjectionError):
+            pagination.project_sort_keys(projection, spec)
+
+
+def test_fetch_collection_with_array_projections(db_connection, test_args):
+    db_collection = db_connection[test_args.collection_name]
+    oid = db_collection.insert_one(
+        {
+            "name": "RS-25",
+            "country": "USA",
+            "stages": [
+                {"name": "first", "thrust": 10},
+                {"name": "second", "thrust": 20},
+            ],
+            "tests": list(range(10)),
+        }
+    ).inserted_id
+    try:
+        (document,) = services.fetch_collection(
+            db_connection,
+            test_args.collection_name,
+            {"name": "RS-25"},
+            projection="name,tests.slice.(2,3),stages.elemMatch.(thrust.gt[int].15)",
+            sort=None,
+            limit=None,
+            skip=None,
+        )
+        assert document == {
+            "_id": oid,
+            "name": "RS-25",
+            "tests": [2, 3, 4],
+            "stages": [{"name": "second", "thrust": 20}],
+        }
+
+        (document,) = services.fetch_collection(
+            db_connection,
+            test_args.collection_name,
+            {"name": "RS-25"},
+            projection="-stages,-tests,-_id",
+            sort=None,
+            limit=None,
+            skip=None,
+        )
+        assert document == {"name": "RS-25", "country": "USA"}
+    finally:
+        db_collection.delete_one({"_id": oid})
+
+
+def test_count_collection(db_connection, test_args):
+    result = services.count_collection(
+        db_connection, test_args.collection_name, test_args.query_empty
+    )
+    assert type(result) is int
+
+
 def test_create_single_document(db_connection, test_args):
     result = services.create_document(
         db_connection, test_args.collection_name, test_args.single_doc
     )
-    assert "$oid" in result["_id"]
+    assert type(result["_id"]) is ObjectId
 
 
 def test_create_multiple_documents(db_connection, test_args):
@@ -117,7 +327,7 @@ def test_create_multiple_documents(db_connection, test_args):
         db_connection, test_args.collection_name, test_args.multiple_doc
     )
     assert len(result) >= 1
-    assert "$oid" in result[0]["_id"]
+    assert type(result[0]["_id"]) is ObjectId
 
 
 def test_fetch_collection(db_connection, test_args):
@@ -137,7 +347,7 @@ def test_fetch_document(db_connection, test_args, oid_query):
     result = services.fetch_document(
         db_connection, test_args.collection_name, oid_query
     )
-    assert "$oid" in result["_id"]
+    assert str(result["_id"]) == oid_query
 
 
 def test_update_document(db_connection, test_args, oid_query):
@@ -233,6 +443,42 @@ def test_login_endpoint(user, client):
     assert "access_token" in resp.json
 
 
+def test_get_endpoint_while_password_hashing_is_saturated(
+    monkeypatch, user, client, test_args
+):
+    hashing_started = threading.Event()
+    release = threading.Event()
+
+    def slow_verify(hashed_password, password):
+        hashing_started.set()
+        release.wait(10)
+        return True
+
+    monkeypatch.setattr(
+        hashing, "password_hasher", hashing.PasswordHasher(max_workers=1, max_pending=0)
+    )
+    monkeypatch.setattr(nacl.pwhash, "verify", slow_verify)
+    credentials = {"username": user.username, "password": user.password}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        login = executor.submit(app.test_client().post, "/login", json=credentials)
+        assert hashing_started.wait(10)
+        try:
+            assert client.post("/login", json=credentials).status_code == 503
+            assert client.get(test_args.api_url).status == "200 OK"
+        finally:
+            release.set()
+        assert "access_token" in login.result().json
+
+
+def test_gunicorn_workers_run_requests_on_threads():
+    settings = runpy.run_path(
+        os.path.join(os.path.dirname(__file__), os.pardir, "gunicorn.conf.py")
+    )
+    assert settings["worker_class"] == "gthread"
+    assert settings["threads"] > config.PASSWORD_HASH_WORKERS
+
+
 def test_create_document_endpoint(client, test_args, jwt_token):
     resp = client.post(
         test_args.api_url,
@@ -251,12 +497,404 @@ def test_create_many_documents_endpoint(client, test_args, jwt_token):
     assert resp.status == "201 CREATED"
 
 
+def test_create_documents_ndjson_endpoint(client, test_args, jwt_token):
+    documents = [
+        {"name": "RD-3", "manufacturer": "Ingestmasher"},
+        {"name": "RD-4", "manufacturer": "Ingestmasher"},
+        ["not", "an", "object"],
+    ]
+    resp = client.post(
+        test_args.api_url,
+        data="\n".join(json.dumps(item) for item in documents),
+        content_type="application/x-ndjson",
+        headers={"Authorization": f"Bearer {jwt_token}"},
+    )
+    assert resp.status == "201 CREATED"
+    assert resp.json["inserted"] == 2
+    assert resp.json["errors"][0]["index"] == 2
+
+    client.delete(
+        f"{test_args.api_url}?manufacturer=Ingestmasher",
+        headers={"Authorization": f"Bearer {jwt_token}"},
+    )
+
+
+def test_create_documents_ndjson_endpoint_rejects_long_lines(
+    client, test_args, jwt_token, monkeypatch
+):
+    monkeypatch.setattr(config, "NDJSON_MAX_LINE_BYTES", 64)
+    documents = [
+        {"name": "RD-5", "manufacturer": "Ingestmasher"},
+        {"name": "RD-6", "manufacturer": "Ingestmasher", "notes": "x" * 100},
+        {"name": "RD-7", "manufacturer": "Ingestmasher"},
+    ]
+    resp = client.post(
+        test_args.api_url,
+        data="\n".join(json.dumps(item) for item in documents),
+        content_type="application/x-ndjson",
+        headers={"Authorization": f"Bearer {jwt_token}"},
+    )
+    assert resp.status == "201 CREATED"
+    assert resp.json["inserted"] == 2
+    assert [error["index"] for error in resp.json["errors"]] == [1]
+
+    client.delete(
+        f"{test_args.api_url}?manufacturer=Ingestmasher",
+        headers={"Authorization": f"Bearer {jwt_token}"},
+    )
+
+
+def test_ndjson_iter_records_max_line_bytes():
+    body = io.BytesIO(b'{"a":1}\n{"a":22}\n{"a":3}')
+    records = list(ndjson.iter_records(body, max_line_bytes=7))
+    assert [record.value for record in records] == [{"a": 1}, None, {"a": 3}]
+    assert records[1].index == 1 and "maximum of 7 bytes" in records[1].error
+
+
+def test_bulk_write_endpoint(client, test_args, jwt_token):
+    operations = [
+        {"insertOne": {"document": {"name": "RD-1", "manufacturer": "Bulkmasher"}}},
+        {"insertOne": {"document": {"name": "RD-2", "manufacturer": "Bulkmasher"}}},
+        {"deleteMany": {"filter": {}}},
+    ]
+    body = "\n".join(json.dumps(item) for item in operations) + "\n{not json\n"
+    resp = client.post(
+        f"{test_args.api_url}/_bulk",
+        data=body,
+        content_type="application/x-ndjson",
+        headers={"Authorization": f"Bearer {jwt_token}"},
+    )
+    assert resp.status == "200 OK"
+    assert resp.json["inserted"] == 2
+    assert [error["index"] for error in resp.json["errors"]] == [2, 3]
+
+    resp = client.post(
+        f"{test_args.api_url}/_bulk",
+        data=json.dumps({"deleteMany": {"filter": {"manufacturer": "Bulkmasher"}}}),
+        content_type="application/x-ndjson",
+        headers={"Authorization": f"Bearer {jwt_token}"},
+    )
+    assert resp.json["deleted"] == 2
+
+
+def test_bulk_write_endpoint_invalid_operations(client, test_args, jwt_token):
+    operations = [
+        {"insertOne": {"document": {"name": "RD-3", "manufacturer": "Bulkmasher"}}},
+        {"updateOne": {"filter": {"name": "RD-3"}, "update": {"country": "Russia"}}},
+        {"insertOne": {"document": ["RD-4"]}},
+        {"replaceOne": {"filter": {"name": "RD-3"}, "replacement": {"$set": {}}}},
+        {"deleteOne": {"filter": "RD-3"}},
+        {"updateOne": {"filter": {"name": "RD-3"}, "update": {"$set": {"x": 1}}}},
+    ]
+    resp = client.post(
+        f"{test_args.api_url}/_bulk",
+        data="\n".join(json.dumps(item) for item in operations),
+        content_type="application/x-ndjson",
+        headers={"Authorization": f"Bearer {jwt_token}"},
+    )
+    assert resp.status == "200 OK"
+    assert resp.json["inserted"] == 1
+    assert resp.json["modified"] == 1
+    assert [error["index"] for error in resp.json["errors"]] == [1, 2, 3, 4]
+
+    client.delete(
+        f"{test_args.api_url}?manufacturer=Bulkmasher",
+        headers={"Authorization": f"Bearer {jwt_token}"},
+    )
+
+
 def test_get_collection_endpoint(client, test_args):
     resp = client.get(test_args.api_url)
     resp_data = resp.json
     assert isinstance(resp_data, list)
 
 
+def test_get_collection_streamed_endpoint(client, test_args):
+    resp = client.get(f"{test_args.api_url}?_stream=true")
+    assert resp.is_streamed
+    assert isinstance(resp.json, list)
+
+
+def test_get_collection_ndjson_endpoint(client, test_args):
+    resp = client.get(test_args.api_url, headers={"Accept": "application/x-ndjson"})
+    lines = resp.get_data(as_text=True).splitlines()
+    assert resp.mimetype == "application/x-ndjson"
+    assert all(json.loads(line)["_id"]["$oid"] for line in lines)
+
+
+def test_get_collection_keyset_pagination_endpoint(client, test_args):
+    first_page = client.get(
+        f"{test_args.api_url}?_limit=1&_after=&_sort=(name:ascending)"
+    )
+    token = first_page.headers["X-Next-Page-Token"]
+    second_page = client.get(
+        f"{test_args.api_url}?_limit=1&_after={token}&_sort=(name:ascending)"
+    )
+    assert len(second_page.json) == 1
+    assert second_page.json[0]["name"] >= first_page.json[0]["name"]
+    assert second_page.json[0]["_id"] != first_page.json[0]["_id"]
+
+
+def test_get_collection_keyset_pagination_endpoint_with_projection(client, test_args):
+    for projection in ["country", "-name,-_id"]:
+        url = f"{test_args.api_url}?_limit=1&_sort=(name:ascending)&_projection={projection}"
+        first_page = client.get(f"{url}&_after=")
+        token = first_page.headers["X-Next-Page-Token"]
+        second_page = client.get(f"{url}&_after={token}")
+        assert second_page.status == "200 OK"
+        for document in first_page.json + second_page.json:
+            assert "name" not in document
+            assert "country" in document
+    assert "_id" not in second_page.json[0]
+
+
+def test_keyset_pagination_over_missing_sort_keys(db_connection, test_args):
+    db_collection = db_connection[test_args.collection_name]
+    oids = db_collection.insert_many(
+        [{"tag": "keyset"}, {"tag": "keyset"}, {"tag": "keyset", "stage": 1}]
+    ).inserted_ids
+    try:
+        for sort in ["(stage:ascending)", "(stage:descending)"]:
+            seen = []
+            after = ""
+            while after is not None:
+                documents, after = services.fetch_collection_page(
+                    db_connection,
+                    test_args.collection_name,
+                    {"tag": "keyset"},
+                    projection=None,
+                    sort=sort,
+                    limit="1",
+                    skip=None,
+                    after=after,
+                )
+                seen.extend(document["_id"] for document in documents)
+            assert sorted(seen) == sorted(oids)
+    finally:
+        db_collection.delete_many({"tag": "keyset"})
+
+
+def test_response_bad_request_when_streaming_a_keyset_page(client, test_args):
+    resp = client.get(f"{test_args.api_url}?_limit=1&_after=&_stream=true")
+    assert resp.status == "400 BAD REQUEST"
+
+
+def test_response_bad_request_when_projection_is_invalid(client, test_args):
+    resp = client.get(f"{test_args.api_url}?_projection=name,-country")
+    assert resp.status == "400 BAD REQUEST"
+
+
+def test_response_bad_request_when_page_token_is_invalid(client, test_args):
+    resp = client.get(f"{test_args.api_url}?_limit=1&_after=not-a-token")
+    assert resp.status == "400 BAD REQUEST"
+
+
+def test_get_collection_endpoint_gzip(client, test_args, monkeypatch):
+    monkeypatch.setattr(config, "COMPRESSION_MIN_SIZE", 0)
+    resp = client.get(test_args.api_url, headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert isinstance(json.loads(gzip.decompress(resp.get_data())), list)
+
+
+def test_get_collection_streamed_endpoint_gzip(client, test_args):
+    resp = client.get(
+        f"{test_args.api_url}?_stream=true", headers={"Accept-Encoding": "gzip"}
+    )
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert isinstance(json.loads(gzip.decompress(resp.get_data())), list)
+
+
+def test_get_collection_endpoint_not_compressed_below_threshold(
+    client, test_args, monkeypatch
+):
+    monkeypatch.setattr(config, "COMPRESSION_MIN_SIZE", 10**9)
+    resp = client.get(test_args.api_url, headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in resp.headers
+
+
+def test_count_collection_endpoint(client, test_args):
+    resp = client.get(f"{test_args.api_url}/_count?manufacturer=Energomasher")
+    assert resp.json["count"] >= 1
+
+
+def test_get_collection_endpoint_total_count(client, test_args):
+    resp = client.get(f"{test_args.api_url}?_limit=1&_count=true")
+    assert len(resp.json) == 1
+    assert int(resp.headers["X-Total-Count"]) >= len(resp.json)
+
+
+def test_resolve_limit_applies_default_and_maximum(test_args, monkeypatch):
+    monkeypatch.setattr(config, "QUERY_DEFAULT_LIMIT", 20)
+    monkeypatch.setattr(config, "QUERY_MAX_LIMIT", 100)
+    assert services.resolve_limit(test_args.collection_name, None) == 20
+    assert services.resolve_limit(test_args.collection_name, "50") == 50
+    with pytest.raises(exceptions.QueryLimitError):
+        services.resolve_limit(test_args.collection_name, "101")
+    with pytest.raises(exceptions.QueryLimitError):
+        services.resolve_limit(test_args.collection_name, "-1")
+
+
+def test_resolve_limit_zero_means_no_limit(test_args, monkeypatch):
+    monkeypatch.setattr(config, "QUERY_DEFAULT_LIMIT", 20)
+    monkeypatch.setattr(config, "QUERY_MAX_LIMIT", 0)
+    assert services.resolve_limit(test_args.collection_name, "0") == 0
+    monkeypatch.setattr(config, "QUERY_MAX_LIMIT", 100)
+    assert services.resolve_limit(test_args.collection_name, "0") == 100
+
+
+def test_resolve_max_time_ms_is_capped(test_args, monkeypatch):
+    monkeypatch.setattr(config, "QUERY_MAX_TIME_MS", 1000)
+    assert services.resolve_max_time_ms(test_args.collection_name) == 1000
+    assert services.resolve_max_time_ms(test_args.collection_name, "200") == 200
+    assert services.resolve_max_time_ms(test_args.collection_name, "5000") == 1000
+
+
+def test_page_builder_caps_the_encoded_size(test_args, monkeypatch):
+    documents = [{"name": "RD-180"}, {"name": "RD-170"}, {"name": "RD-191"}]
+    monkeypatch.setattr(config, "RESPONSE_MAX_BYTES", len('[{"name":"RD-180"}]\n'))
+
+    page = services.PageBuilder(test_args.collection_name, None, None, "2", after="")
+    assert page.add(dict(documents[0]))
+    assert not page.add(dict(documents[1]))
+    assert json.loads(page.body()) == documents[:1]
+    # cut off pages point after their last document
+    token = page.next_token()
+    assert pagination.decode_token(token, pagination.sort_spec(None)) == [None]
+
+    page = services.PageBuilder(test_args.collection_name, None, None, None)
+    assert page.add(dict(documents[0]))
+    with pytest.raises(exceptions.ResponseTooLargeError):
+        page.add(dict(documents[1]))
+
+
+def test_iter_json_array_is_cut_off_at_max_bytes():
+    documents = [{"name": "RD-180"}, {"name": "RD-170"}, {"name": "RD-191"}]
+    max_bytes = len('[{"name":"RD-180"},{"name":"RD-170"}]')
+    body = "".join(encoder.iter_json_array(iter(documents), max_bytes=max_bytes))
+    assert json.loads(body) == documents[:2]
+    body = "".join(encoder.iter_ndjson(iter(documents), max_bytes=max_bytes))
+    assert len(body.splitlines()) == 2
+
+
+def test_response_bad_request_when_skip_is_invalid(client, test_args):
+    for skip in ["abc", "-1"]:
+        resp = client.get(f"{test_args.api_url}?_skip={skip}")
+        assert resp.status == "400 BAD REQUEST"
+
+
+def test_response_bad_request_when_limit_exceeds_maximum(
+    client, test_args, monkeypatch
+):
+    monkeypatch.setattr(config, "QUERY_MAX_LIMIT", 1)
+    resp = client.get(f"{test_args.api_url}?_limit=2")
+    assert resp.status == "400 BAD REQUEST"
+
+
+def test_response_too_large(client, test_args, monkeypatch):
+    monkeypatch.setattr(config, "RESPONSE_MAX_BYTES", 1)
+    resp = client.get(test_args.api_url)
+    assert resp.status == "400 BAD REQUEST"
+
+    resp = client.get(f"{test_args.api_url}?_after=&_limit=2")
+    assert resp.status == "400 BAD REQUEST"
+
+    resp = client.get(f"{test_args.api_url}?_stream=true")
+    assert resp.status == "200 OK"
+    assert json.loads(resp.data) == []
+
+
+def test_response_cache_evicts_by_size_and_skips_stale_responses():
+    response_cache = cache.ResponseCache(max_bytes=400)
+    body = b"x" * 100
+    for key in ["a", "b", "c"]:
+        assert response_cache.set("rockets", key, cache.CachedResponse(body, []), 0)
+    response_cache.get("a")
+    for key in ["d", "e"]:
+        assert response_cache.set("engines", key, cache.CachedResponse(body, []), 0)
+    assert response_cache.get("b") is None
+    assert response_cache.get("a").body == body
+    assert response_cache.size <= 400
+
+    generation = response_cache.generation("rockets")
+    response_cache.invalidate("rockets")
+    assert response_cache.get("a") is None
+    assert response_cache.get("d") is not None
+    assert not response_cache.set(
+        "rockets", "a", cache.CachedResponse(body, []), generation
+    )
+    assert not response_cache.set(
+        "rockets", "big", cache.CachedResponse(b"x" * 101, []), generation + 1
+    )
+
+
+def test_get_collection_endpoint_cached(client, test_args, jwt_token, monkeypatch):
+    monkeypatch.setitem(
+        services.collection_options,
+        test_args.collection_name,
+        config.CollectionOptions(cache_ttl=60),
+    )
+    url = f"{test_args.api_url}?manufacturer=Cachemasher&_count=true"
+    first = client.get(url)
+    hits = services.response_cache.stats()["hits"]
+    second = client.get(url)
+    assert services.response_cache.stats()["hits"] == hits + 1
+    assert second.data == first.data
+    assert second.headers["ETag"] == first.headers["ETag"]
+    assert second.headers["X-Total-Count"] == "0"
+    assert client.get(url, headers={"If-None-Match": first.headers["ETag"]}).status == (
+        "304 NOT MODIFIED"
+    )
+
+    # writes through the API invalidate the cached responses of the collection
+    client.post(
+        test_args.api_url,
+        json={"name": "RD-cache", "manufacturer": "Cachemasher"},
+        headers={"Authorization": f"Bearer {jwt_token}"},
+    )
+    resp = client.get(url)
+    assert [document["name"] for document in resp.json] == ["RD-cache"]
+    assert resp.headers["X-Total-Count"] == "1"
+
+    client.delete(
+        f"{test_args.api_url}?manufacturer=Cachemasher",
+        headers={"Authorization": f"Bearer {jwt_token}"},
+    )
+    assert client.get(url).json == []
+
+
+def test_aggregate_collection_endpoint(client, test_args):
+    resp = client.post(
+        f"{test_args.api_url}/_aggregate",
+        json={
+            "pipeline": [
+                {"$match": {"manufacturer": "Energomasher"}},
+                {"$group": {"_id": "$manufacturer", "count": {"$sum": 1}}},
+            ]
+        },
+    )
+    assert resp.status == "200 OK"
+    assert resp.json[0]["_id"] == "Energomasher"
+
+
+def test_response_forbidden_when_aggregating_with_disallowed_stage(client, test_args):
+    resp = client.post(
+        f"{test_args.api_url}/_aggregate", json=[{"$out": "rocket_engines_copy"}]
+    )
+    assert resp.status == "403 FORBIDDEN"
+
+
+def test_validate_pipeline_maps_resource_names():
+    pipeline = services.validate_pipeline(
+        [{"$lookup": {"from": "vehicles", "as": "vehicles", "pipeline": []}}]
+    )
+    assert pipeline[0]["$lookup"]["from"] == "launch_vehicles"
+
+
+def test_validate_pipeline_rejects_javascript_operators():
+    with pytest.raises(exceptions.ForbiddenPipelineStageError):
+        services.validate_pipeline([{"$match": {"$where": "true"}}])
+
+
 def test_get_document_endpoint(client, test_args, oid_query):
     resp = client.get(f"{ test_args.api_url}/{oid_query}")
     resp_data = resp.json
@@ -264,6 +902,37 @@ def test_get_document_endpoint(client, test_args, oid_query):
     assert oid_query == oid
 
 
+def test_get_document_endpoint_not_modified(client, test_args, oid_query):
+    resp = client.get(f"{test_args.api_url}/{oid_query}")
+    etag = resp.headers["ETag"]
+    resp = client.get(
+        f"{test_args.api_url}/{oid_query}", headers={"If-None-Match": etag}
+    )
+    assert resp.status == "304 NOT MODIFIED"
+    assert resp.get_data() == b""
+
+
+def test_get_document_endpoint_etag_from_version_field(
+    client, test_args, oid_query, monkeypatch
+):
+    monkeypatch.setattr(config, "ETAG_VERSION_FIELD", "thrust_to_weight_ratio")
+    resp = client.get(f"{test_args.api_url}/{oid_query}")
+    etag = resp.headers["ETag"]
+    assert services.document_etag(oid_query, 90) in etag
+    resp = client.get(
+        f"{test_args.api_url}/{oid_query}", headers={"If-None-Match": etag}
+    )
+    assert resp.status == "304 NOT MODIFIED"
+
+
+def test_get_collection_endpoint_not_modified(client, test_args):
+    resp = client.get(test_args.api_url)
+    resp = client.get(
+        test_args.api_url, headers={"If-None-Match": resp.headers["ETag"]}
+    )
+    assert resp.status == "304 NOT MODIFIED"
+
+
 def test_update_document_endpoint(client, test_args, oid_query, jwt_token):
     resp = client.patch(
         f"{ test_args.api_url}/{oid_query}",
@@ -273,6 +942,29 @@ def test_update_document_endpoint(client, test_args, oid_query, jwt_token):
     assert resp.status == "204 NO CONTENT"
 
 
+def test_update_document_endpoint_returning_document(
+    client, test_args, oid_query, jwt_token
+):
+    resp = client.patch(
+        f"{test_args.api_url}/{oid_query}?_return=after&_projection=manufacturer",
+        json={"manufacturer": "Energomasher Luna"},
+        headers={"Authorization": f"Bearer {jwt_token}"},
+    )
+    assert resp.status == "200 OK"
+    assert resp.json["manufacturer"] == "Energomasher Luna"
+    assert "name" not in resp.json
+
+
+def test_response_bad_request_when_return_option_is_invalid(
+    client, test_args, oid_query, jwt_token
+):
+    resp = client.delete(
+        f"{test_args.api_url}/{oid_query}?_return=after",
+        headers={"Authorization": f"Bearer {jwt_token}"},
+    )
+    assert resp.status == "400 BAD REQUEST"
+
+
 def test_update_many_documents_endpoint(client, test_args, jwt_token):
     resp = client.patch(
         f"{test_args.api_url}?manufacturer=Energomasher",
@@ -320,3 +1012,123 @@ def test_response_forbidden_when_deleting_documents_without_query(
         headers={"Authorization": f"Bearer {jwt_token}"},
     )
     assert resp.status == "403 FORBIDDEN"
+
+
+def test_index_endpoints(client, test_args, jwt_token):
+    headers = {"Authorization": f"Bearer {jwt_token}"}
+    resp = client.post(
+        f"{test_args.api_url}/_indexes",
+        json={"keys": [["country", 1], ["name", -1]], "name": "country_name"},
+        headers=headers,
+    )
+    assert resp.status == "201 CREATED"
+    assert resp.json["name"] == "country_name"
+
+    resp = client.get(f"{test_args.api_url}/_indexes", headers=headers)
+    assert "country_name" in [index["name"] for index in resp.json]
+
+    resp = client.delete(f"{test_args.api_url}/_indexes/country_name", headers=headers)
+    assert resp.status == "204 NO CONTENT"
+    resp = client.delete(f"{test_args.api_url}/_indexes/country_name", headers=headers)
+    assert resp.status == "404 NOT FOUND"
+
+
+def test_response_bad_request_when_index_spec_is_invalid(client, test_args, jwt_token):
+    resp = client.post(
+        f"{test_args.api_url}/_indexes",
+        json={"keys": {"country": "ascending"}},
+        headers={"Authorization": f"Bearer {jwt_token}"},
+    )
+    assert resp.status == "400 BAD REQUEST"
+
+
+def test_response_forbidden_when_dropping_id_index(client, test_args, jwt_token):
+    resp = client.delete(
+        f"{test_args.api_url}/_indexes/_id_",
+        headers={"Authorization": f"Bearer {jwt_token}"},
+    )
+    assert resp.status == "403 FORBIDDEN"
+
+
+def test_index_advisor_endpoint(client, test_args, jwt_token, monkeypatch):
+    monkeypatch.setattr(config, "INDEX_ADVISOR_ENABLED", True)
+    monkeypatch.setattr(
+        mongo,
+        "explain_query",
+        lambda *args: {
+            "queryPlanner": {
+                "winningPlan": {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}
+            }
+        },
+    )
+    services.shape_recorder.clear()
+
+    for country in ["USSR", "Russia"]:
+        client.get(f"{test_args.api_url}?country={country}&_sort=(name:descending)")
+
+    resp = client.get(
+        f"{test_args.api_url}/_advisor",
+        headers={"Authorization": f"Bearer {jwt_token}"},
+    )
+    (shape,) = resp.json["shapes"]
+    assert shape["filter"] == {"country": 1}
+    assert shape["count"] == 2
+    assert shape["collscan"] and shape["in_memory_sort"]
+    assert shape["suggested_index"] == [["country", 1], ["name", -1]]
+
+
+def test_index_advisor_reports_explain_timeouts(db_connection, test_args, monkeypatch):
+    monkeypatch.setattr(config, "INDEX_ADVISOR_ENABLED", True)
+    monkeypatch.setattr(config, "QUERY_MAX_TIME_MS", 250)
+    explained = []
+
+    def explain_query(db_collection, query, sort_options, max_time_ms):
+        explained.append(
+            mongo.explain_find_command(db_collection, query, sort_options, max_time_ms)
+        )
+        raise ExecutionTimeout("operation exceeded time limit")
+
+    monkeypatch.setattr(mongo, "explain_query", explain_query)
+    services.shape_recorder.clear()
+    services.record_query_shape(
+        test_args.collection_name, {"country": "USSR"}, [("name", -1)]
+    )
+
+    report = services.advise_indexes(db_connection, test_args.collection_name)
+    (shape,) = report["shapes"]
+    assert shape["error"] == "Explain exceeded 250 ms."
+    assert explained == [
+        {
+            "find": test_args.collection_name,
+            "filter": {"country": "USSR"},
+            "sort": {"name": -1},
+            "maxTimeMS": 250,
+        }
+    ]
+
+
+def test_metrics_endpoint(client, test_args):
+    # metrics are recorded once the response is closed, as WSGI servers do
+    client.get(f"{test_args.api_url}?country=USSR").close()
+    resp = client.get("/metrics")
+    assert resp.status == "200 OK"
+    body = resp.data.decode("UTF-8")
+    assert (
+        'mangorest_http_requests_total{method="GET",resource="rockets",'
+        'route="/api/<resource>",status="200"}'
+    ) in body
+    assert (
+        'mangorest_http_request_phase_seconds_count{phase="parse",'
+        'route="/api/<resource>"}'
+    ) in body
+
+
+def test_metrics_command_listener_helpers():
+    assert metrics.command_collection("find", {"find": "rocket_engines"}) == (
+        "rocket_engines"
+    )
+    assert metrics.command_collection("getMore", {"collection": "rocket_engines"}) == (
+        "rocket_engines"
+    )
+    assert metrics.returned_documents({"cursor": {"nextBatch": [{}, {}]}}) == 2
+    assert metrics.returned_documents({"n": 2}) == 0
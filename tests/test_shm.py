@@ -0,0 +1,137 @@
+import multiprocessing
+import time
+
+import pytest
+
+import mangorest.auth as auth
+import mangorest.cache as cache
+import mangorest.config as config
+import mangorest.shm as shm
+
+
+@pytest.fixture
+def segment(tmp_path):
+    # one bucket of 8 entries
+    return shm.Segment(str(tmp_path / "segment"), entries=shm.WAYS, data_size=400)
+
+
+def test_segment_get_set_delete_and_clear(segment):
+    assert segment.get(shm.digest("a")) is None
+    assert segment.set(shm.digest("a"), b"RD-180")
+    assert segment.get(shm.digest("a")) == b"RD-180"
+    assert segment.set(shm.digest("a"), b"RD-191")
+    assert segment.get(shm.digest("a")) == b"RD-191"
+
+    segment.delete(shm.digest("a"))
+    assert segment.get(shm.digest("a")) is None
+
+    segment.set(shm.digest("b"), b"RD-170")
+    segment.clear()
+    assert segment.get(shm.digest("b")) is None
+    assert not segment.set(shm.digest("c"), b"x" * 101)
+
+
+def test_segment_refuses_symlinks_and_files_of_other_users(tmp_path, monkeypatch):
+    target = tmp_path / "target"
+    target.write_bytes(b"not a cache segment")
+    (tmp_path / "link").symlink_to(target)
+    linked = shm.Segment(str(tmp_path / "link"), entries=shm.WAYS, data_size=400)
+    with pytest.raises(OSError):
+        linked.get(shm.digest("a"))
+    assert target.read_bytes() == b"not a cache segment"
+
+    (tmp_path / "other").write_bytes(b"not a cache segment")
+    monkeypatch.setattr(shm.os, "getuid", lambda: shm.os.stat(tmp_path).st_uid + 1)
+    other = shm.Segment(str(tmp_path / "other"), entries=shm.WAYS, data_size=400)
+    with pytest.raises(PermissionError):
+        other.get(shm.digest("a"))
+    assert (tmp_path / "other").read_bytes() == b"not a cache segment"
+
+
+def test_segment_entries_expire(segment):
+    segment.set(shm.digest("a"), b"RD-180", ttl=0.05)
+    assert segment.get(shm.digest("a")) == b"RD-180"
+    time.sleep(0.1)
+    assert segment.get(shm.digest("a")) is None
+
+
+def test_segment_evicts_least_recently_used(segment):
+    for number in range(shm.WAYS):
+        segment.set(shm.digest(number), b"x")
+    segment.get(shm.digest(0))
+    segment.set(shm.digest("new"), b"x")
+    assert segment.get(shm.digest(1)) is None
+    assert segment.get(shm.digest(0)) == b"x"
+    assert segment.stats()["evictions"] == 1
+
+
+def test_segment_values_overwritten_in_the_ring_buffer_are_misses(segment):
+    for number in range(5):
+        segment.set(shm.digest(number), bytes([number]) * 90)
+    assert segment.get(shm.digest(0)) is None
+    # the last value wraps around the end of the data region
+    assert segment.get(shm.digest(4)) == bytes([4]) * 90
+
+
+def test_segment_namespace_invalidation(segment):
+    namespace = shm.digest("rocket_engines")
+    generation = segment.generation(namespace)
+    segment.set(shm.digest("a"), b"RD-180", namespace_digest=namespace)
+    segment.set(shm.digest("b"), b"RD-170")
+
+    segment.invalidate(namespace)
+    assert segment.get(shm.digest("a")) is None
+    assert segment.get(shm.digest("b")) == b"RD-170"
+    assert segment.generation(namespace) == generation + 1
+    assert not segment.set(
+        shm.digest("a"), b"RD-180", namespace_digest=namespace, generation=generation
+    )
+
+
+def set_and_get(segment):
+    segment.set(shm.digest("from-child"), b"RD-180")
+    segment.get(shm.digest("from-parent"))
+
+
+def test_segment_is_shared_by_forked_workers(segment):
+    segment.set(shm.digest("from-parent"), b"RD-170")
+    context = multiprocessing.get_context("fork")
+    process = context.Process(target=set_and_get, args=(segment,))
+    process.start()
+    process.join()
+
+    assert segment.get(shm.digest("from-child")) == b"RD-180"
+    stats = segment.stats()
+    assert stats["hits"] == 2
+    assert stats["entries"] == 2
+    # the child exited, only this worker is left
+    (worker,) = stats["workers"]
+    assert worker["pid"] == stats["worker"]
+    assert worker["hits"] == 1
+
+
+def test_shared_backends(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "CACHE_BACKEND", "shared")
+    monkeypatch.setattr(config, "SHARED_CACHE_DIR", str(tmp_path))
+
+    user_cache = cache.create_cache("users", 16, 60, auth.dump_user, auth.load_user)
+    assert isinstance(user_cache, cache.SharedTTLCache)
+    user = auth.MangoUser("neeban", b"hashed")
+    user_cache.set("neeban", user)
+    assert user_cache.get("neeban") == user
+    user_cache.invalidate("neeban")
+    assert user_cache.get("neeban") is None
+
+    response_cache = cache.create_response_cache("responses", 4096, 64)
+    assert isinstance(response_cache, cache.SharedResponseCache)
+    response = cache.CachedResponse(b"[]", [("ETag", 'W/"abc"')])
+    generation = response_cache.generation("rocket_engines")
+    assert response_cache.set("rocket_engines", ("key",), response, generation)
+    assert response_cache.get(("key",)) == response
+    response_cache.invalidate("rocket_engines")
+    assert response_cache.get(("key",)) is None
+    assert response_cache.stats()["backend"] == "shared"
+
+    monkeypatch.setattr(config, "CACHE_BACKEND", "redis")
+    with pytest.raises(ValueError):
+        cache.create_response_cache("responses", 4096, 64)
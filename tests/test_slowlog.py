@@ -0,0 +1,115 @@
+import datetime
+import json
+
+from pymongo import monitoring
+
+from mangorest import config, metrics, slowlog
+
+CONNECTION_ID = ("localhost", 27017)
+
+
+def started(command, request_id):
+    return monitoring.CommandStartedEvent(
+        command, "mangorest", request_id, CONNECTION_ID, request_id
+    )
+
+
+def succeeded(command_name, reply, request_id, milliseconds):
+    return monitoring.CommandSucceededEvent(
+        datetime.timedelta(milliseconds=milliseconds),
+        reply,
+        command_name,
+        request_id,
+        CONNECTION_ID,
+        request_id,
+    )
+
+
+def slow_query_records(caplog):
+    return [
+        json.loads(record.message)
+        for record in caplog.records
+        if record.name == "mangorest.slowlog"
+    ]
+
+
+def test_describe_normalizes_find():
+    command = {
+        "find": "rocket_engines",
+        "filter": {"country": "USSR", "thrust": {"$gt": 100}},
+        "sort": {"name": -1, "score": {"$meta": "textScore"}},
+        "projection": {
+            "name": 1,
+            "tests": {"$slice": [10, 5]},
+            "stages": {"$elemMatch": {"serial": "SN-1234"}},
+        },
+    }
+    assert slowlog.describe("find", command) == {
+        "command": "find",
+        "collection": "rocket_engines",
+        "filter": {"country": 1, "thrust": {"$gt": 1}},
+        "sort": {"name": -1, "score": {"$meta": 1}},
+        "projection": {
+            "name": 1,
+            "tests": {"$slice": 1},
+            "stages": {"$elemMatch": {"serial": 1}},
+        },
+    }
+
+
+def test_explain_stats():
+    explain = {
+        "queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}},
+        "executionStats": {"totalDocsExamined": 5000, "totalKeysExamined": 0},
+    }
+    assert slowlog.explain_stats(explain) == {
+        "docs_examined": 5000,
+        "keys_examined": 0,
+        "plan": ["COLLSCAN"],
+    }
+
+
+def test_slow_cursor_is_logged_with_its_get_mores(caplog):
+    listener = slowlog.SlowQueryListener(threshold_ms=100, explain_sample_rate=0)
+    find = {"find": "rocket_engines", "filter": {"country": "USSR"}}
+
+    listener.started(started(find, 1))
+    listener.succeeded(
+        succeeded("find", {"cursor": {"id": 42, "firstBatch": [{}, {}]}}, 1, 60)
+    )
+    assert slow_query_records(caplog) == []
+
+    listener.started(started({"getMore": 42, "collection": "rocket_engines"}, 2))
+    listener.succeeded(
+        succeeded("getMore", {"cursor": {"id": 0, "nextBatch": [{}]}}, 2, 50)
+    )
+
+    (record,) = slow_query_records(caplog)
+    assert record["command"] == "find"
+    assert record["filter"] == {"country": 1}
+    assert record["duration_ms"] == 110
+    assert record["docs_returned"] == 3
+
+
+def test_fast_command_is_not_logged(caplog):
+    listener = slowlog.SlowQueryListener(threshold_ms=100, explain_sample_rate=0)
+    listener.started(started({"count": "rocket_engines", "query": {}}, 1))
+    listener.succeeded(succeeded("count", {"n": 3}, 1, 5))
+    assert slow_query_records(caplog) == []
+
+
+def test_explains_beyond_the_queue_depth_are_dropped(caplog, monkeypatch):
+    monkeypatch.setattr(config, "METRICS_ENABLED", True)
+    dropped = metrics.SLOW_QUERY_EXPLAINS_DROPPED._value.get()
+    listener = slowlog.SlowQueryListener(
+        threshold_ms=100, explain_sample_rate=1, explain_queue_depth=0
+    )
+    listener._get_executor()
+    listener._explain_slots.acquire()
+
+    listener.started(started({"count": "rocket_engines", "query": {}}, 1))
+    listener.succeeded(succeeded("count", {"n": 3}, 1, 150))
+
+    (record,) = slow_query_records(caplog)
+    assert record["explain_dropped"] is True
+    assert metrics.SLOW_QUERY_EXPLAINS_DROPPED._value.get() == dropped + 1
@@ -0,0 +1,316 @@
+import json
+import threading
+import time
+
+import pytest
+from bson.objectid import ObjectId
+from bson.timestamp import Timestamp
+from pymongo.errors import OperationFailure
+
+import mangorest.services as services
+from mangorest import app, exceptions, watch
+
+
+class FakeChangeStream:
+    """Stands in for a pymongo ChangeStream, returning the changes put on it."""
+
+    def __init__(self, events=None, error=None):
+        self.events = list(events or [])
+        self.error = error
+        self.alive = True
+        self.lock = threading.Lock()
+
+    def push(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def try_next(self):
+        if self.error:
+            raise self.error
+        with self.lock:
+            if self.events:
+                return self.events.pop(0)
+        time.sleep(0.01)
+        return None
+
+    def close(self):
+        self.alive = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def change(operation_type, number, document=None):
+    oid = ObjectId()
+    event = {
+        "_id": {"_data": f"8261{number:04d}"},
+        "operationType": operation_type,
+        "clusterTime": Timestamp(1650000000, number),
+        "documentKey": {"_id": oid},
+    }
+    if document is not None:
+        event["fullDocument"] = {"_id": oid, **document}
+    return event
+
+
+def parse_events(chunks):
+    events = []
+    for chunk in chunks:
+        if chunk.startswith(":"):
+            continue
+        fields = dict(line.split(": ", 1) for line in chunk.strip().split("\n"))
+        fields["data"] = json.loads(fields["data"])
+        events.append(fields)
+    return events
+
+
+def read_events(events, count):
+    chunks = []
+    for chunk in events:
+        if not chunk.startswith(":"):
+            chunks.append(chunk)
+        if len(chunks) == count:
+            break
+    return parse_events(chunks)
+
+
+@pytest.fixture
+def streams():
+    opened = []
+
+    def open_stream(collection_name, resume_after):
+        stream = FakeChangeStream()
+        opened.append(stream)
+        return stream
+
+    hub = watch.ChangeStreamHub(open_stream)
+    return hub, opened
+
+
+def test_match_filter_with_query_string_filters():
+    document = {
+        "name": "RD-180",
+        "thrust": 3830,
+        "is_active": True,
+        "stages": [{"name": "first"}, {"name": "second"}],
+        "tags": ["kerolox", "staged"],
+    }
+    matching = [
+        {"name": "RD-180"},
+        {"thrust": "gt[int].3000"},
+        {"thrust": "lte[float].3830.0", "name": "ne[str].RD-170"},
+        {"is_active": "[bool].true"},
+        {"stages.name": "second"},
+        {"tags": "in[list-str].(hypergolic,kerolox)"},
+        {"or": "(thrust.lt[int].10,name.eq[str].RD-180)"},
+    ]
+    for query_params in matching:
+        query = services.map_to_query_operator(query_params)
+        assert watch.match_filter(document, query), query_params
+
+    not_matching = [
+        {"name": "RD-170"},
+        {"thrust": "gt[str].3000"},
+        {"is_active": "[int].1"},
+        {"tags": "nin[list-str].(staged)"},
+        {"and": "(thrust.gt[int].10,name.eq[str].RD-170)"},
+        {"country": "USSR"},
+    ]
+    for query_params in not_matching:
+        query = services.map_to_query_operator(query_params)
+        assert not watch.match_filter(document, query), query_params
+
+
+def test_check_filter_rejects_operators_not_matched_in_process():
+    watch.check_filter(services.map_to_query_operator({"thrust": "gte[int].1"}))
+    with pytest.raises(exceptions.UnsupportedWatchFilterError):
+        watch.check_filter(services.map_to_query_operator({"name": "regex[str].^RD"}))
+
+
+def test_resume_token_round_trip():
+    event = change("insert", 1, {"name": "RD-180"})
+    token = watch.encode_token(event["_id"])
+    assert watch.decode_token(token) == event["_id"]
+    for malformed in ["not-a-token", "", watch.encode_token({"a": 1})]:
+        with pytest.raises(exceptions.InvalidResumeTokenError):
+            watch.decode_token(malformed)
+
+
+def test_format_event():
+    event = change("insert", 1, {"name": "RD-180"})
+    (parsed,) = parse_events([watch.format_event(event)])
+    assert parsed["event"] == "insert"
+    assert watch.decode_token(parsed["id"]) == event["_id"]
+    assert parsed["data"]["fullDocument"]["name"] == "RD-180"
+    assert parsed["data"]["documentKey"]["_id"] == {
+        "$oid": str(event["documentKey"]["_id"])
+    }
+
+
+def test_hub_shares_one_stream_and_filters_per_subscriber(streams):
+    hub, opened = streams
+    soviet = watch.Subscription({"country": "USSR"}, 100)
+    everything = watch.Subscription({}, 100)
+    hub.subscribe("rockets", soviet)
+    hub.subscribe("rockets", everything)
+    assert len(opened) == 1
+    assert hub.subscribers("rockets") == 2
+
+    soviet_events = watch.iter_events(hub, "rockets", soviet, None, None, 0.05)
+    all_events = watch.iter_events(hub, "rockets", everything, None, None, 0.05)
+    opened[0].push(change("insert", 1, {"country": "USA"}))
+    opened[0].push(change("update", 2, {"country": "USSR"}))
+    opened[0].push(change("delete", 3))
+    opened[0].push({**change("drop", 4), "operationType": "drop"})
+
+    assert [event["event"] for event in read_events(all_events, 3)] == [
+        "insert",
+        "update",
+        "delete",
+    ]
+    assert [event["event"] for event in read_events(soviet_events, 2)] == [
+        "update",
+        "delete",
+    ]
+
+    soviet_events.close()
+    all_events.close()
+    assert hub.subscribers("rockets") == 0
+    for _ in range(100):
+        if not opened[0].alive:
+            break
+        time.sleep(0.01)
+    assert not opened[0].alive
+
+
+def test_subscriber_is_closed_when_it_falls_behind(streams):
+    hub, opened = streams
+    subscription = watch.Subscription({}, 2)
+    hub.subscribe("rockets", subscription)
+    for number in range(1, 4):
+        opened[0].push(change("insert", number, {"name": "RD-180"}))
+
+    events = list(watch.iter_events(hub, "rockets", subscription, None, None, 1))
+    parsed = parse_events(events)
+    assert [event["event"] for event in parsed] == ["insert", "insert", "error"]
+    assert "Reconnect" in parsed[-1]["data"]["error"]
+
+
+def test_resuming_catches_up_without_duplicates(streams):
+    hub, opened = streams
+    missed = [change("insert", number, {"name": "RD-180"}) for number in (1, 2, 3)]
+    subscription = watch.Subscription({}, 100)
+    hub.subscribe("rockets", subscription)
+    # the shared stream got the last missed change after the subscription
+    opened[0].push(missed[2])
+    opened[0].push(change("insert", 4, {"name": "RD-191"}))
+    while subscription.pending() < 2:
+        time.sleep(0.01)
+
+    catch_up = FakeChangeStream(missed[1:])
+    events = watch.iter_events(
+        hub, "rockets", subscription, catch_up, missed[0]["_id"], 0.05
+    )
+    numbers = [
+        watch.decode_token(event["id"])["_data"] for event in read_events(events, 3)
+    ]
+    assert numbers == ["82610002", "82610003", "82610004"]
+    events.close()
+    assert not catch_up.alive
+
+
+def test_subscribe_raises_when_the_stream_cannot_be_opened():
+    def open_stream(collection_name, resume_after):
+        raise OperationFailure(
+            "The $changeStream stage is only supported on replica sets"
+        )
+
+    hub = watch.ChangeStreamHub(open_stream)
+    with pytest.raises(OperationFailure):
+        hub.subscribe("rockets", watch.Subscription({}, 10))
+    assert hub.subscribers("rockets") == 0
+
+
+def test_hub_stops_the_stream_on_unexpected_errors(streams):
+    def open_stream(collection_name, resume_after):
+        raise TypeError("not a pymongo error")
+
+    hub = watch.ChangeStreamHub(open_stream)
+    with pytest.raises(TypeError):
+        hub.subscribe("rockets", watch.Subscription({}, 10))
+    assert hub.subscribers("rockets") == 0
+
+    # failing while the stream is running closes the subscribers
+    hub, opened = streams
+    subscription = watch.Subscription({}, 10)
+    hub.subscribe("rockets", subscription)
+    opened[0].error = ValueError("not a pymongo error either")
+    for _ in range(100):
+        if subscription.closed:
+            break
+        time.sleep(0.01)
+    assert subscription.error == "The change stream failed."
+    assert hub.subscribers("rockets") == 0
+
+
+def test_cache_invalidator_invalidates_on_changes(monkeypatch):
+    opened = []
+
+    def open_stream(collection_name, resume_after):
+        opened.append(FakeChangeStream())
+        return opened[-1]
+
+    monkeypatch.setattr(watch, "_hub", None)
+    invalidated = []
+    invalidator = watch.CacheInvalidator(open_stream, invalidated.append)
+    assert not invalidator.watching("rockets")
+    for _ in range(100):
+        if invalidator.watching("rockets"):
+            break
+        time.sleep(0.01)
+    assert invalidator.watching("rockets")
+
+    # changes made before watching are not known
+    assert invalidated == ["rockets"]
+
+    opened[0].push(change("update", 1, {"name": "RD-180"}))
+    for _ in range(100):
+        if len(invalidated) == 2:
+            break
+        time.sleep(0.01)
+    assert invalidated == ["rockets"] * 2
+
+    # the changes are missed once the change stream is closed, eg. dropped
+    opened[0].close()
+    for _ in range(100):
+        if len(invalidated) == 3:
+            break
+        time.sleep(0.01)
+    assert invalidated == ["rockets"] * 3
+    assert not invalidator.watching("rockets")
+
+
+def test_watch_endpoint_rejects_unsupported_filters_and_tokens():
+    threaded = {"wsgi.multithread": True}
+    with app.test_client() as client:
+        resp = client.get(
+            "/api/rockets/_watch?name=regex[str].^RD", environ_overrides=threaded
+        )
+        assert resp.status_code == 400
+        resp = client.get(
+            "/api/rockets/_watch",
+            headers={"Last-Event-ID": "nope"},
+            environ_overrides=threaded,
+        )
+        assert resp.status_code == 400
+        assert client.get("/api/unknown/_watch").status_code == 404
+
+
+def test_watch_endpoint_needs_a_threaded_server():
+    with app.test_client() as client:
+        resp = client.get("/api/rockets/_watch")
+        assert resp.status_code == 501
+        assert "gthread" in resp.json["error"]